@@ -0,0 +1,256 @@
+"""
+Benchmarks for the scoring functions.
+
+Run with `python benchmark.py NAME [documents.txt.gz]`, where NAME is one of
+the bench_* functions below without its prefix (e.g. `python benchmark.py
+batch`). The documents are the TIME collection (see main.read_data), or the
+lines of a gzipped file if one is given.
+"""
+import contextlib
+import cProfile
+import gzip
+import io
+import os
+import pstats
+import random
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import evaluate
+
+import index
+import main as searcher
+import score
+
+SCORERS = [score.Cosine(), score.RSV(), score.BM25(k=1, b=.5)]
+
+
+def read_docs(filename=None):
+    """ Return the TIME documents, or the stripped lines of a gzipped file. """
+    if filename is None:
+        return searcher.read_data()[2]
+    with gzip.open(filename, 'rt') as f:
+        return [line.strip() for line in f]
+
+
+def sample_queries(docs, n=2000, max_terms=5, seed=0):
+    """ Return n queries of 1 to max_terms words taken from random documents. """
+    rand = random.Random(seed)
+    tokenize = index.Index().tokenize
+    queries = []
+    while len(queries) < n:
+        tokens = tokenize(rand.choice(docs))
+        if tokens:
+            queries.append(' '.join(rand.choice(tokens) for _ in range(rand.randint(1, max_terms))))
+    return queries
+
+
+def bench_batch(filename=None):
+    """ Compare searching queries one at a time with main.search_batch, and
+    check that both return the same rankings. """
+    docs = read_docs(filename)
+    indexer = index.Index(docs)
+    queries = sample_queries(docs)
+    print('%d documents, %d queries' % (len(docs), len(queries)))
+    for scorer in SCORERS:
+        start = time.perf_counter()
+        expected = [searcher.search(q, scorer, indexer) for q in queries]
+        loop = time.perf_counter() - start
+        start = time.perf_counter()
+        results = searcher.search_batch(queries, scorer, indexer)
+        batch = time.perf_counter() - start
+        print('%-16s loop %8.1f queries/s  batch %8.1f queries/s  same results: %s' %
+              (scorer, len(queries) / loop, len(queries) / batch, results == expected))
+
+
+def bench_matrix(filename=None):
+    """ Compare the postings loops of the scoring functions with the same
+    functions using matrix.TermDocumentMatrix, and check that both give the
+    same scores to 6 decimals. """
+    docs = read_docs(filename)
+    indexer = index.Index(docs)
+    vectors = [indexer.query_to_vector(indexer.tokenize(q)) for q in sample_queries(docs)]
+    start = time.perf_counter()
+    score.term_document_matrix(indexer)
+    print('%d documents, %d queries, matrix built in %.2fs' %
+          (len(docs), len(vectors), time.perf_counter() - start))
+    for loop_scorer, matrix_scorer in [(score.Cosine(), score.Cosine(matrix=True)),
+                                       (score.RSV(), score.RSV(matrix=True)),
+                                       (score.BM25(k=1, b=.5), score.BM25(k=1, b=.5, matrix=True))]:
+        start = time.perf_counter()
+        expected = [loop_scorer.score(v, indexer) for v in vectors]
+        loop = time.perf_counter() - start
+        start = time.perf_counter()
+        results = [matrix_scorer.score(v, indexer) for v in vectors]
+        matrix = time.perf_counter() - start
+        same = all(list(r) == list(e) and all(round(r[d], 6) == round(e[d], 6) for d in e)
+                   for r, e in zip(results, expected))
+        print('%-16s loop %8.1f queries/s  matrix %8.1f queries/s  same scores: %s' %
+              (loop_scorer, len(vectors) / loop, len(vectors) / matrix, same))
+
+
+def bench_experiment(filename=None, n_queries=200):
+    """ Compare main.run_all with main.run_all_parallel for 1, 2 and 4
+    workers on the scorers of main.main, and check that the tables written by
+    write_results are identical. The relevance judgements are random. """
+    docs = read_docs(filename)
+    indexer = index.Index(docs)
+    rand = random.Random(0)
+    queries = dict(enumerate(sample_queries(docs, n_queries), 1))
+    relevances = dict((qid, rand.sample(range(1, len(docs) + 1), 10)) for qid in queries)
+    scorers = [score.Cosine(), score.RSV(), score.BM25(k=1, b=.5), score.BM25(k=1, b=1),
+               score.BM25(k=2, b=.5), score.BM25(k=2, b=1)]
+    evaluators = [evaluate.Precision(), evaluate.Recall(), evaluate.F1(), evaluate.MAP()]
+    args = (queries, relevances, docs, indexer, scorers, evaluators, 10)
+    path = os.path.join(tempfile.mkdtemp(), 'Results.md')
+
+    def table(results):
+        searcher.write_results(results, path)
+        with open(path) as f:
+            return f.read()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = table(searcher.run_all(*args))
+    base = time.perf_counter() - start
+    print('run_all              %7.2fs' % base)
+    for workers in (1, 2, 4):
+        start = time.perf_counter()
+        results = table(searcher.run_all_parallel(*args, workers=workers))
+        elapsed = time.perf_counter() - start
+        print('run_all_parallel(%d)  %7.2fs  speedup %4.2fx  same table: %s' %
+              (workers, elapsed, base / elapsed, results == expected))
+    os.remove(path)
+
+
+def bench_grid(filename=None, n_queries=200):
+    """ Compare evaluating a grid of BM25 settings with one score.BM25
+    scorer per setting against main.tune_bm25 with a score.BM25Grid, and
+    check that both give the same evaluations. The relevance judgements are
+    random. """
+    docs = read_docs(filename)
+    indexer = index.Index(docs)
+    rand = random.Random(0)
+    queries = dict(enumerate(sample_queries(docs, n_queries), 1))
+    relevances = dict((qid, rand.sample(range(1, len(docs) + 1), 10)) for qid in queries)
+    evaluators = [evaluate.Precision(), evaluate.Recall(), evaluate.F1(), evaluate.MAP()]
+    grid = score.BM25Grid(ks=[.5, 1, 1.2, 1.5, 2, 3], bs=[0, .25, .5, .75, 1])
+    scorers = [score.BM25(k=k, b=b) for k, b in grid.params]
+
+    # run_all keys its results by str(scorer), which rounds k down, so each
+    # setting is run on its own and matched to the grid by its parameters.
+    start = time.perf_counter()
+    expected = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for params, scorer in zip(grid.params, scorers):
+            expected[params] = searcher.run_all(queries, relevances, docs, indexer, [scorer],
+                                                evaluators, 10)[str(scorer)]
+    loop = time.perf_counter() - start
+    start = time.perf_counter()
+    results, best = searcher.tune_bm25(queries, relevances, indexer, grid, evaluators, 10)
+    tuned = time.perf_counter() - start
+    same = all(results[label] == expected[params] for label, params in zip(grid.labels, grid.params))
+    print('%d settings, %d queries' % (len(grid.params), len(queries)))
+    print('one scorer per setting %7.2fs' % loop)
+    print('BM25Grid               %7.2fs  speedup %5.1fx  same evaluations: %s' %
+          (tuned, loop / tuned, same))
+    for evaluator in evaluators:
+        (k, b), value = best[str(evaluator)]
+        print('best for %-9s k=%g b=%g (%.4f)' % (evaluator, k, b, value))
+
+
+def bench_evaluate(filename=None, n_queries=500, depth=1000):
+    """ Compare evaluating ranked lists of the given depth with the
+    evaluate.py classes, one query at a time, against one
+    evaluate.BatchEvaluator call, and check that both give the same values.
+    The rankings and the (large) relevance judgements are random. """
+    rand = random.Random(0)
+    n_docs = 20000
+    rankings = [rand.sample(range(1, n_docs + 1), depth) for _ in range(n_queries)]
+    relevances = [rand.sample(range(1, n_docs + 1), rand.randint(1, 2000))
+                  for _ in range(n_queries)]
+    evaluators = [evaluate.Precision(), evaluate.Recall(), evaluate.F1(), evaluate.MAP()]
+    names = ['P', 'R', 'F1', 'AP']
+    cutoffs = (10, 100, 1000)
+
+    start = time.perf_counter()
+    expected = dict(('%s@%d' % (name, k), [e.evaluate(hits[:k], relevant)
+                                            for hits, relevant in zip(rankings, relevances)])
+                    for name, e in zip(names, evaluators) for k in cutoffs)
+    loop = time.perf_counter() - start
+    start = time.perf_counter()
+    results = evaluate.BatchEvaluator(cutoffs).evaluate(rankings, relevances)
+    batch = time.perf_counter() - start
+    same = all(results[name].tolist() == values for name, values in expected.items())
+    print('%d queries, depth %d, cutoffs %s' % (n_queries, depth, cutoffs))
+    print('classes         %7.3fs (P, R, F1, AP)' % loop)
+    print('BatchEvaluator  %7.3fs (P, R, F1, AP, nDCG, RR)  same values: %s' % (batch, same))
+
+
+def bench_profile(filename=None, n_queries=500):
+    """ Profile scoring the sample queries with each of main.main's
+    scorers, and report the time and the number of math.log10 calls per
+    query. """
+    docs = read_docs(filename)
+    indexer = index.Index(docs)
+    vectors = [indexer.query_to_vector(indexer.tokenize(q))
+               for q in sample_queries(docs, n_queries)]
+    for scorer in [score.Cosine(), score.RSV(), score.BM25(k=1, b=.5)]:
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        for vector in vectors:
+            scorer.score(vector, indexer)
+        profile.disable()
+        elapsed = time.perf_counter() - start
+        calls = sum(stat[1] for func, stat in pstats.Stats(profile).stats.items()
+                    if func[2] == '<built-in method math.log10>')
+        print('%-16s %7.3f ms/query (profiled)  %8.1f log10 calls/query' %
+              (scorer, 1000 * elapsed / len(vectors), 1. * calls / len(vectors)))
+
+
+def bench_lexicon(filename=None):
+    """ Compare building the index keyed by term, from documents tokenized
+    into lists of strings, with index.Index, which keys it by term id and
+    keeps the documents as arrays of term ids, and check that both have the
+    same postings. Both builds include the document lengths and norms;
+    index.Index also builds its IDF and log TF tables. """
+    docs = read_docs(filename)
+
+    def build_terms():
+        indexer = index.Index()
+        indexer.documents = [indexer.tokenize(d) for d in docs]
+        indexer.doc_freqs = indexer.count_doc_frequencies(indexer.documents)
+        indexer.index = indexer.create_tf_index(indexer.documents, indexer.doc_freqs)
+        indexer.doc_lengths, indexer.mean_doc_length = indexer.compute_doc_lengths(indexer.index)
+        indexer.doc_norms = indexer.compute_doc_norms(indexer.index, len(docs), indexer.doc_freqs)
+        return indexer
+
+    indexers = {}
+    for label, build in (('terms', build_terms), ('term ids', lambda: index.Index(docs))):
+        # The best of 3 builds, timed without tracemalloc, which slows down
+        # every allocation.
+        elapsed = min(timeit.repeat(build, number=1, repeat=3))
+        tracemalloc.start()
+        indexers[label] = build()
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('%-9s build %6.2fs  documents and index %9.1f KiB  peak %9.1f KiB' %
+              (label, elapsed, size / 1024., peak / 1024.))
+    terms, ids = indexers['terms'], indexers['term ids']
+    same = (len(terms.index) == len(ids.index) and
+            all(terms.index[term] == ids.index[ids.lexicon[term]] for term in terms.index))
+    print('same postings: %s' % same)
+
+
+def main():
+    name = sys.argv[1] if len(sys.argv) > 1 else 'batch'
+    filename = sys.argv[2] if len(sys.argv) > 2 else None
+    globals()['bench_' + name](filename)
+
+
+if __name__ == '__main__':
+    main()
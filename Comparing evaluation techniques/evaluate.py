@@ -36,8 +36,9 @@ class Precision(EvaluatorFunction):
         0.5
         """
         count = 0
+        hits_set = set(hits)
         for rel in relevant:
-            if rel in hits:
+            if rel in hits_set:
                 count += 1
         
         return 1.0 * count / len(hits)
@@ -56,8 +57,9 @@ class Recall(EvaluatorFunction):
         0.5
         """
         count = 0
+        hits_set = set(hits)
         for rel in relevant:
-            if rel in hits:
+            if rel in hits_set:
                 count += 1
         
         return 1.0 * count / len(relevant)
@@ -94,8 +96,9 @@ class MAP(EvaluatorFunction):
         """
         relcount = 0
         meansum = 0.0
+        relevant_set = set(relevant)
         for i in range(len(hits)):
-            if hits[i] in relevant:
+            if hits[i] in relevant_set:
                 relcount += 1
                 meansum += (1. * relcount / (i+1))
                 
@@ -103,3 +106,111 @@ class MAP(EvaluatorFunction):
 
     def __repr__(self):
         return 'MAP'
+
+
+class BatchEvaluator(object):
+    """
+    Evaluate the ranked lists of many queries at once, at several cutoffs.
+
+    The hits of all queries are put in one (queries x depth) array and
+    marked relevant or not with a single NumPy membership test; every
+    metric is then computed from that mask for every query and cutoff.
+    At a cutoff k, the metrics are:
+
+      P@k.......Precision().evaluate(hits[:k], relevant)
+      R@k.......Recall().evaluate(hits[:k], relevant)
+      F1@k......F1().evaluate(hits[:k], relevant)
+      AP@k......MAP().evaluate(hits[:k], relevant)
+      nDCG@k....normalized discounted cumulative gain, with binary gains
+      RR@k......reciprocal rank of the first relevant hit, 0 if there is none
+
+    and P, R, F1 and AP equal the values of the classes above exactly.
+    Document ids are assumed not to repeat within a ranked list or a list
+    of relevant documents.
+
+    >>> evaluator = BatchEvaluator(cutoffs=(2, 4))
+    >>> results = evaluator.evaluate([[1, 2, 3, 4], [5, 6]], [[2, 4], [7, 5]])
+    >>> results['P@4'].tolist(), results['R@2'].tolist()
+    ([0.5, 0.5], [0.5, 0.5])
+    >>> results['AP@4'].tolist() == [MAP().evaluate([1, 2, 3, 4], [2, 4]), MAP().evaluate([5, 6], [7, 5])]
+    True
+    >>> results['RR@4'].tolist()
+    [0.5, 1.0]
+    >>> evaluator.mean(results)['F1@4']  # doctest:+ELLIPSIS
+    0.5833...
+    """
+    def __init__(self, cutoffs=(10,)):
+        self.cutoffs = sorted(cutoffs)
+
+    def relevance_mask(self, rankings, relevances):
+        """
+        Params:
+          rankings.....A list of ranked lists of document ids, one per query.
+          relevances...A list of lists of relevant document ids, in the same
+                       query order.
+        Returns:
+          A (mask, n_hits, n_relevant) tuple: a boolean (queries x depth)
+          array marking the relevant hits, where depth is the largest cutoff,
+          and the number of hits (up to depth) and of relevant documents of
+          each query.
+        """
+        depth = self.cutoffs[-1]
+        hits = np.full((len(rankings), depth), -1, dtype=np.int64)
+        n_hits = np.zeros(len(rankings), dtype=np.int64)
+        for row, ranking in enumerate(rankings):
+            ranking = ranking[:depth]
+            hits[row, :len(ranking)] = ranking
+            n_hits[row] = len(ranking)
+        n_relevant = np.array([len(relevant) for relevant in relevances], dtype=np.int64)
+        # Number every (query, document) pair, so that one binary search over
+        # the sorted relevant pairs tests all the hits.
+        relevant = np.array([doc for r in relevances for doc in r], dtype=np.int64)
+        width = max(int(hits.max(initial=0)), int(relevant.max(initial=0))) + 2
+        rows = np.repeat(np.arange(len(relevances), dtype=np.int64), n_relevant)
+        relevant_keys = np.sort(rows * width + relevant)
+        keys = np.arange(len(rankings), dtype=np.int64)[:, None] * width + hits
+        found = np.searchsorted(relevant_keys, keys)
+        mask = (relevant_keys[np.minimum(found, max(len(relevant_keys) - 1, 0))] == keys
+                if len(relevant_keys) else np.zeros(keys.shape, dtype=bool))
+        return mask & (hits >= 0), n_hits, n_relevant
+
+    def evaluate(self, rankings, relevances):
+        """
+        Params:
+          rankings.....A list of ranked lists of document ids, one per query.
+          relevances...A list of lists of relevant document ids, in the same
+                       query order.
+        Returns:
+          A dict from metric name (e.g. 'P@10') to an array with its value
+          for each query.
+        """
+        mask, n_hits, n_relevant = self.relevance_mask(rankings, relevances)
+        ranks = np.arange(1, mask.shape[1] + 1)
+        found = np.cumsum(mask, axis=1)
+        # Running sums add one term per rank, in rank order, like MAP's loop.
+        precision_sums = np.cumsum(np.where(mask, found / ranks, 0.0), axis=1)
+        gains = np.cumsum(np.where(mask, 1 / np.log2(ranks + 1), 0.0), axis=1)
+        ideal_gains = np.cumsum(1 / np.log2(ranks + 1))
+        first = np.where(mask.any(axis=1), mask.argmax(axis=1) + 1, 0)
+        results = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for k in self.cutoffs:
+                count = found[:, k-1]
+                precision = 1.0 * count / np.minimum(n_hits, k)
+                recall = 1.0 * count / n_relevant
+                f1 = (2.0 * recall * precision) / (precision + recall)
+                results['P@%d' % k] = precision
+                results['R@%d' % k] = recall
+                results['F1@%d' % k] = np.where(precision + recall != 0, f1, 0.0)
+                results['AP@%d' % k] = precision_sums[:, k-1] / n_relevant
+                ideal = np.minimum(n_relevant, k)
+                results['nDCG@%d' % k] = np.where(
+                    ideal > 0, gains[:, k-1] / ideal_gains[np.maximum(ideal, 1) - 1], 0.0)
+                results['RR@%d' % k] = np.where((first > 0) & (first <= k),
+                                                1.0 / np.maximum(first, 1), 0.0)
+        return results
+
+    def mean(self, results):
+        """ Return a dict from metric name to its mean over the queries,
+        summed in query order as run_all sums evaluations. """
+        return dict((name, sum(values.tolist()) / len(values)) for name, values in results.items())
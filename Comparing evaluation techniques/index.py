@@ -1,25 +1,82 @@
 """ Assignment 2
+
+Terms are numbered by a lexicon.Lexicon in order of first appearance:
+the documents are kept as arrays of term ids, the index structures as
+lexicon.TermTables indexed by term id, and query vectors map term id to
+IDF.
 """
+from array import array
 from collections import Counter, defaultdict
 import math
+import multiprocessing
 import re
 import numpy as np
 
+from lexicon import Lexicon, TermTable
+
 class Index(object):
 
-    def __init__(self, docs=None):
-        """ Do not modify.
+    def __init__(self, docs=None, workers=1):
+        """
         Create a new index by parsing the given file containing documents,
-        one per line."""
+        one per line. With workers > 1 the documents are tokenized and
+        counted by that many processes (see create_tf_index_parallel)."""
         self.documents = docs
+        self.lexicon = Lexicon()
         if docs:
-            self.documents = [self.tokenize(d) for d in self.documents]
-            self.doc_freqs = self.count_doc_frequencies(self.documents)
-            self.index = self.create_tf_index(self.documents, self.doc_freqs)
+            if workers > 1:
+                self.documents, doc_freqs, index = self.create_tf_index_parallel(
+                    docs, workers, self.lexicon)
+            else:
+                self.documents = [self.lexicon.encode(self.tokenize(d)) for d in self.documents]
+                doc_freqs = self.count_doc_frequencies(self.documents)
+                index = self.create_tf_index(self.documents, doc_freqs)
+            self.doc_freqs = TermTable(doc_freqs, 'd')
+            self.index = TermTable(index)
+            self.idfs, self.log_tfs = self.create_tables(
+                self.index, len(self.documents), self.doc_freqs)
             self.doc_lengths, self.mean_doc_length = self.compute_doc_lengths(self.index)
-            self.doc_norms = self.compute_doc_norms(self.index, len(self.documents), self.doc_freqs)
+            self.doc_norms = self.compute_doc_norms(self.index, len(self.documents), self.doc_freqs,
+                                                    self.idfs, self.log_tfs)
+
+    def create_tables(self, index, n_docs, doc_freqs):
+        """
+        Precompute the logarithms the scoring functions need, so that they
+        are computed once per term and per distinct term frequency instead of
+        once per posting.
+
+        Params:
+            index.......A dict mapping term id (0 to n-1) to list of (doc_id, term_frequency) tuples.
+            n_docs......The total number of documents in the index.
+            doc_freqs...A dict mapping a term id to the number of unique documents that contain it.
+        Returns:
+            An (idfs, log_tfs) tuple: an array mapping term id to the term's
+            IDF, log10(n_docs / df), and an array mapping each term frequency
+            tf up to the largest one to 1 + log10(tf).
 
-    def compute_doc_norms(self, index, n_docs, doc_freqs):
+        >>> idfs, log_tfs = Index().create_tables({0: [[1, 3]], 1: [[1, 1], [2, 10]]}, 2, {0: 1, 1: 2})
+        >>> idfs[1]
+        0.0
+        >>> idfs[0]  # doctest:+ELLIPSIS
+        0.30102...
+        >>> log_tfs[10]
+        2.0
+        """
+        idfs = array('d')
+        max_tf = 0
+        for term_id, postings in enumerate(index.values()):
+            idfs.append(math.log10(n_docs / doc_freqs[term_id]))
+            max_tf = max(max_tf, max(tf for _, tf in postings))
+        max_tf = int(max_tf)
+        log_tfs = array('d', [0.0] + [1 + math.log10(tf) for tf in range(1, max_tf + 1)])
+        return idfs, log_tfs
+
+    def idf(self, term_id):
+        """ Return the IDF of a term id from the precomputed table, or 0.0
+        if the term is not indexed. """
+        return self.idfs[term_id] if term_id in self.index else 0.0
+
+    def compute_doc_norms(self, index, n_docs, doc_freqs, idfs=None, log_tfs=None):
         """
         Return a dict mapping doc_id to its norm, computed as sqrt(sum(w_i**2)),
         where w_i is the tf-idf weight for each term in the document.
@@ -43,17 +100,28 @@ class Index(object):
             index.......A dict mapping term to list of (doc_id, term_frequency) tuples.
             n_docs......The total number of documents in the index.
             doc_freqs...A dict mapping a term to the number of unique documents that contain it.
+            idfs........Optional: the IDF table of create_tables, for an
+                        index keyed by term id.
+            log_tfs.....Optional: the log TF table of create_tables.
         Returns:
             A dict mapping a document id to its tfidf vector norm.
         >>> norms = Index().compute_doc_norms({'a': [[0, 3]], 'b': [[0, 4], [1, 5]]}, 2, {'a': 1, 'b': 2})
         >>> norms[0] # doctest:+ELLIPSIS
         0.444...
+        >>> index = {0: [[0, 3]], 1: [[0, 4], [1, 5]]}
+        >>> idfs, log_tfs = Index().create_tables(index, 2, {0: 1, 1: 2})
+        >>> Index().compute_doc_norms(index, 2, {0: 1, 1: 2}, idfs, log_tfs)[0] # doctest:+ELLIPSIS
+        0.444...
         """
         norm = defaultdict(lambda: 0.0)
+        if idfs is None:
+            idfs = dict((token, math.log10(n_docs/doc_freqs[token])) for token in index.keys())
+        if log_tfs is None:
+            log_tfs = dict((int(tf), 1 + math.log10(tf)) for postings in index.values() for _, tf in postings)
         for token in index.keys():
-            term_idf = doc_freqs[token]
+            term_idf = idfs[token]
             for values in index[token]:
-                norm[values[0]] += (((1 + math.log10(values[1])) * 1.0 * math.log10(n_docs/term_idf))**2)
+                norm[values[0]] += ((log_tfs[int(values[1])] * term_idf)**2)
         
         for key in norm.keys():
             norm[key] = math.sqrt(norm[key])
@@ -123,6 +191,56 @@ class Index(object):
         
         return res
 
+    def create_tf_index_parallel(self, docs, workers, lexicon=None):
+        """
+        Tokenize docs and build the same doc_freqs and tf index as
+        count_doc_frequencies and create_tf_index, using a pool of worker
+        processes, one contiguous shard of documents each (see
+        tokenize_shard). Merging the shards in order keeps the postings
+        sorted by doc id and the terms in order of first appearance, so the
+        result does not depend on the number of workers.
+
+        Params:
+          docs......A list of document strings.
+          workers...The number of processes.
+          lexicon...A lexicon.Lexicon. If given, the documents are returned as
+                    arrays of term ids and doc_freqs and index are keyed by
+                    term id, as in Index.__init__.
+        Returns:
+          A (tokenized documents, doc_freqs, index) tuple.
+
+        >>> docs = ['a b a', 'a c', 'c d', 'b b']
+        >>> toked, doc_freqs, index = Index().create_tf_index_parallel(docs, 2)
+        >>> toked[1]
+        ['a', 'c']
+        >>> index == Index().create_tf_index(toked, doc_freqs)
+        True
+        >>> doc_freqs['b']
+        2.0
+        >>> lexicon = Lexicon()
+        >>> toked, doc_freqs, index = Index().create_tf_index_parallel(docs, 2, lexicon)
+        >>> toked[1], index[lexicon['c']]
+        (array('I', [0, 2]), [[2, 1.0], [3, 1.0]])
+        """
+        size = max(1, -(-len(docs) // workers))
+        shards = [(i, docs[i:i+size]) for i in range(0, len(docs), size)]
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(tokenize_shard, shards)
+
+        documents = []
+        doc_freqs = defaultdict(lambda: 0)
+        index = defaultdict(lambda: [])
+        for toked, terms, offsets, doc_ids, tfs in results:
+            if lexicon is not None:
+                toked = [lexicon.encode(tokens) for tokens in toked]
+                terms = [lexicon[term] for term in terms]
+            documents.extend(toked)
+            for i, term in enumerate(terms):
+                doc_freqs[term] += (offsets[i+1] - offsets[i]) * 1.0
+                for j in range(offsets[i], offsets[i+1]):
+                    index[term].append([doc_ids[j], tfs[j] * 1.0])
+        return documents, doc_freqs, index
+
     def count_doc_frequencies(self, docs):
         """
         Params:
@@ -165,24 +283,24 @@ class Index(object):
           query_terms....list of terms
 
         Returns:
-          A dict from query term to IDF.
+          A dict from the term id of each query term to its IDF.
 
         >>> idx = Index(['a b c', 'b c', 'd'])
         >>> idx.query_to_vector(['a']) # doctest:+ELLIPSIS
-        {'a': 0.477...}
-        >>> idx.query_to_vector(['a', 'a']) # doctest:+ELLIPSIS
-        {'a': 0.477...}
+        {0: 0.477...}
+        >>> idx.query_to_vector(['a', 'a', 'z']) # doctest:+ELLIPSIS
+        {0: 0.477...}
         >>> res = idx.query_to_vector(['a', 'b', 'c', 'd']) # doctest:+ELLIPSIS
-        >>> res['a'] # doctest:+ELLIPSIS
+        >>> res[idx.lexicon['a']] # doctest:+ELLIPSIS
         0.477...
-        >>> res['b'] # doctest:+ELLIPSIS
+        >>> res[idx.lexicon['b']] # doctest:+ELLIPSIS
         0.176...
         """
         res = {}
-        N = len(self.documents)
         for qry_term in query_terms:
-            if qry_term in self.index:
-                res[qry_term] = float(math.log10( N * 1.0 / self.doc_freqs[qry_term]))
+            term_id = self.lexicon.get(qry_term)
+            if term_id is not None and term_id in self.index:
+                res[term_id] = self.idfs[term_id]
         
         return res
 
@@ -196,3 +314,38 @@ class Index(object):
         ['hi', 'there', "what's", 'going', 'on', 'first-class']
         """
         return [t.lower() for t in re.findall(r"\w+(?:[-']\w+)*", document)]
+
+
+def tokenize_shard(shard):
+    """
+    Tokenize a shard of documents for Index.create_tf_index_parallel.
+
+    Params:
+      shard...A (index of the first document, list of document strings) tuple.
+    Returns:
+      A (tokenized documents, terms, offsets, doc_ids, tfs) tuple, where terms
+      are in order of first appearance and term i's postings are
+      doc_ids[offsets[i]:offsets[i+1]] (starting at 1, as in create_tf_index).
+
+    >>> toked, terms, offsets, doc_ids, tfs = tokenize_shard((2, ['b a b', 'a']))
+    >>> terms
+    ['b', 'a']
+    >>> list(doc_ids), list(tfs)
+    ([3, 3, 4], [2, 1, 1])
+    """
+    first, docs = shard
+    tokenize = Index().tokenize
+    toked = [tokenize(d) for d in docs]
+    postings = {}
+    for doc_id, tokens in enumerate(toked, first + 1):
+        for term, tf in Counter(tokens).items():
+            if term not in postings:
+                postings[term] = (array('i'), array('i'))
+            postings[term][0].append(doc_id)
+            postings[term][1].append(tf)
+    offsets, doc_ids, tfs = array('i', [0]), array('i'), array('i')
+    for term_doc_ids, term_tfs in postings.values():
+        doc_ids.extend(term_doc_ids)
+        tfs.extend(term_tfs)
+        offsets.append(len(doc_ids))
+    return toked, list(postings), offsets, doc_ids, tfs
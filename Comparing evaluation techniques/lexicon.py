@@ -0,0 +1,32 @@
+"""
+The term-id lexicon of "TFIDF Champion Index/lexicon.py", shared by this
+directory's index.
+
+The directories of this repository are run as separate scripts rather than
+installed as packages, so this module loads that file with importlib and
+re-exports its classes instead of keeping a copy of it. The file is loaded
+under this module's name, so Lexicon and TermTable pickle (and unpickle, in
+a worker that imports this module) as lexicon.Lexicon and
+lexicon.TermTable.
+
+>>> Lexicon.__module__, TermTable.__module__
+('lexicon', 'lexicon')
+>>> import pickle
+>>> pickle.loads(pickle.dumps(Lexicon(['a', 'b']))).encode(['b', 'a'])
+array('I', [1, 0])
+"""
+import importlib.util
+import os
+from array import array  # Used by the doctests of the re-exported classes.
+
+SOURCE = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                       'TFIDF Champion Index', 'lexicon.py'))
+
+_spec = importlib.util.spec_from_file_location(__name__, SOURCE)
+_module = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(_module)
+
+Lexicon = _module.Lexicon
+TermTable = _module.TermTable
+
+__all__ = ['Lexicon', 'TermTable']
@@ -1,4 +1,6 @@
 from collections import defaultdict
+import multiprocessing
+import os
 import tarfile
 import tabulate
 import index, evaluate, score
@@ -104,11 +106,7 @@ def parse_document_strings(strings):
     ... THE ROAD TO JAIL IS PAVED WITH
     ...
     ... *STOP'''
-<<<<<<< HEAD
     >>> parse_document_strings(string.split('\\n'))
-=======
-    >>> parse_document_strings(string.split('\n'))
->>>>>>> template/master
     ['THE ALLIES AFTER NASSAU', 'THE ROAD TO JAIL IS PAVED WITH']
     """
     document_string = []
@@ -181,6 +179,16 @@ def search(query, scorer, index):
     qry_terms = index.tokenize(query)
     qry_vector = index.query_to_vector(qry_terms)
     document_rank = scorer.score(qry_vector,index)
+    return rank(document_rank)
+
+def rank(document_rank):
+    """
+    Return the document ids of a dict from document id to score, in
+    descending order of the score rounded to 6 decimal places (see search).
+
+    >>> rank({3: 0.5, 1: 0.7, 2: 0.5000000001})
+    [1, 3, 2]
+    """
     doc_list = defaultdict(lambda: 0)
     for key in document_rank.keys():
         doc_list[key] = round(document_rank[key],6)
@@ -190,6 +198,37 @@ def search(query, scorer, index):
     
     return result
 
+def search_batch(queries, scorer, index, batch_size=None):
+    """
+    Retrieve documents for a list of queries, scoring up to batch_size of them
+    at once with the scorer's score_batch. By default batch_size keeps each
+    score matrix to about 4M entries.
+
+    Params:
+      queries......A list of query strings.
+      scorer.......A ScoringFunction to retrieve documents.
+      index........A Index storing postings lists.
+      batch_size...The number of queries scored together.
+    Returns:
+      A list with, for each query, the same list of document ids as search.
+
+    >>> idx = index.Index(['a b c', 'c d e', 'c e f', 'a a f'])
+    >>> queries = ['a', 'e c', 'f b z']
+    >>> for scorer in [score.Cosine(), score.RSV(), score.BM25()]:
+    ...     print(search_batch(queries, scorer, idx) == [search(q, scorer, idx) for q in queries])
+    True
+    True
+    True
+    """
+    if batch_size is None:
+        batch_size = max(1, (1 << 22) // (len(index.documents) + 1))
+    qry_vectors = [index.query_to_vector(index.tokenize(query)) for query in queries]
+    results = []
+    for start in range(0, len(qry_vectors), batch_size):
+        for document_rank in scorer.score_batch(qry_vectors[start:start+batch_size], index):
+            results.append(rank(document_rank))
+    return results
+
 def run_all(queries, relevances, docs, indexer, scorers, evaluators, NHITS):
     """ Do not modify.
     For each query, run all scoring methods and evaluate the results.
@@ -212,6 +251,141 @@ def run_all(queries, relevances, docs, indexer, scorers, evaluators, NHITS):
             results[str(scorer)][str(evaluator)] /= len(queries)
     return results
 
+# The arguments of the run_all_parallel call in progress, set before its
+# workers are forked so that they share them (and the index) copy-on-write.
+_experiment = None
+
+def run_pair(task):
+    """
+    Run one (scorer position, query id) pair of the run_all_parallel
+    experiment in progress.
+
+    Returns:
+      A (hits, evaluations) tuple, with one evaluation per evaluator.
+    """
+    position, qid = task
+    queries, relevances, indexer, scorers, evaluators, NHITS = _experiment
+    hits = search(queries[qid], scorers[position], indexer)[:NHITS]
+    relevant = sorted(list(relevances[qid]))
+    return hits, [evaluator.evaluate(hits, relevant) for evaluator in evaluators]
+
+def run_all_parallel(queries, relevances, docs, indexer, scorers, evaluators, NHITS,
+                     workers=None, log=None):
+    """
+    Compute the same results as run_all, spreading the (scorer, query) pairs
+    over a pool of worker processes.
+
+    The workers are forked after the index is built, so they share it with
+    this process instead of copying it. Their results are collected in the
+    order run_all computes them, so the sums, and the tables written by
+    write_results, are exactly the same for any number of workers.
+
+    Params:
+      workers...The number of processes (default: one per CPU); with 1, no
+                process is started.
+      log.......An optional file to write run_all's per-query output to,
+                instead of printing it.
+    Returns:
+      A dict from scoring method to results
+
+    >>> import contextlib, io
+    >>> queries = {1: 'a b', 2: 'c', 3: 'd a'}
+    >>> relevances = {1: [1, 4], 2: [3], 3: [3, 4]}
+    >>> indexer = index.Index(['a b c', 'b c', 'c d', 'a'])
+    >>> args = (queries, relevances, None, indexer, [score.RSV(), score.BM25()],
+    ...         [evaluate.Precision(), evaluate.MAP()], 2)
+    >>> with contextlib.redirect_stdout(io.StringIO()):
+    ...     expected = run_all(*args)
+    >>> run_all_parallel(*args, workers=2) == expected
+    True
+    """
+    global _experiment
+    workers = workers or os.cpu_count() or 1
+    for scorer in scorers:
+        if getattr(scorer, 'matrix', False):
+            score.term_document_matrix(indexer)  # build it once, before forking
+    tasks = [(position, qid) for qid in queries for position in range(len(scorers))]
+    results = defaultdict(lambda: defaultdict(lambda: 0))
+    _experiment = (queries, relevances, indexer, scorers, evaluators, NHITS)
+    pool = multiprocessing.get_context('fork').Pool(workers) if workers > 1 else None
+    try:
+        if pool is None:
+            outcomes = map(run_pair, tasks)
+        else:
+            outcomes = pool.imap(run_pair, tasks, max(1, len(tasks) // (4 * workers)))
+        for qid, qtext in queries.items():
+            if log:
+                log.write('\n-------\nQUERY:%d %s\n' % (qid, qtext))
+                log.write('RELEVANT: %s\n' % sorted(list(relevances[qid])))
+            for scorer in scorers:
+                hits, evaluations = next(outcomes)
+                if log:
+                    log.write('\t%s results: %s\n' % (scorer, hits))
+                for evaluator, evaluation in zip(evaluators, evaluations):
+                    results[str(scorer)][str(evaluator)] += evaluation
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        _experiment = None
+    for scorer in scorers:
+        for evaluator in evaluators:
+            results[str(scorer)][str(evaluator)] /= len(queries)
+    return results
+
+def tune_bm25(queries, relevances, indexer, grid, evaluators, NHITS):
+    """
+    Evaluate BM25 for every (k, b) setting of a score.BM25Grid, and find the
+    best setting for each evaluator. The evaluations are the same as run_all
+    would compute for the corresponding score.BM25 scorers, but each query
+    is only scored once for the whole grid.
+
+    Params:
+      queries......A dict from query id to query text.
+      relevances...A dict from query id to the list of relevant document ids.
+      indexer......An Index.
+      grid.........A score.BM25Grid.
+      evaluators...A list of EvaluatorFunctions.
+      NHITS........The number of hits to evaluate.
+    Returns:
+      A (results, best) tuple, where results is a dict from the label of a
+      setting in grid.labels (e.g. 'BM25 k=1.2 b=0.75') to a dict from
+      evaluator to its mean over the queries, as run_all returns (so it can
+      be passed to write_results), and
+      best is a dict from evaluator to the ((k, b), mean) of its best
+      setting, the first one in grid.params on a tie.
+
+    >>> indexer = index.Index(['a b c', 'b c', 'c d', 'a a d'])
+    >>> queries, relevances = {1: 'a b', 2: 'd c'}, {1: [1, 4], 2: [3]}
+    >>> grid = score.BM25Grid(ks=[1, 2], bs=[.5, 1])
+    >>> results, best = tune_bm25(queries, relevances, indexer, grid, [evaluate.MAP()], 1)
+    >>> sorted(results)
+    ['BM25 k=1 b=0.5', 'BM25 k=1 b=1', 'BM25 k=2 b=0.5', 'BM25 k=2 b=1']
+    >>> import contextlib, io
+    >>> with contextlib.redirect_stdout(io.StringIO()):
+    ...     expected = run_all(queries, relevances, None, indexer, [score.BM25(k=2, b=1)], [evaluate.MAP()], 1)
+    >>> results['BM25 k=2 b=1'] == expected['BM25 k=2 b=1.00']
+    True
+    >>> best
+    {'MAP': ((1, 0.5), 0.75)}
+    """
+    labels = grid.labels
+    results = defaultdict(lambda: defaultdict(lambda: 0))
+    for qid, qtext in queries.items():
+        relevant = sorted(list(relevances[qid]))
+        qry_vector = indexer.query_to_vector(indexer.tokenize(qtext))
+        for label, hits in zip(labels, grid.search(qry_vector, indexer, NHITS)):
+            for evaluator in evaluators:
+                results[label][str(evaluator)] += evaluator.evaluate(hits, relevant)
+    best = {}
+    for evaluator in evaluators:
+        for label, params in zip(labels, grid.params):
+            results[label][str(evaluator)] /= len(queries)
+            value = results[label][str(evaluator)]
+            if str(evaluator) not in best or value > best[str(evaluator)][1]:
+                best[str(evaluator)] = (params, value)
+    return results, best
+
 
 def main():
     """ Do not modify.
@@ -233,8 +407,14 @@ def main():
                   evaluate.F1(),
                   evaluate.MAP()]
 
-    all_results = run_all(queries, relevances, docs, indexer, scorers, evaluators, NHITS)
+    all_results = run_all_parallel(queries, relevances, docs, indexer, scorers, evaluators, NHITS)
     write_results(all_results, 'Results.md')
 
+    grid = score.BM25Grid(ks=[.5, 1, 1.2, 1.5, 2, 3], bs=[0, .25, .5, .75, 1])
+    _, best = tune_bm25(queries, relevances, indexer, grid, evaluators, NHITS)
+    for evaluator in evaluators:
+        (k, b), value = best[str(evaluator)]
+        print('best BM25 for %s: k=%g b=%g (%.4f)' % (evaluator, k, b, value))
+
 if __name__ == '__main__':
     main()
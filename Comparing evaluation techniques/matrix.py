@@ -0,0 +1,111 @@
+""" A sparse-matrix scoring engine for the scoring functions in score.py.
+
+TermDocumentMatrix turns an index.Index into a CSR matrix with one row per
+term and one column per document id, holding the term frequencies. The
+per-posting values each scoring function needs are computed once, for
+every posting at the same time:
+
+  log-tf.............1 + log10(tf), for Cosine
+  BM25 weights.......(k+1) * tf / (k*((1-b) + b*dl/avgdl) + tf), for each
+                     (k, b) pair, from the per-document denominators
+
+so that scoring a query is one sparse matrix-vector product over the rows
+of its terms. Needs scipy.
+
+The scores equal those of score.RSV, score.BM25 and score.Cosine to within
+floating point rounding (they agree to well over 6 decimals), and the
+documents come in the same order.
+"""
+import numpy as np
+from scipy import sparse
+
+
+class TermDocumentMatrix(object):
+    """
+    >>> import index
+    >>> idx = index.Index(['a a b c', 'c d e', 'c e f'])
+    >>> matrix = TermDocumentMatrix(idx)
+    >>> matrix.tfs.shape
+    (6, 4)
+    >>> matrix.cosine({idx.lexicon['a']: 1.})  # doctest:+ELLIPSIS
+    {1: 0.792857...}
+    >>> matrix.rsv({idx.lexicon['e']: 1., idx.lexicon['a']: 1.})  # doctest:+ELLIPSIS
+    {2: 0.176..., 3: 0.176..., 1: 0.477...}
+    >>> matrix.bm25({idx.lexicon['a']: 1.}, k=1, b=.5)  # doctest:+ELLIPSIS
+    {1: 0.61564032...}
+    """
+
+    def __init__(self, index):
+        """ Build the matrix of an index.Index. """
+        terms = list(index.index)
+        self.term_ids = dict((term, i) for i, term in enumerate(terms))
+        n_docs = len(index.documents) + 1  # doc ids start at 1
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(index.index[term]) for term in terms])
+        postings = np.array([posting for term in terms for posting in index.index[term]],
+                            dtype=np.float64).reshape(-1, 2)
+        self.tfs = sparse.csr_matrix((postings[:, 1], postings[:, 0].astype(np.int64), indptr),
+                                     shape=(len(terms), n_docs))
+        self.log_tfs = self.with_data(np.asarray(index.log_tfs)[self.tfs.data.astype(np.int64)])
+        self.ones = self.with_data(np.ones(self.tfs.nnz))
+        self.idfs = np.asarray(index.idfs)[terms]
+        self.doc_lengths = np.zeros(n_docs)
+        self.doc_lengths[list(index.doc_lengths.keys())] = list(index.doc_lengths.values())
+        self.mean_doc_length = index.mean_doc_length
+        self.doc_norms = np.ones(n_docs)
+        self.doc_norms[list(index.doc_norms.keys())] = list(index.doc_norms.values())
+        self.bm25_weights = {}
+
+    def with_data(self, data):
+        """ Return a matrix with the sparsity structure of tfs and the given
+        values. """
+        return sparse.csr_matrix((data, self.tfs.indices, self.tfs.indptr), shape=self.tfs.shape)
+
+    def bm25_matrix(self, k, b):
+        """ Return (and cache) the matrix of BM25 weights without idf for
+        parameters k and b. """
+        if (k, b) not in self.bm25_weights:
+            denominators = k * ((1 - b) + b * self.doc_lengths / self.mean_doc_length)
+            tfs = self.tfs.data
+            self.bm25_weights[(k, b)] = self.with_data(
+                (k + 1) * tfs / (denominators[self.tfs.indices] + tfs))
+        return self.bm25_weights[(k, b)]
+
+    def term_rows(self, query_vector):
+        """ Return the row numbers and query weights of the indexed terms of
+        query_vector, in query order. """
+        terms = [term for term in query_vector if term in self.term_ids]
+        rows = np.array([self.term_ids[term] for term in terms], dtype=np.int64)
+        return rows, np.array([query_vector[term] for term in terms], dtype=np.float64)
+
+    def product(self, matrix, rows, weights):
+        """ Return the doc ids of the documents in at least one of the given
+        rows of matrix, and their weighted sums of those rows, as two arrays.
+        The documents are ordered as the score.py loops first score them: by
+        the first query term they contain, then by doc id. """
+        selected = matrix[rows]
+        scores = selected.T.dot(weights)
+        first = np.full(matrix.shape[1], len(rows), dtype=np.int64)
+        for position in range(len(rows) - 1, -1, -1):
+            first[selected.indices[selected.indptr[position]:selected.indptr[position+1]]] = position
+        matched = np.flatnonzero(first < len(rows))
+        matched = matched[np.argsort(first[matched], kind='stable')]
+        return matched, scores[matched]
+
+    def rsv(self, query_vector):
+        """ Return the scores of score.RSV. """
+        rows, _ = self.term_rows(query_vector)
+        doc_ids, scores = self.product(self.ones, rows, self.idfs[rows])
+        return dict(zip(doc_ids.tolist(), scores.tolist()))
+
+    def bm25(self, query_vector, k, b):
+        """ Return the scores of score.BM25(k, b). """
+        rows, _ = self.term_rows(query_vector)
+        doc_ids, scores = self.product(self.bm25_matrix(k, b), rows, self.idfs[rows])
+        return dict(zip(doc_ids.tolist(), scores.tolist()))
+
+    def cosine(self, query_vector):
+        """ Return the scores of score.Cosine. """
+        rows, weights = self.term_rows(query_vector)
+        doc_ids, scores = self.product(self.log_tfs, rows, weights * self.idfs[rows])
+        return dict(zip(doc_ids.tolist(), (scores / self.doc_norms[doc_ids]).tolist()))
@@ -2,7 +2,8 @@
 """
 import abc
 from collections import defaultdict
-import math
+
+import numpy as np
 
 import index
 
@@ -13,23 +14,91 @@ def idf(term, index):
     t.
 
     Params:
-      terms....A string representing a term.
+      terms....A term id (see index.Index.lexicon).
       index....A Index object.
     Returns:
       The idf value.
 
     >>> idx = index.Index(['a b c a', 'c d e', 'c e f'])
-    >>> idf('a', idx) # doctest:+ELLIPSIS
+    >>> idf(idx.lexicon['a'], idx) # doctest:+ELLIPSIS
     0.477...
-    >>> idf('d', idx) # doctest:+ELLIPSIS
+    >>> idf(idx.lexicon['d'], idx) # doctest:+ELLIPSIS
     0.477...
-    >>> idf('e', idx) # doctest:+ELLIPSIS
+    >>> idf(idx.lexicon['e'], idx) # doctest:+ELLIPSIS
     0.176...
     """
-    if term in index.index:
-        return math.log10( len(index.documents) / index.doc_freqs[term] )
-    
-    return 0.0
+    return index.idf(term)
+
+
+def score_batch(query_vectors, index, term_scores, normalize=None):
+    """
+    Score a list of query vectors together, for ScoringFunction.score_batch.
+
+    The scores are accumulated in a dense (queries x documents) NumPy
+    matrix. Query terms are added in rounds by their position in the query,
+    all the queries sharing a term at once, so that every document's score
+    is summed in the same order as a one-query loop over query_vector and its
+    postings, and is identical to it.
+
+    Params:
+      query_vectors...A list of dicts mapping query term to weight.
+      index...........An Index object.
+      term_scores.....A function (term, doc_ids, tfs, query weights) returning
+                      the score each posting adds for each query, as an array
+                      broadcastable to (queries, postings).
+      normalize.......An optional function (doc_ids, scores) returning the
+                      final scores of the matched documents of one query.
+    Returns:
+      A list with one dict per query, mapping doc id to score, with the
+      documents in the order the one-query loop would first score them.
+
+    >>> idx = index.Index(['a b', 'b c', 'c'])
+    >>> add_tf = lambda term, doc_ids, tfs, weights: weights[:, None] * tfs
+    >>> score_batch([{idx.lexicon['b']: 1.}, {idx.lexicon['c']: 2., idx.lexicon['a']: 1.}], idx, add_tf)
+    [{1: 1.0, 2: 1.0}, {2: 2.0, 3: 2.0, 1: 1.0}]
+    """
+    n_docs = len(index.documents) + 1  # doc ids start at 1
+    postings = {}
+    unmatched = np.iinfo(np.int64).max
+    batch = [[(term, weight) for term, weight in vector.items() if term in index.index]
+             for vector in query_vectors]
+    scores = np.zeros((len(batch), n_docs))
+    # (query term position << 32) + position in its postings of the first term
+    # that matched each document.
+    first = np.full((len(batch), n_docs), unmatched, dtype=np.int64)
+    for position in range(max([len(terms) for terms in batch] or [0])):
+        groups = defaultdict(list)
+        for row, terms in enumerate(batch):
+            if position < len(terms):
+                groups[terms[position][0]].append((row, terms[position][1]))
+        for term, members in groups.items():
+            if term not in postings:
+                values = np.array(index.index[term], dtype=np.float64)
+                postings[term] = (values[:, 0].astype(np.int64), values[:, 1],
+                                  np.arange(len(values), dtype=np.int64))
+            doc_ids, tfs, ranks = postings[term]
+            rows = np.array([row for row, _ in members])[:, None]
+            weights = np.array([weight for _, weight in members], dtype=np.float64)
+            scores[rows, doc_ids] += term_scores(term, doc_ids, tfs, weights)
+            first[rows, doc_ids] = np.minimum(first[rows, doc_ids], (position << 32) + ranks)
+    results = []
+    for row in range(len(batch)):
+        matched = np.flatnonzero(first[row] != unmatched)
+        matched = matched[np.argsort(first[row, matched], kind='stable')]
+        row_scores = scores[row, matched]
+        if normalize is not None:
+            row_scores = normalize(matched, row_scores)
+        results.append(dict(zip(matched.tolist(), row_scores.tolist())))
+    return results
+
+
+def term_document_matrix(index):
+    """ Return the matrix.TermDocumentMatrix of an Index, building it the
+    first time it is needed. """
+    if getattr(index, 'matrix', None) is None:
+        import matrix
+        index.matrix = matrix.TermDocumentMatrix(index)
+    return index.matrix
 
 
 class ScoringFunction:
@@ -48,6 +117,18 @@ class ScoringFunction:
         """
         return
 
+    def score_batch(self, query_vectors, index):
+        """
+        Return [self.score(query_vector, index) for query_vector in
+        query_vectors]. Subclasses override this with a vectorized version
+        (see the score_batch function) that gives the same scores.
+
+        Params:
+          query_vectors...list of dicts mapping query term to weight.
+          index...........Index object.
+        """
+        return [self.score(query_vector, index) for query_vector in query_vectors]
+
 
 class RSV(ScoringFunction):
     """
@@ -58,19 +139,41 @@ class RSV(ScoringFunction):
     idf(e) = log10(3/2)
     >>> idx = index.Index(['a b c', 'c d e', 'c e f'])
     >>> rsv = RSV()
-    >>> rsv.score({'a': 1.}, idx)[1]  # doctest:+ELLIPSIS
+    >>> rsv.score({idx.lexicon['a']: 1.}, idx)[1]  # doctest:+ELLIPSIS
+    0.4771...
+
+    With matrix=True, scores are computed by matrix.TermDocumentMatrix.
+
+    >>> RSV(matrix=True).score({idx.lexicon['a']: 1.}, idx)[1]  # doctest:+ELLIPSIS
     0.4771...
     """
+    def __init__(self, matrix=False):
+        self.matrix = matrix
 
     def score(self, query_vector, index):
+        if self.matrix:
+            return term_document_matrix(index).rsv(query_vector)
         res = defaultdict(lambda: 0)
-        N = len(index.documents)
         for term in query_vector:
             if term in index.index:
+                term_idf = idf(term, index)
                 for doclist in index.index[term]:
-                        res[doclist[0]] += idf(term, index)
+                        res[doclist[0]] += term_idf
         return res
 
+    def score_batch(self, query_vectors, index):
+        """
+        >>> idx = index.Index(['a b c', 'c d e', 'c e f'])
+        >>> vectors = [{idx.lexicon['a']: 1.}, {idx.lexicon['e']: 1., idx.lexicon['c']: 1.}]
+        >>> RSV().score_batch(vectors, idx) == [RSV().score(v, idx) for v in vectors]
+        True
+        """
+        def term_scores(term, doc_ids, tfs, weights):
+            return np.full(len(doc_ids), idf(term, index))
+        if self.matrix:
+            return ScoringFunction.score_batch(self, query_vectors, index)
+        return score_batch(query_vectors, index, term_scores)
+
     def __repr__(self):
         return 'RSV'
 
@@ -82,15 +185,19 @@ class BM25(ScoringFunction):
     log10(3) * (2*2) / (1(.5 + .5(4/3.333)) + 2) = log10(3) * 4 / 3.1 = .6156...
     >>> idx = index.Index(['a a b c', 'c d e', 'c e f'])
     >>> bm = BM25(k=1, b=.5)
-    >>> bm.score({'a': 1.}, idx)[1]  # doctest:+ELLIPSIS
+    >>> bm.score({idx.lexicon['a']: 1.}, idx)[1]  # doctest:+ELLIPSIS
+    0.61564032...
+    >>> BM25(k=1, b=.5, matrix=True).score({idx.lexicon['a']: 1.}, idx)[1]  # doctest:+ELLIPSIS
     0.61564032...
     """
-    def __init__(self, k=1, b=.5):
+    def __init__(self, k=1, b=.5, matrix=False):
         self.k = k
         self.b = b
+        self.matrix = matrix
 
     def score(self, query_vector, index):
-        
+        if self.matrix:
+            return term_document_matrix(index).bm25(query_vector, self.k, self.b)
         res = defaultdict(lambda: 0)
         N = len(index.documents)
         K = self.k
@@ -102,10 +209,130 @@ class BM25(ScoringFunction):
                     res[doc_id] += term_idf*(K+1)*term_freq/(K*((1-B)+(1.*B*index.doc_lengths[doc_id]/index.mean_doc_length))+term_freq)
         return res
 
+    def score_batch(self, query_vectors, index):
+        """
+        >>> idx = index.Index(['a a b c', 'c d e', 'c e f'])
+        >>> vectors = [{idx.lexicon['a']: 1.}, {idx.lexicon['e']: 1., idx.lexicon['c']: 1.}]
+        >>> bm = BM25(k=2, b=.75)
+        >>> bm.score_batch(vectors, idx) == [bm.score(v, idx) for v in vectors]
+        True
+        """
+        K = self.k
+        B = self.b
+        doc_lengths = np.zeros(len(index.documents) + 1)
+        doc_lengths[list(index.doc_lengths.keys())] = list(index.doc_lengths.values())
+        def term_scores(term, doc_ids, tfs, weights):
+            # The same operations, in the same order, as score.
+            return idf(term, index)*(K+1)*tfs/(K*((1-B)+(1.*B*doc_lengths[doc_ids]/index.mean_doc_length))+tfs)
+        if self.matrix:
+            return ScoringFunction.score_batch(self, query_vectors, index)
+        return score_batch(query_vectors, index, term_scores)
+
     def __repr__(self):
         return 'BM25 k=%d b=%.2f' % (self.k, self.b)
 
 
+class BM25Grid(object):
+    """
+    BM25 for a whole grid of (k, b) settings at once, for tuning.
+
+    Each query term's postings, and the length of each document in them, are
+    gathered once; the scores under every setting are then computed together
+    as a (settings x postings) NumPy array per term. The arithmetic is the
+    same, in the same order, as in BM25.score, so every score equals the
+    one BM25(k, b) would give.
+
+    >>> idx = index.Index(['a a b c', 'c d e', 'c e f'])
+    >>> grid = BM25Grid(ks=[1, 2], bs=[.5, 1])
+    >>> grid.params
+    [(1, 0.5), (1, 1), (2, 0.5), (2, 1)]
+    >>> grid.labels
+    ['BM25 k=1 b=0.5', 'BM25 k=1 b=1', 'BM25 k=2 b=0.5', 'BM25 k=2 b=1']
+    >>> doc_ids, scores = grid.score({idx.lexicon['e']: 1., idx.lexicon['a']: 1.}, idx)
+    >>> doc_ids
+    [2, 3, 1]
+    >>> all(dict(zip(doc_ids, row)) == BM25(k, b).score({idx.lexicon['e']: 1., idx.lexicon['a']: 1.}, idx)
+    ...     for (k, b), row in zip(grid.params, scores.tolist()))
+    True
+    """
+    def __init__(self, ks=(.5, 1, 1.5, 2), bs=(.25, .5, .75, 1)):
+        self.params = [(k, b) for k in ks for b in bs]
+        # Unlike str(BM25(k, b)), which rounds k down, these tell every
+        # setting apart.
+        self.labels = ['BM25 k=%g b=%g' % (k, b) for k, b in self.params]
+        self.K = np.array([k for k, _ in self.params], dtype=np.float64)[:, None]
+        self.B = np.array([b for _, b in self.params], dtype=np.float64)[:, None]
+        self.index = None
+        self.postings = {}
+
+    def term_postings(self, term, index):
+        """ Return the doc ids, term frequencies and document lengths of the
+        postings of term, as arrays. They are computed once per index. """
+        if index is not self.index:
+            self.index, self.postings = index, {}
+        if term not in self.postings:
+            doc_ids = np.array([doc_id for doc_id, _ in index.index[term]], dtype=np.int64)
+            tfs = np.array([tf for _, tf in index.index[term]], dtype=np.float64)
+            doc_lengths = np.array([index.doc_lengths[doc_id] for doc_id in doc_ids.tolist()],
+                                   dtype=np.float64)
+            self.postings[term] = (doc_ids, tfs, doc_lengths)
+        return self.postings[term]
+
+    def score(self, query_vector, index):
+        """
+        Params:
+          query_vector...dict mapping query term to weight.
+          index..........Index object.
+        Returns:
+          A (doc_ids, scores) tuple: the ids of the matching documents, in
+          the order BM25.score first scores them, and an array with one row
+          of their scores per setting in self.params.
+        """
+        K = self.K
+        B = self.B
+        scores = np.zeros((len(self.params), len(index.documents) + 1))
+        matched = []
+        seen = np.zeros(len(index.documents) + 1, dtype=bool)
+        for term in query_vector:
+            if term in index.index:
+                term_idf = idf(term, index)
+                doc_ids, term_freq, doc_lengths = self.term_postings(term, index)
+                scores[:, doc_ids] += term_idf*(K+1)*term_freq/(K*((1-B)+(1.*B*doc_lengths/index.mean_doc_length))+term_freq)
+                matched.append(doc_ids[~seen[doc_ids]])
+                seen[doc_ids] = True
+        doc_ids = np.concatenate(matched) if matched else np.zeros(0, dtype=np.int64)
+        return doc_ids.tolist(), scores[:, doc_ids]
+
+    def search(self, query_vector, index, NHITS):
+        """
+        Return, for each setting in self.params, the top NHITS document ids
+        that main.search would return with BM25(k, b): in descending order
+        of the score rounded to 6 decimals, ties in the order the documents
+        were first scored.
+
+        Scores are first rounded with NumPy for every setting at once; only
+        the few documents that may make the top NHITS are then rounded with
+        round(), as main.search does, since the two can differ by one unit
+        in the last place.
+
+        >>> idx = index.Index(['a a b c', 'c d e', 'c e f', 'a e'])
+        >>> BM25Grid(ks=[1], bs=[0, 1]).search({idx.lexicon['e']: 1., idx.lexicon['a']: 1.}, idx, 2)
+        [[4, 1], [4, 1]]
+        """
+        doc_ids, scores = self.score(query_vector, index)
+        if not doc_ids:
+            return [[] for _ in self.params]
+        rounded = np.round(scores, 6)
+        n = min(NHITS, len(doc_ids))
+        thresholds = -np.partition(-rounded, n - 1, axis=1)[:, n - 1]
+        results = []
+        for row, threshold in zip(range(len(self.params)), thresholds.tolist()):
+            candidates = np.flatnonzero(rounded[row] >= threshold - 2.5e-6).tolist()
+            ranked = sorted(candidates, key=lambda i: round(float(scores[row, i]), 6), reverse=True)
+            results.append([doc_ids[i] for i in ranked[:NHITS]])
+        return results
+
+
 class Cosine(ScoringFunction):
     """
     See lecture notes for definition of Cosine similarity.  Be sure to use the
@@ -114,22 +341,48 @@ class Cosine(ScoringFunction):
 
     >>> idx = index.Index(['a a b c', 'c d e', 'c e f'])
     >>> cos = Cosine()
-    >>> cos.score({'a': 1.}, idx)[1]  # doctest:+ELLIPSIS
+    >>> cos.score({idx.lexicon['a']: 1.}, idx)[1]  # doctest:+ELLIPSIS
+    0.792857...
+    >>> Cosine(matrix=True).score({idx.lexicon['a']: 1.}, idx)[1]  # doctest:+ELLIPSIS
     0.792857...
     """
+    def __init__(self, matrix=False):
+        self.matrix = matrix
+
     def score(self, query_vector, index):
-        
+        if self.matrix:
+            return term_document_matrix(index).cosine(query_vector)
         scores = defaultdict(lambda: 0)
+        log_tfs = index.log_tfs
         for qry_term, qry_weight in query_vector.items():
             if qry_term in index.index:
+                term_idf = idf(qry_term, index)
                 for doc_id, doc_weight in index.index[qry_term]:
-                    scores[doc_id] += ( qry_weight * ((1 + math.log10(doc_weight)) * idf(qry_term, index) ))
+                    scores[doc_id] += ( qry_weight * (log_tfs[int(doc_weight)] * term_idf ))
         
         for doc_id in scores:
             scores[doc_id] /= float(index.doc_norms[doc_id])
         
         return scores
 
+    def score_batch(self, query_vectors, index):
+        """
+        >>> idx = index.Index(['a a b c', 'c d e', 'c e f'])
+        >>> vectors = [{idx.lexicon['a']: 1.}, {idx.lexicon['e']: .5, idx.lexicon['c']: 1., idx.lexicon['a']: 2.}]
+        >>> Cosine().score_batch(vectors, idx) == [Cosine().score(v, idx) for v in vectors]
+        True
+        """
+        norms = np.ones(len(index.documents) + 1)
+        norms[list(index.doc_norms.keys())] = list(index.doc_norms.values())
+        log_tfs = np.asarray(index.log_tfs)
+        def term_scores(term, doc_ids, tfs, weights):
+            return weights[:, None] * (log_tfs[tfs.astype(np.int64)] * idf(term, index))
+        def normalize(doc_ids, scores):
+            return scores / norms[doc_ids]
+        if self.matrix:
+            return ScoringFunction.score_batch(self, query_vectors, index)
+        return score_batch(query_vectors, index, term_scores, normalize)
+
     def __repr__(self):
         return 'Cosine'
     
@@ -0,0 +1,195 @@
+"""
+Benchmarks for the k-means clusterer.
+
+Run with `python benchmark.py NAME [profiles.txt.gz]`, where NAME is one of
+the bench_* functions below without its prefix (e.g. `python benchmark.py
+matrix`). The profiles are pruned as in cluster.main.
+"""
+import contextlib
+import gzip
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cluster
+from matrix import DocumentMatrix
+
+
+def read_profiles(filename, n=None, seed=0):
+    """ Return the pruned profiles of filename, or n profiles drawn from them
+    at random with replacement. """
+    profiles = cluster.prune_terms(cluster.read_profiles(filename), min_df=2)
+    if n is None:
+        return profiles
+    rand = random.Random(seed)
+    return [rand.choice(profiles) for _ in range(n)]
+
+
+def run(km, profiles, iters):
+    """ Run km.cluster(profiles, iters) and return its elapsed seconds and
+    printed lines (the cluster sizes and error of each iteration). """
+    out = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        km.cluster(profiles, iters)
+    return time.perf_counter() - start, out.getvalue().splitlines()
+
+
+def same_output(lines, expected):
+    """ Return whether the printed sizes of two runs are identical and
+    their errors equal to 2 decimals. """
+    return len(lines) == len(expected) and all(
+        a == b if a.startswith('[') else round(float(a), 2) == round(float(b), 2)
+        for a, b in zip(lines, expected))
+
+
+def bench_matrix(filename, k=10, iters=20):
+    """ Compare the Counter loops of cluster.KMeans with KMeans(matrix=True),
+    on the profiles and on 1M profiles drawn from them, and check that both
+    print the same cluster sizes and errors. On 1M profiles the Counter loops
+    are only run for 2 iterations. The matrix's time per iteration leaves out
+    building the matrix, which is reported separately. """
+    for n, counter_iters in ((None, iters), (1000000, 2)):
+        profiles = read_profiles(filename, n)
+        counter, expected = run(cluster.KMeans(k), profiles, counter_iters)
+        start = time.perf_counter()
+        DocumentMatrix(profiles)
+        build = time.perf_counter() - start
+        matrix, lines = run(cluster.KMeans(k, matrix=True), profiles, iters)
+        matrix = (matrix - build) / iters
+        print('%7d profiles  Counter %7.3fs/iteration  matrix %7.3fs/iteration (+%.1fs to build '
+              'it)  speedup %5.1fx  same sizes and errors: %s' %
+              (len(profiles), counter / counter_iters, matrix, build,
+               counter / counter_iters / matrix, same_output(lines[:len(expected)], expected)))
+
+
+def write_profiles(filename, n, seed=0):
+    """ Write n profiles drawn at random from filename to a new gzipped file
+    in the same format, and return its path. """
+    profiles = cluster.read_profiles(filename)
+    rand = random.Random(seed)
+    path = os.path.join(tempfile.mkdtemp(), 'profiles-%d.txt.gz' % n)
+    with gzip.open(path, 'wt', encoding='utf8') as f:
+        for _ in range(n):
+            f.write(' '.join(rand.choice(profiles).elements()) + '\n')
+    return path
+
+
+def bench_minibatch(filename, k=10, iters=20, batch_size=1000):
+    """ Compare the error curve of cluster.MiniBatchKMeans, streaming the
+    profiles from filename, with that of KMeans(matrix=True) on the same
+    pruned profiles, and report the peak memory of both. Then report the
+    time and peak memory of 2 passes of MiniBatchKMeans over 1M profiles
+    drawn from filename, which should not grow with the number of
+    profiles. """
+    def traced(fn):
+        out = io.StringIO()
+        tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(out):
+            fn()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return elapsed, peak, [float(line) for line in out.getvalue().splitlines()
+                               if not line.startswith('[')]
+
+    batch, batch_peak, batch_errors = traced(
+        lambda: cluster.KMeans(k, matrix=True).cluster(read_profiles(filename), iters))
+    mini, mini_peak, mini_errors = traced(
+        lambda: cluster.MiniBatchKMeans(k, batch_size).cluster_file(filename, iters))
+    print('iteration  KMeans error  MiniBatchKMeans error (batch size %d)' % batch_size)
+    for i, (batch_error, mini_error) in enumerate(zip(batch_errors, mini_errors), 1):
+        print('%9d  %12.2f  %12.2f' % (i, batch_error, mini_error))
+    print('final assignment          %12.2f' % mini_errors[-1])
+    print('KMeans           %6.1fs  peak %8.1f MiB (profiles read and pruned in memory)' %
+          (batch, batch_peak / 2.**20))
+    print('MiniBatchKMeans  %6.1fs  peak %8.1f MiB' % (mini, mini_peak / 2.**20))
+    path = write_profiles(filename, 1000000)
+    mini, mini_peak, _ = traced(lambda: cluster.MiniBatchKMeans(k, batch_size).cluster_file(path, 2))
+    print('MiniBatchKMeans, 1M profiles, 2 passes and the final assignment  %6.1fs  peak %8.1f MiB' %
+          (mini, mini_peak / 2.**20))
+    os.remove(path)
+
+
+def bench_triangle(filename, iters=20):
+    """ Compare KMeans(matrix=True) with KMeans(triangle=True) for several
+    k, on the profiles and on 100,000 profiles drawn from them, and check
+    that both print the same cluster sizes and errors and make the same
+    final assignments. Reports the mean fraction of distances skipped per
+    iteration, after the first (which computes them all), and the fraction
+    skipped in the last iteration. """
+    for n in (None, 100000):
+        profiles = read_profiles(filename, n)
+        for k in (10, 50, 200):
+            exhaustive = cluster.KMeans(k, matrix=True)
+            base, expected = run(exhaustive, profiles, iters)
+            triangle = cluster.KMeans(k, triangle=True)
+            elapsed, lines = run(triangle, profiles, iters)
+            same = lines == expected and (triangle.assignments == exhaustive.assignments).all()
+            print('%7d profiles  k=%-4d exhaustive %7.2fs  triangle %7.2fs  speedup %4.2fx  '
+                  'skipped %5.1f%% (last %5.1f%%)  same output: %s' %
+                  (len(profiles), k, base, elapsed, base / elapsed,
+                   100 * sum(triangle.skipped[1:]) / (len(triangle.skipped) - 1),
+                   100 * triangle.skipped[-1], same))
+
+
+def bench_converge(filename, iters=50):
+    """ Compare KMeans running a fixed number of iterations with KMeans
+    stopping early once no assignment changes (tol=0) or the error changes
+    by less than 1 (tol=1), and check whether the final clusters are the
+    same. """
+    profiles = read_profiles(filename)
+    for k in (10, 50):
+        fixed = cluster.KMeans(k)
+        base, _ = run(fixed, profiles, iters)
+        print('k=%-3d fixed       %3d iterations %7.2fs' % (k, iters, base))
+        for tol in (0, 1):
+            km = cluster.KMeans(k)
+            out = io.StringIO()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(out):
+                km.cluster(profiles, iters, tol=tol)
+            elapsed = time.perf_counter() - start
+            print('k=%-3d tol=%-8g %3d iterations %7.2fs  speedup %5.1fx  same clusters: %s' %
+                  (k, tol, km.iterations, elapsed, base / elapsed, km.assignments == fixed.assignments))
+
+
+def bench_parallel(filename, k=10, iters=10, n=1000000):
+    """ Compare KMeans(matrix=True) in one process with KMeans(n_jobs=...)
+    for several numbers of worker processes, on n profiles drawn from
+    filename, and check that all print the same cluster sizes and errors
+    and make the same final assignments. The times per iteration leave out
+    building the matrix, but include copying it to shared memory and
+    starting the workers. """
+    profiles = read_profiles(filename, n)
+    start = time.perf_counter()
+    DocumentMatrix(profiles)
+    build = time.perf_counter() - start
+    print('%d profiles, k=%d, %d CPUs, matrix built in %.1fs' %
+          (len(profiles), k, os.cpu_count(), build))
+    single = cluster.KMeans(k, matrix=True)
+    base, expected = run(single, profiles, iters)
+    base = (base - build) / iters
+    print('1 process     %7.3fs/iteration' % base)
+    for n_jobs in (2, 4, 8):
+        km = cluster.KMeans(k, n_jobs=n_jobs)
+        elapsed, lines = run(km, profiles, iters)
+        elapsed = (elapsed - build) / iters
+        same = lines == expected and (km.assignments == single.assignments).all()
+        print('n_jobs=%d      %7.3fs/iteration  speedup %4.2fx  same output: %s' %
+              (n_jobs, elapsed, base / elapsed, same))
+
+
+def main():
+    name = sys.argv[1] if len(sys.argv) > 1 else 'matrix'
+    filename = sys.argv[2] if len(sys.argv) > 2 else 'profiles.txt.gz'
+    globals()['bench_' + name](filename)
+
+
+if __name__ == '__main__':
+    main()
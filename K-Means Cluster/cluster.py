@@ -5,18 +5,40 @@ Assignment 5: K-Means. See the instructions to complete the methods below.
 from collections import Counter
 from collections import defaultdict
 import gzip
+import heapq
 import math
 import numpy as np
 
 class KMeans(object):
 
-    def __init__(self, k=2):
-        """ Initialize a k-means clusterer. Should not have to change this."""
+    def __init__(self, k=2, matrix=False, triangle=False, n_jobs=1):
+        """ Initialize a k-means clusterer. With matrix=True, distances and
+        means are computed for all documents at once by
+        matrix.DocumentMatrix instead of one Counter at a time. With
+        triangle=True (which implies matrix=True), compute_clusters skips
+        the distances that triangle inequality bounds prove cannot change
+        an assignment (see matrix.TriangleBounds), and the fraction of
+        distances skipped in each iteration is added to self.skipped. It
+        gives the same clusters as matrix=True, but only pays off in the
+        late iterations of long runs, once most documents keep their
+        cluster; on the profiles it is no faster over 20 iterations (see
+        `python benchmark.py triangle`). With
+        n_jobs > 1 (which also implies matrix=True), the documents are
+        assigned and summed by n_jobs worker processes sharing the matrix
+        (see parallel.ParallelAssigner). """
+        if triangle and n_jobs > 1:
+            raise ValueError('triangle and n_jobs > 1 cannot be combined')
         self.k = k
+        self.matrix = matrix or triangle or n_jobs > 1
+        self.triangle = triangle
+        self.n_jobs = n_jobs
 
-    def cluster(self, documents, iters=10):
+    def cluster(self, documents, iters=10, tol=None):
         """
         Cluster a list of unlabeled documents, using iters iterations of k-means.
+        If tol is given, stop early after an iteration that changes no
+        assignment or changes the error by less than tol; the number of
+        iterations run is kept in self.iterations.
         Initialize the k mean vectors to be the first k documents provided.
         After each iteration, print:
         - the number of documents in each cluster
@@ -34,53 +56,156 @@ class KMeans(object):
         
         self.mean_norms=[]
         self.mean_vectors = []
-        for doc_id in range(len(documents)):
-            self.doc_norm[doc_id] = self.sqnorm(documents[doc_id])
-            if doc_id < self.k:
-                self.mean_vectors.append(documents[doc_id])
-                self.mean_norms.append(self.doc_norm[doc_id])
+        self.assignments = None
+        self.assigner = None
+        if self.matrix:
+            from matrix import DocumentMatrix
+            self.doc_matrix = DocumentMatrix(documents)
+            if self.triangle:
+                from matrix import TriangleBounds
+                self.bounds = TriangleBounds(self.doc_matrix)
+                self.skipped = []
+            if self.n_jobs > 1:
+                from parallel import ParallelAssigner
+                self.assigner = ParallelAssigner(self.doc_matrix, self.k, self.n_jobs)
+            self.means = self.doc_matrix.docs[:self.k].toarray()
+            self.mean_norms = self.doc_matrix.sqnorms[:self.k]
+        else:
+            for doc_id in range(len(documents)):
+                self.doc_norm[doc_id] = self.sqnorm(documents[doc_id])
+                if doc_id < self.k:
+                    self.mean_vectors.append(documents[doc_id])
+                    self.mean_norms.append(self.doc_norm[doc_id])
+            # The sum of each cluster's documents, its squared norm and the
+            # cluster of each document in the sums, updated by compute_means
+            # for the documents that change cluster.
+            self.sums = [Counter() for _ in range(self.k)]
+            self.sum_sqnorms = [0] * self.k
+            self.sum_assignments = [None] * len(documents)
+            # The distance from each document to each mean, and the means
+            # that have changed since the distances were computed.
+            self.doc_dists = [[0.0] * self.k for _ in range(len(documents))]
+            self.stale = set(range(self.k))
         
-        for j in range(iters):
-            
-            self.compute_clusters(documents)
-            self.compute_means()
-            
-            num_of_docs = []
-            for i in self.k_cluster:
-                num_of_docs.append(len(self.k_cluster[i]))
-            
-            print(num_of_docs)
-            print(self.error(documents))
+        previous_error = None
+        try:
+            for j in range(iters):
+                
+                self.compute_clusters(documents)
+                self.compute_means()
+                
+                num_of_docs = []
+                for i in self.k_cluster:
+                    num_of_docs.append(len(self.k_cluster[i]))
+                
+                print(num_of_docs)
+                error = self.error(documents)
+                print(error)
+                self.iterations = j + 1
+                if tol is not None and (self.changed == 0 or
+                                        previous_error is not None and abs(previous_error - error) < tol):
+                    break
+                previous_error = error
+        finally:
+            if self.assigner is not None:
+                self.assigner.close()
+                self.assigner = None
 
     def compute_means(self):
         """ Compute the mean vectors for each cluster (results stored in an
-        instance variable of your choosing)."""
-        self.mean_vectors = []
+        instance variable of your choosing).
+
+        Only the documents that changed cluster are moved between the
+        running sums, and only the means of the clusters they left or
+        joined are recomputed. The squared norm of a mean is that of its
+        sum, updated with the dot product of each added or removed
+        document, over the squared cluster size. With integer term counts
+        the sums and their norms are exact. The recomputed means are left
+        in self.stale, for compute_clusters.
+        """
+        if self.assigner is not None:
+            self.means = self.assigner.means(self.means)
+            self.mean_norms = (self.means ** 2).sum(axis=1)
+            return
+        if self.matrix:
+            # An empty cluster keeps its mean rather than being dropped.
+            self.means = self.doc_matrix.means(self.assignments, self.k, self.means)
+            self.mean_norms = (self.means ** 2).sum(axis=1)
+            return
+        moved = self.stale = set()
+        for doc_id, cluster in enumerate(self.assignments):
+            old = self.sum_assignments[doc_id]
+            if cluster != old:
+                doc = self.documents[doc_id]
+                if old is not None:
+                    self.move_doc(doc, old, -1)
+                    moved.add(old)
+                self.move_doc(doc, cluster, 1)
+                moved.add(cluster)
+                self.sum_assignments[doc_id] = cluster
         for i in range(self.k):
-            term_freq = Counter()
-            for doc_id in self.k_cluster[i]:
-                term_freq.update(self.documents[doc_id])
-            if(len(self.k_cluster[i]) > 0):
-                for term in term_freq:
-                    term_freq[term] = 1.0 * term_freq[term] / len(self.k_cluster[i])
-                self.mean_vectors.append(term_freq)
-            self.mean_norms = []
-            for t in self.mean_vectors:
-                self.mean_norms.append(self.sqnorm(t))
+            self.k_cluster[i]  # Lists empty clusters in the printed sizes.
+        for i in list(moved):
+            size = len(self.k_cluster[i])
+            # An empty cluster keeps its mean rather than being dropped.
+            if size > 0:
+                self.mean_vectors[i] = Counter(dict((term, 1.0 * count / size)
+                                                    for term, count in self.sums[i].items()))
+                self.mean_norms[i] = self.sum_sqnorms[i] / size ** 2
+            else:
+                moved.discard(i)
+
+    def move_doc(self, doc, cluster, sign):
+        """ Add doc to (sign=1) or remove it from (sign=-1) the running sum
+        of cluster, and update the sum's squared norm. """
+        total = self.sums[cluster]
+        sqnorm = self.sum_sqnorms[cluster]
+        for term, count in doc.items():
+            old = total[term]
+            new = old + sign * count
+            sqnorm += new * new - old * old
+            if new:
+                total[term] = new
+            else:
+                del total[term]
+        self.sum_sqnorms[cluster] = sqnorm
 
     def compute_clusters(self, documents):
         """ Assign each document to a cluster. (Results stored in an instance
         variable of your choosing). """
+        previous = self.assignments
+        if self.matrix:
+            from matrix import cluster_members
+            if self.triangle:
+                self.assignments = self.bounds.assign(self.means, self.mean_norms).copy()
+                self.skipped.append(1 - self.bounds.evaluations / float(len(documents) * len(self.means)))
+            elif self.assigner is not None:
+                self.assignments = self.assigner.assign(self.means, self.mean_norms)
+            else:
+                # argmin picks the first of equally near means, like the loop below.
+                self.assignments = self.doc_matrix.distances(self.means, self.mean_norms).argmin(axis=1)
+            self.k_cluster = cluster_members(self.assignments)
+            self.changed = len(documents) if previous is None else int((self.assignments != previous).sum())
+            return
         self.k_cluster = defaultdict(lambda: [])
+        self.assignments = []
+        # Only the distances to means that changed are recomputed.
+        stale = sorted(self.stale)
         for doc_id in range(len(documents)):
             assign_cluster = -1
             min_distance = -1
+            dists = self.doc_dists[doc_id]
+            for cluster in stale:
+                dists[cluster] = self.distance(documents[doc_id],self.mean_vectors[cluster],self.mean_norms[cluster]+self.doc_norm[doc_id])
             for cluster in range(self.k):
-                distance = self.distance(documents[doc_id],self.mean_vectors[cluster],self.mean_norms[cluster]+self.doc_norm[doc_id])
+                distance = dists[cluster]
                 if ( distance < min_distance or assign_cluster == -1):
                     assign_cluster = cluster
                     min_distance = distance
             self.k_cluster[assign_cluster].append(doc_id)
+            self.assignments.append(assign_cluster)
+        self.changed = len(documents) if previous is None else \
+            sum(a != b for a, b in zip(self.assignments, previous))
 
     def sqnorm(self, d):
         """ Return the vector length of a dictionary d, defined as the sum of
@@ -107,6 +232,11 @@ class KMeans(object):
         
         error = 0.0
         self.k_cluster_dist = defaultdict(lambda: [])
+        if self.matrix:
+            # print_top_docs builds k_cluster_dist from these when it needs it.
+            self.doc_distances = self.doc_matrix.pair_distances(
+                np.arange(len(self.assignments)), self.means, self.mean_norms, self.assignments)
+            return float(self.doc_distances.sum())
         for cluster in self.k_cluster.keys():
             for doc_id in self.k_cluster[cluster]:
                 distance = self.distance(documents[doc_id],self.mean_vectors[cluster],self.mean_norms[cluster]+self.doc_norm[doc_id])
@@ -122,6 +252,10 @@ class KMeans(object):
         for each Counter (sorted alphabetically).
         Note: To make the output more interesting, only print documents with more than 3 distinct terms.
         See Log.txt for an example."""
+        if self.matrix:
+            for cluster, doc_ids in self.k_cluster.items():
+                self.k_cluster_dist[cluster] = list(zip([self.documents[doc_id] for doc_id in doc_ids],
+                                                        self.doc_distances[doc_ids].tolist()))
         for cluster in self.k_cluster.keys():
             print("CLUSTER ",cluster)
             topdocs = sorted(self.k_cluster_dist[cluster],key=lambda x:x[1])
@@ -134,6 +268,150 @@ class KMeans(object):
                 if count == n:
                     break
 
+class MiniBatchKMeans(KMeans):
+    """
+    k-means over profiles streamed from a gzipped file in mini-batches, for
+    corpora that do not fit in memory. Each batch is assigned to the
+    nearest means with a matrix.DocumentMatrix, then each mean moves
+    towards the mean of its batch documents with a learning rate of one
+    over the number of documents assigned to it so far, so that every mean
+    is the running mean of its documents.
+
+    Memory use depends on the batch size, k and the vocabulary, but not on
+    the number of profiles: besides one batch, only the document
+    frequencies and the k dense mean vectors are kept.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'profiles.txt.gz')
+    >>> with gzip.open(path, 'wt') as f:
+    ...     _ = f.write('a a b\\nx y\\na b\\ny y x\\nz\\na b b\\n')
+    >>> km = MiniBatchKMeans(k=2, batch_size=2)
+    >>> km.cluster_file(path, iters=2, min_df=2)  # doctest:+ELLIPSIS
+    [3, 2]
+    3.118...
+    [3, 2]
+    3.365...
+    [3, 2]
+    2.962...
+    >>> km.counts.tolist()
+    [6.0, 4.0]
+    >>> km.cluster_file(path, iters=1, min_df=2, final_pass=False)  # doctest:+ELLIPSIS
+    [3, 2]
+    3.118...
+    >>> km.print_top_docs()
+    Traceback (most recent call last):
+    ...
+    ValueError: no documents assigned; run cluster_file with final_pass=True or call assign_file first
+    """
+
+    def __init__(self, k=2, batch_size=1000):
+        """ Initialize a mini-batch k-means clusterer reading batch_size
+        profiles at a time. """
+        KMeans.__init__(self, k, matrix=True)
+        self.batch_size = batch_size
+        self.k_cluster_dist = None
+
+    def batches(self, filename):
+        """ Yield the pruned profiles of filename, one DocumentMatrix per
+        batch. """
+        from matrix import DocumentMatrix
+        for batch in read_profile_batches(filename, self.batch_size):
+            docs = prune_docs(batch, self.term_doc_freq, self.min_df)
+            if docs:
+                yield docs, DocumentMatrix(docs, self.columns)
+
+    def cluster_file(self, filename, iters=10, min_df=2, final_pass=True):
+        """
+        Cluster the profiles of filename with iters passes of mini-batch
+        k-means. The profiles are pruned as prune_terms(profiles, min_df)
+        would, after a first pass to count document frequencies, and the
+        means initialized to the first k of them.
+
+        After each pass, print the number of documents assigned to each
+        cluster during the pass and the error of the pass: the total
+        distance between each document and the mean it was assigned to,
+        as the means were when its batch was read. If final_pass is True,
+        then assign every document to its nearest final mean and print the
+        sizes and error of that assignment, which KMeans.error measures
+        the same way, and keep the nearest documents for print_top_docs.
+        """
+        self.min_df = min_df
+        self.term_doc_freq = defaultdict(lambda: 0)
+        for batch in read_profile_batches(filename, self.batch_size):
+            count_doc_frequencies(batch, self.term_doc_freq)
+        self.columns = {}
+        for term, df in self.term_doc_freq.items():
+            if df >= min_df:
+                self.columns[term] = len(self.columns)
+
+        self.means = None
+        self.counts = np.zeros(self.k)
+        self.k_cluster_dist = None
+        for j in range(iters):
+            sizes = np.zeros(self.k, dtype=np.int64)
+            error = 0.0
+            for docs, matrix in self.batches(filename):
+                if self.means is None:
+                    if len(docs) < self.k:
+                        raise ValueError('the first batch has fewer than k documents')
+                    self.means = matrix.docs[:self.k].toarray()
+                    self.mean_norms = matrix.sqnorms[:self.k]
+                distances = matrix.distances(self.means, self.mean_norms)
+                assignments = distances.argmin(axis=1)
+                error += distances[np.arange(len(docs)), assignments].sum()
+                batch_sizes = np.bincount(assignments, minlength=self.k)
+                sizes += batch_sizes
+                self.counts += batch_sizes
+                rates = batch_sizes / np.maximum(self.counts, 1)
+                self.means += (matrix.means(assignments, self.k, self.means) - self.means) * rates[:, None]
+                self.mean_norms = (self.means ** 2).sum(axis=1)
+            print(sizes.tolist())
+            print(float(error))
+        if final_pass:
+            self.assign_file(filename)
+
+    def assign_file(self, filename, n=10):
+        """ Assign every document of filename to its nearest mean and print
+        the cluster sizes and the error, as KMeans.cluster does after an
+        iteration. The n nearest documents of each cluster with more than 3
+        distinct terms are kept for print_top_docs. """
+        sizes = np.zeros(self.k, dtype=np.int64)
+        error = 0.0
+        top = defaultdict(lambda: [])
+        seen = 0
+        for docs, matrix in self.batches(filename):
+            distances = matrix.distances(self.means, self.mean_norms)
+            assignments = distances.argmin(axis=1)
+            distances = distances[np.arange(len(docs)), assignments]
+            error += distances.sum()
+            sizes += np.bincount(assignments, minlength=self.k)
+            for i in np.flatnonzero(np.fromiter((len(doc) > 3 for doc in docs), bool, len(docs))):
+                # A bounded max-heap on distance, with ties kept in document order.
+                entry = (-distances[i], -(seen + i), docs[i])
+                heap = top[int(assignments[i])]
+                if len(heap) < n:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+            seen += len(docs)
+        self.k_cluster_dist = dict((cluster, [(doc, -distance) for distance, _, doc in sorted(heap, reverse=True)])
+                                   for cluster, heap in sorted(top.items()))
+        print(sizes.tolist())
+        print(float(error))
+
+    def print_top_docs(self, n=10):
+        """ Print the nearest documents of each cluster kept by assign_file,
+        like KMeans.print_top_docs. Raise ValueError if assign_file has not
+        run since the means were last computed. """
+        if self.k_cluster_dist is None:
+            raise ValueError('no documents assigned; run cluster_file with final_pass=True '
+                             'or call assign_file first')
+        for cluster, topdocs in self.k_cluster_dist.items():
+            print("CLUSTER ",cluster)
+            for doc, _ in topdocs[:n]:
+                print(' '.join(sorted(doc.keys())))
+
+
 def prune_terms(docs, min_df=3):
     """ Remove terms that don't occur in at least min_df different
     documents. Return a list of Counters. Omit documents that are empty after
@@ -141,17 +419,30 @@ def prune_terms(docs, min_df=3):
     >>> prune_terms([{'a': 1, 'b': 10}, {'a': 1}, {'c': 1}], min_df=2)
     [Counter({'a': 1}), Counter({'a': 1})]
     """
-    term_doc_freq = defaultdict(lambda: 0)
-    
+    term_doc_freq = count_doc_frequencies(docs)
+    return prune_docs(docs, term_doc_freq, min_df)
+
+def count_doc_frequencies(docs, term_doc_freq=None):
+    """ Return a dict from term to the number of docs containing it, adding
+    to the counts of term_doc_freq if given (e.g. for a stream of batches).
+    >>> dict(count_doc_frequencies([{'a': 1, 'b': 10}, {'a': 1}]))
+    {'a': 2, 'b': 1}
+    """
+    if term_doc_freq is None:
+        term_doc_freq = defaultdict(lambda: 0)
     for doc in docs:
         for term in doc.keys():
             term_doc_freq[term] += 1
-            
+    return term_doc_freq
+
+def prune_docs(docs, term_doc_freq, min_df):
+    """ Remove the terms with a document frequency below min_df from docs,
+    as prune_terms does, given the document frequencies. """
     result = []
     for doc in docs:
         freq = Counter()
         for term in doc.keys():
-            if term_doc_freq[term] >= min_df:
+            if term_doc_freq.get(term, 0) >= min_df:
                 freq[term] += doc[term]
         if freq:
             result.append(freq)
@@ -168,6 +459,20 @@ def read_profiles(filename):
     return profiles
 
 
+def read_profile_batches(filename, batch_size=1000):
+    """ Read profiles like read_profiles, but yield them in lists of up to
+    batch_size Counters, so that only one batch is in memory at a time. """
+    batch = []
+    with gzip.open(filename, mode='rt', encoding='utf8') as infile:
+        for line in infile:
+            batch.append(Counter(line.split()))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
 def main():
     profiles = read_profiles('profiles.txt.gz')
     print('read', len(profiles), 'profiles.')
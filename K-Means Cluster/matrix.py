@@ -0,0 +1,235 @@
+""" A sparse-matrix engine for cluster.KMeans.
+
+DocumentMatrix holds the documents as a CSR matrix with one row per document
+and one column per term, and the squared norm of each row. The squared
+Euclidean distance between a document d and a mean m is
+
+  |d|^2 + |m|^2 - 2 d.m
+
+so the distances between every document and each of the k means (a dense
+k x V matrix) take one sparse-dense matrix product, and the nearest means
+one argmin. The means themselves are one sparse product of a cluster
+membership matrix with the documents. Needs scipy.
+
+Distances equal those of KMeans.distance to within floating point rounding
+(the terms are summed in a different order), so only documents equally far
+from two means to within rounding could be assigned differently.
+
+TriangleBounds assigns documents to the same means while skipping the
+distances that the triangle inequality proves cannot change the assignment.
+It is used by KMeans(triangle=True), and pays off only when most documents
+keep their mean between iterations.
+"""
+from array import array
+from collections import defaultdict
+
+import numpy as np
+from scipy import sparse
+
+
+class DocumentMatrix(object):
+    """
+    >>> from collections import Counter
+    >>> matrix = DocumentMatrix([Counter('aab'), Counter('bc'), Counter('a')])
+    >>> matrix.docs.shape, matrix.terms
+    ((3, 3), ['a', 'b', 'c'])
+    >>> matrix.sqnorms.tolist()
+    [5.0, 2.0, 1.0]
+    >>> means = matrix.means(np.array([0, 1, 0]), 2)
+    >>> means.tolist()
+    [[1.5, 0.5, 0.0], [0.0, 1.0, 1.0]]
+    >>> matrix.distances(means).round(4).tolist()
+    [[0.7071, 2.2361], [1.8708, 0.0], [0.7071, 1.7321]]
+    >>> DocumentMatrix([Counter('aab'), Counter('bc')], {'b': 0, 'a': 1}).docs.toarray().tolist()
+    [[1.0, 2.0], [1.0, 0.0]]
+    """
+
+    def __init__(self, documents, columns=None):
+        """ Build the matrix of a list of Counters mapping term to count.
+        Terms are numbered in order of first appearance, unless columns, a
+        dict from term to column number, gives a fixed vocabulary; terms not
+        in it are then left out. """
+        fixed = columns is not None
+        self.terms = list(columns) if fixed else []
+        columns = columns if fixed else {}
+        indptr, indices, data = array('q', [0]), array('i'), array('d')
+        for doc in documents:
+            for term, count in doc.items():
+                column = columns.get(term)
+                if column is None:
+                    if fixed:
+                        continue
+                    column = columns[term] = len(self.terms)
+                    self.terms.append(term)
+                indices.append(column)
+                data.append(count)
+            indptr.append(len(indices))
+        self.docs = sparse.csr_matrix((np.frombuffer(data, dtype=np.float64),
+                                       np.frombuffer(indices, dtype=np.int32),
+                                       np.frombuffer(indptr, dtype=np.int64)),
+                                      shape=(len(documents), len(self.terms)))
+        self.sqnorms = np.asarray(self.docs.multiply(self.docs).sum(axis=1)).ravel()
+
+    def means(self, assignments, k, previous=None):
+        """ Return the k x V matrix of the mean of the documents assigned to
+        each cluster, given an array of the cluster of each document. The
+        mean of an empty cluster is its row of previous, or zero. """
+        n_docs = len(assignments)
+        members = sparse.csr_matrix((np.ones(n_docs), (assignments, np.arange(n_docs))),
+                                    shape=(k, n_docs))
+        sizes = np.bincount(assignments, minlength=k)
+        means = members.dot(self.docs).toarray() / np.maximum(sizes, 1)[:, None]
+        if previous is not None:
+            means[sizes == 0] = previous[sizes == 0]
+        return means
+
+    def distances(self, means, mean_sqnorms=None, rows=None):
+        """ Return the n x k array of Euclidean distances between each
+        document (or each of rows, if given) and each row of means, given
+        their squared norms if they are known. """
+        if mean_sqnorms is None:
+            mean_sqnorms = (means ** 2).sum(axis=1)
+        docs, sqnorms = self.docs, self.sqnorms
+        if rows is not None:
+            docs, sqnorms = docs[rows], sqnorms[rows]
+        squared = docs.dot(means.T)
+        squared *= -2
+        squared += sqnorms[:, None]
+        squared += mean_sqnorms
+        # Rounding can leave a document's distance to itself slightly negative.
+        np.maximum(squared, 0, out=squared)
+        return np.sqrt(squared, out=squared)
+
+    def pair_distances(self, rows, means, mean_sqnorms, centers):
+        """ Return the array of Euclidean distances between document rows[i]
+        and mean centers[i], for each i. Each dot product is summed in the
+        same order as by the matrix product of distances, so the distances
+        are identical to the corresponding ones of distances. """
+        indptr = self.docs.indptr
+        starts = indptr[rows]
+        lengths = indptr[rows + 1] - starts
+        pairs = np.repeat(np.arange(len(rows)), lengths)
+        nonzeros = (np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) +
+                    np.repeat(starts, lengths))
+        products = self.docs.data[nonzeros] * means[centers[pairs], self.docs.indices[nonzeros]]
+        # bincount adds the products of each pair in order, as the matrix product does.
+        squared = np.asarray(np.bincount(pairs, weights=products, minlength=len(rows)), dtype=np.float64) * -2
+        squared += self.sqnorms[rows]
+        squared += mean_sqnorms[centers]
+        np.maximum(squared, 0, out=squared)
+        return np.sqrt(squared, out=squared)
+
+
+class TriangleBounds(object):
+    """
+    Hamerly's accelerated k-means assignment. For every document it keeps an
+    upper bound on the distance to its assigned mean a and a lower bound on
+    the distance to every other mean. When the means move, the bounds are
+    loosened by how far the means moved. By the triangle inequality no other
+    mean can be nearer to a document x than a if
+
+      upper(x) < max(lower(x), s(a)),   s(a) = min d(a, c) / 2 over c != a
+
+    For the other documents, upper(x) is first tightened to the exact
+    distance to a, and only if the test still fails are the distances to
+    all k means computed. In the iterations where most documents fail the
+    test, all distances are computed at once instead (see DENSE).
+
+    The bounds are widened by a margin that covers the rounding of the
+    computed distances, and computed distances are identical to those of
+    DocumentMatrix.distances, so the assignments are identical to an
+    argmin over all distances.
+
+    >>> from collections import Counter
+    >>> matrix = DocumentMatrix([Counter('aab'), Counter('bc'), Counter('a'), Counter('cc')])
+    >>> bounds = TriangleBounds(matrix)
+    >>> means = matrix.docs[:2].toarray()
+    >>> bounds.assign(means).tolist(), bounds.evaluations
+    ([0, 1, 0, 1], 8)
+    >>> means = matrix.means(bounds.assignments, 2)
+    >>> bounds.assign(means).tolist(), bounds.evaluations
+    ([0, 1, 0, 1], 1)
+    """
+
+    # The margin on every bound, relative to the largest document and mean
+    # norms, well above the rounding error of the distances.
+    SLACK = 1e-6
+    # When more than this fraction of the documents fail the bounds test,
+    # all distances are computed at once, as by DocumentMatrix.distances,
+    # which is cheaper than checking the documents one by one.
+    DENSE = .5
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.upper = self.lower = self.means = self.assignments = None
+        self.evaluations = 0
+
+    def nearest(self, rows, means, mean_sqnorms):
+        """ Compute the distances from documents rows (or all documents, if
+        rows is None) to all means, and set their assignments and bounds
+        from them. """
+        distances = self.matrix.distances(means, mean_sqnorms, rows)
+        assignments = distances.argmin(axis=1)
+        rows = slice(None) if rows is None else rows
+        self.assignments[rows] = assignments
+        self.upper[rows] = distances[np.arange(len(assignments)), assignments]
+        distances[np.arange(len(assignments)), assignments] = np.inf
+        self.lower[rows] = distances.min(axis=1)
+
+    def assign(self, means, mean_sqnorms=None):
+        """ Return the index of the nearest of means to each document, and
+        count in evaluations the distances that had to be computed. """
+        matrix = self.matrix
+        if mean_sqnorms is None:
+            mean_sqnorms = (means ** 2).sum(axis=1)
+        n_docs, k = matrix.docs.shape[0], len(means)
+        if self.upper is None:
+            self.assignments = np.zeros(n_docs, dtype=np.int64)
+            self.upper, self.lower = np.zeros(n_docs), np.zeros(n_docs)
+            self.nearest(None, means, mean_sqnorms)
+            self.means = means.copy()
+            self.evaluations = n_docs * k
+            return self.assignments
+
+        drift = np.sqrt(((means - self.means) ** 2).sum(axis=1))
+        self.means = means.copy()
+        assignments, upper, lower = self.assignments, self.upper, self.lower
+        # The other means moved by at most the largest drift but a's own.
+        order = np.argsort(drift)
+        other_drift = np.where(assignments == order[-1], drift[order[-2]] if k > 1 else 0, drift[order[-1]])
+        upper += drift[assignments]
+        lower -= other_drift
+        slack = self.SLACK * np.sqrt(matrix.sqnorms + mean_sqnorms.max())
+        centers = np.sqrt(np.maximum(mean_sqnorms[:, None] + mean_sqnorms - 2 * means.dot(means.T), 0))
+        np.fill_diagonal(centers, np.inf)
+        bound = np.maximum(lower, centers.min(axis=1)[assignments] / 2)
+
+        docs = np.flatnonzero(upper + slack >= bound)
+        if len(docs) > self.DENSE * n_docs:
+            self.nearest(None, means, mean_sqnorms)
+            self.evaluations = n_docs * k
+            return assignments
+        upper[docs] = matrix.pair_distances(docs, means, mean_sqnorms, assignments[docs])
+        self.evaluations = len(docs)
+        docs = docs[upper[docs] + slack[docs] >= bound[docs]]
+        self.nearest(docs, means, mean_sqnorms)
+        self.evaluations += len(docs) * k
+        return assignments
+
+
+def cluster_members(assignments):
+    """ Return a dict from cluster to the list of its doc ids, given an array
+    of the cluster of each document. The clusters are in order of their
+    first document, as KMeans.compute_clusters adds them.
+
+    >>> dict(cluster_members(np.array([2, 0, 2, 1, 0])))
+    {2: [0, 2], 0: [1, 4], 1: [3]}
+    """
+    clusters, first = np.unique(assignments, return_index=True)
+    order = np.argsort(assignments, kind='stable')
+    ends = np.cumsum(np.bincount(assignments)[clusters])
+    members = np.split(order, ends[:-1])
+    res = defaultdict(lambda: [])
+    for i in np.argsort(first):
+        res[int(clusters[i])] = members[i].tolist()
+    return res
@@ -0,0 +1,175 @@
+"""
+Parallel assignment for cluster.KMeans(n_jobs=...).
+
+ParallelAssigner copies a matrix.DocumentMatrix into shared memory once and
+starts n_jobs worker processes, each owning a contiguous range of its rows.
+In each iteration the parent writes the means to shared memory and every
+worker computes, for its rows, the nearest means and the partial sum and
+size of each cluster, which it writes back to shared memory. The parent
+then adds up the partial sums into the new means.
+
+Each worker computes its rows' distances exactly as DocumentMatrix.distances
+computes them, so the assignments are identical to a single process's. The
+partial sums are added up in a different order than DocumentMatrix.means
+adds the documents, which makes no difference for integer term counts (the
+sums are exact); with other weights the means can differ by rounding.
+"""
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+
+from matrix import DocumentMatrix
+
+
+class SharedArrays(object):
+    """ Named NumPy arrays in one block of shared memory. Created with
+    shapes, a list of (name, shape, dtype) triples, by the parent; attached
+    to with the block's name and the same shapes by the workers. """
+
+    def __init__(self, shapes, name=None):
+        sizes = [int(np.prod(shape)) * np.dtype(dtype).itemsize for _, shape, dtype in shapes]
+        self.shapes = shapes
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None,
+                                                 size=max(1, sum(sizes)))
+        self.arrays, offset = {}, 0
+        for (key, shape, dtype), size in zip(shapes, sizes):
+            self.arrays[key] = np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=offset)
+            offset += size
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def close(self, unlink=False):
+        """ Detach from the block, and free it if unlink is True. """
+        self.arrays = {}
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+def serve_rows(name, shapes, job, start, end, conn):
+    """ Attach to the shared arrays of a ParallelAssigner and, for each
+    request from conn, assign rows start to end to their nearest means and
+    write their partial cluster sums and sizes to slot job. A request is the
+    number of means; None stops the worker. """
+    shared = SharedArrays(shapes, name)
+    indptr = shared['indptr'][start:end+1]
+    matrix = DocumentMatrix([])
+    matrix.docs = sparse.csr_matrix((shared['data'][indptr[0]:indptr[-1]],
+                                     shared['indices'][indptr[0]:indptr[-1]], indptr - indptr[0]),
+                                    shape=(end - start, shared['means'].shape[1]))
+    matrix.sqnorms = shared['sqnorms'][start:end]
+    means = None
+    while True:
+        k = conn.recv()
+        if k is None:
+            break
+        means = shared['means'][:k]
+        assignments = matrix.distances(means, shared['mean_sqnorms'][:k]).argmin(axis=1)
+        shared['assignments'][start:end] = assignments
+        members = sparse.csr_matrix((np.ones(end - start), (assignments, np.arange(end - start))),
+                                    shape=(k, end - start))
+        shared['sums'][job, :k] = members.dot(matrix.docs).toarray()
+        shared['sizes'][job, :k] = np.bincount(assignments, minlength=k)
+        conn.send(True)
+    # The block can only be detached once no array uses it.
+    del matrix, indptr, means
+    shared.close()
+    conn.close()
+
+
+class ParallelAssigner(object):
+    """
+    >>> from collections import Counter
+    >>> matrix = DocumentMatrix([Counter('aab'), Counter('bc'), Counter('a'), Counter('cc')])
+    >>> with ParallelAssigner(matrix, 2, n_jobs=2) as assigner:
+    ...     assigner.assign(matrix.docs[:2].toarray()).tolist()
+    ...     assigner.means().tolist()
+    [0, 1, 0, 1]
+    [[1.5, 0.5, 0.0], [0.0, 0.5, 1.5]]
+    >>> matrix.means(np.array([0, 1, 0, 1]), 2).tolist()
+    [[1.5, 0.5, 0.0], [0.0, 0.5, 1.5]]
+    """
+
+    def __init__(self, matrix, k, n_jobs=2):
+        """ Copy matrix to shared memory and start n_jobs workers (see
+        serve_rows), for up to k means. close() (or leaving a with block)
+        must be called to stop them. """
+        docs = matrix.docs
+        n_docs, n_terms = docs.shape
+        self.shapes = [('data', docs.data.shape, docs.data.dtype),
+                       ('indices', docs.indices.shape, docs.indices.dtype),
+                       ('indptr', docs.indptr.shape, docs.indptr.dtype),
+                       ('sqnorms', (n_docs,), np.float64),
+                       ('means', (k, n_terms), np.float64),
+                       ('mean_sqnorms', (k,), np.float64),
+                       ('assignments', (n_docs,), np.int64),
+                       ('sums', (n_jobs, k, n_terms), np.float64),
+                       ('sizes', (n_jobs, k), np.int64)]
+        self.shared = SharedArrays(self.shapes)
+        for key, values in (('data', docs.data), ('indices', docs.indices),
+                            ('indptr', docs.indptr), ('sqnorms', matrix.sqnorms)):
+            self.shared[key][:] = values
+        size = -(-n_docs // n_jobs)
+        self.workers = []
+        for job in range(n_jobs):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=serve_rows, daemon=True,
+                args=(self.shared.memory.name, self.shapes, job,
+                      min(job * size, n_docs), min((job + 1) * size, n_docs), child_conn))
+            process.start()
+            child_conn.close()
+            self.workers.append((process, conn))
+        self.k = 0
+
+    def close(self):
+        """ Stop the workers and free the shared memory, even if some
+        workers have died. """
+        try:
+            for process, conn in self.workers:
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass  # The worker is gone; it is terminated below.
+                conn.close()
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+        finally:
+            self.workers = []
+            if self.shared is not None:
+                self.shared.close(unlink=True)
+                self.shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def assign(self, means, mean_sqnorms=None):
+        """ Return the index of the nearest of means to each document, as
+        an array computed by the workers in parallel. """
+        if mean_sqnorms is None:
+            mean_sqnorms = (means ** 2).sum(axis=1)
+        self.k = len(means)
+        self.shared['means'][:self.k] = means
+        self.shared['mean_sqnorms'][:self.k] = mean_sqnorms
+        for _, conn in self.workers:
+            conn.send(self.k)
+        for _, conn in self.workers:
+            conn.recv()
+        return self.shared['assignments'].copy()
+
+    def means(self, previous=None):
+        """ Return the mean of each cluster of the last assignment, from the
+        workers' partial sums, like DocumentMatrix.means. """
+        sizes = self.shared['sizes'][:, :self.k].sum(axis=0)
+        means = self.shared['sums'][:, :self.k].sum(axis=0) / np.maximum(sizes, 1)[:, None]
+        if previous is not None:
+            means[sizes == 0] = previous[sizes == 0]
+        return means
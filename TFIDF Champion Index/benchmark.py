@@ -0,0 +1,463 @@
+"""
+Benchmarks for the search engine.
+
+Run with `python benchmark.py NAME [documents.txt.gz]`, where NAME is one of
+the bench_* functions below without its prefix (e.g. `python benchmark.py
+memory`).
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from searcher import Index
+
+QUERIES = ['pop love song', 'chinese american', 'city']
+
+
+def sample_queries(indexer, n=500, max_terms=5, seed=0):
+    """ Return n queries of 1 to max_terms words taken from random documents,
+    so that popular terms appear as often as they do in the corpus. """
+    rand = random.Random(seed)
+    queries = []
+    while len(queries) < n:
+        tokens = indexer.tokenize(rand.choice(indexer.documents))
+        if tokens:
+            queries.append(' '.join(rand.choice(tokens) for _ in range(rand.randint(1, max_terms))))
+    return queries
+
+
+def timed(fn, queries):
+    """ Return the mean seconds per query of fn over queries. """
+    start = time.perf_counter()
+    for query in queries:
+        fn(query)
+    return (time.perf_counter() - start) / len(queries)
+
+
+def traced(fn, *args):
+    """ Call fn(*args) and return (result, seconds, bytes still allocated by
+    the result, peak bytes allocated). """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, current, peak
+
+
+def bench_memory(filename):
+    """ Compare the memory used by the list-of-lists postings with the
+    compact array postings, and check that both rank documents the same way
+    for the sample queries. """
+    indexer = Index()
+    indexer.documents = indexer.read_lines(filename)
+    toked_docs = [indexer.tokenize(d) for d in indexer.documents]
+    indexer.doc_freqs = indexer.count_doc_frequencies(toked_docs)
+    n_postings = sum(indexer.doc_freqs.values())
+    print('%d documents, %d terms, %d postings' %
+          (len(toked_docs), len(indexer.doc_freqs), n_postings))
+
+    rankings = {}
+    for compact in (False, True):
+        index, elapsed, size, peak = traced(indexer.create_tfidf_index,
+                                            toked_docs, indexer.doc_freqs, compact)
+        label = 'compact' if compact else 'lists'
+        print('%-8s build %.2fs  index %8.1f KiB (%5.1f bytes/posting)  peak %8.1f KiB' %
+              (label, elapsed, size / 1024., 1. * size / n_postings, peak / 1024.))
+        indexer.index = index
+        indexer.doc_lengths = indexer.compute_doc_lengths(index)
+        rankings[compact] = [[d for d, s in indexer.search(q)[:100]] for q in QUERIES]
+    print('same top-100 ordering: %s' % (rankings[False] == rankings[True]))
+
+
+def bench_load(filename):
+    """ Compare building the index from the documents with loading a saved
+    copy of it, with and without mmap. """
+    start = time.perf_counter()
+    indexer = Index(filename)
+    print('build       %8.3fs' % (time.perf_counter() - start))
+    path = os.path.join(tempfile.mkdtemp(), 'documents.idx')
+    indexer.save(path)
+    print('file size   %8.1f KiB' % (os.path.getsize(path) / 1024.))
+    for use_mmap in (False, True):
+        start = time.perf_counter()
+        loaded = Index.load(path, mmap=use_mmap)
+        elapsed = time.perf_counter() - start
+        same = all(loaded.search(q) == indexer.search(q) for q in QUERIES)
+        print('load mmap=%-5s %8.5fs  same results: %s' % (use_mmap, elapsed, same))
+    os.remove(path)
+
+
+def bench_build(filename, run_size=200000):
+    """ Compare the time and peak memory of building the index in memory and
+    saving it with streaming it into a file with builder.build_index. """
+    import builder
+    path = os.path.join(tempfile.mkdtemp(), 'documents.idx')
+    _, elapsed, _, peak = traced(lambda: Index(filename).save(path))
+    print('in memory  %6.2fs  peak %8.1f KiB' % (elapsed, peak / 1024.))
+    with open(path, 'rb') as f:
+        expected = f.read()
+    _, elapsed, _, peak = traced(builder.build_index, filename, path, 10, run_size)
+    print('streaming  %6.2fs  peak %8.1f KiB  (run_size=%d)' % (elapsed, peak / 1024., run_size))
+    with open(path, 'rb') as f:
+        print('identical files: %s' % (f.read() == expected))
+    os.remove(path)
+
+
+def bench_workers(filename):
+    """ Time building the index with 1, 2, 4 and 8 worker processes and
+    check that every build produces the same index. """
+    base = None
+    for workers in (1, 2, 4, 8):
+        start = time.perf_counter()
+        indexer = Index(filename, workers=workers)
+        elapsed = time.perf_counter() - start
+        if base is None:
+            base, base_time = indexer, elapsed
+        same = (list(indexer.index) == list(base.index) and
+                all(list(indexer.index[t]) == list(base.index[t]) for t in base.index) and
+                indexer.doc_lengths == base.doc_lengths)
+        print('workers=%d  %6.2fs  speedup %4.2fx  same index: %s' %
+              (workers, elapsed, base_time / elapsed, same))
+
+
+def bench_updates(filename, fraction=.02, rounds=20):
+    """ Compare applying an update (adding and deleting a small fraction of
+    the documents) to a DynamicIndex with rebuilding the whole index. Then
+    search from a second thread while rounds of updates and compactions run,
+    and check that no search fails and that each sees a consistent index:
+    its results are those of the snapshot that was current before or after
+    some update. """
+    from dynamic import DynamicIndex
+    documents = Index().read_lines(filename)
+    n = int(len(documents) * fraction)
+    indexer = DynamicIndex(compact_ratio=1)
+    indexer.add_documents(documents[:-n])
+    start = time.perf_counter()
+    indexer.add_documents(documents[-n:])
+    indexer.delete_documents(range(n))
+    print('update %d docs  %8.3fs' % (2 * n, time.perf_counter() - start))
+    start = time.perf_counter()
+    indexer.compact()
+    print('compact         %8.3fs' % (time.perf_counter() - start))
+    start = time.perf_counter()
+    DynamicIndex().add_documents(documents[n:])
+    print('full rebuild    %8.3fs' % (time.perf_counter() - start))
+
+    # Compactions run in this thread, so that every snapshot is recorded.
+    indexer = DynamicIndex(compact_ratio=float('inf'))
+    indexer.add_documents(documents[:len(documents) // 2])
+    queries = sample_queries(Index(filename), n=50)
+    snapshots, seen, errors = [indexer.snapshot], [], []
+    done = threading.Event()
+
+    def search():
+        while not done.is_set():
+            for query in queries:
+                try:
+                    seen.append((query, indexer.search(query, k=10)))
+                except Exception as e:
+                    errors.append(e)
+    thread = threading.Thread(target=search)
+    thread.start()
+    rand = random.Random(0)
+    for i in range(rounds):
+        offset = len(documents) // 2 + i * n
+        indexer.add_documents(documents[offset:offset + n])
+        snapshots.append(indexer.snapshot)
+        indexer.delete_documents(rand.sample(range(len(indexer.documents)), n))
+        snapshots.append(indexer.snapshot)
+        indexer.compact()
+        snapshots.append(indexer.snapshot)
+    done.set()
+    thread.join()
+    expected = dict((query, set(repr(s.search(query, k=10)) for s in snapshots)) for query in queries)
+    consistent = sum(repr(results) in expected[query] for query, results in seen)
+    print('%d searches during %d rounds of updates: %d errors, %d consistent with a snapshot' %
+          (len(seen) + len(errors), rounds, len(errors), consistent))
+
+
+def bench_topk(filename, k=10):
+    """ Compare exhaustive scoring and sorting with the bounded-heap and
+    MaxScore top-k paths, and check that all return the same top k. """
+    indexer = Index(filename)
+    queries = sample_queries(indexer)
+    same = all(indexer.search(q, k=k) == indexer.search(q)[:k] for q in queries)
+    print('%d queries, k=%d, same top k: %s' % (len(queries), k, same))
+    runs = [('sorted', lambda q: indexer.search(q)[:k]),
+            ('heap', lambda q: indexer.search_by_cosine(
+                indexer.query_to_vector(indexer.tokenize(q)), indexer.index,
+                indexer.doc_lengths, k)),
+            ('maxscore', lambda q: indexer.search(q, k=k))]
+    for name, fn in runs:
+        print('%-9s %8.3f ms/query' % (name, 1000 * timed(fn, queries)))
+
+
+def bench_batch(filename, k=10):
+    """ Compare searching the sample queries one at a time with scoring them
+    together with search_batch, and check that both return the same
+    results. """
+    indexer = Index(filename)
+    queries = sample_queries(indexer, n=2000)
+    for label, k in (('all', None), ('top %d' % k, k)):
+        start = time.perf_counter()
+        expected = [indexer.search(q, k=k) for q in queries]
+        loop = time.perf_counter() - start
+        start = time.perf_counter()
+        results = indexer.search_batch(queries, k=k)
+        batch = time.perf_counter() - start
+        print('%-6s loop %8.1f queries/s  batch %8.1f queries/s  same results: %s' %
+              (label, len(queries) / loop, len(queries) / batch, results == expected))
+
+
+def bench_lexicon(filename):
+    """ Compare building an index keyed by term, from documents tokenized
+    into lists of strings, with building one keyed by term id, from
+    documents encoded as arrays of term ids (as Index(filename) does), and
+    check that both rank documents the same way for the sample queries. """
+    from lexicon import Lexicon, TermTable
+    documents = Index().read_lines(filename)
+
+    def tokenize(lexicon):
+        tokenize = Index().tokenize
+        if lexicon is None:
+            return [tokenize(d) for d in documents]
+        return [lexicon.encode(tokenize(d)) for d in documents]
+
+    def build(lexicon, toked_docs):
+        indexer = Index()
+        indexer.documents, indexer.lexicon = documents, lexicon
+        indexer.doc_freqs = indexer.count_doc_frequencies(toked_docs)
+        indexer.index = indexer.create_tfidf_index(toked_docs, indexer.doc_freqs, True)
+        if lexicon is not None:  # as Index(filename) stores them
+            indexer.doc_freqs = TermTable(indexer.doc_freqs, 'i')
+            indexer.index = TermTable(indexer.index)
+        indexer.doc_lengths = indexer.compute_doc_lengths(indexer.index)
+        indexer.champion_index = indexer.create_champion_index(indexer.index, 10)
+        indexer.max_scores = indexer.compute_max_scores(indexer.index, indexer.doc_lengths)
+        if lexicon is not None:
+            indexer.champion_index = TermTable(indexer.champion_index)
+            indexer.max_scores = TermTable(indexer.max_scores, 'd')
+        return indexer
+
+    rankings = {}
+    for label, lexicon in (('terms', None), ('term ids', Lexicon())):
+        toked_docs, tokenized, toked_size, _ = traced(tokenize, lexicon)
+        indexer, elapsed, size, peak = traced(build, lexicon, toked_docs)
+        print('%-9s tokenize %5.2fs  tokenized docs %8.1f KiB  build %5.2fs  '
+              'index %8.1f KiB  peak %8.1f KiB' %
+              (label, tokenized, toked_size / 1024., elapsed, size / 1024., peak / 1024.))
+        rankings[label] = [indexer.search(q) for q in QUERIES]
+        del toked_docs, indexer
+    print('same rankings: %s' % (rankings['terms'] == rankings['term ids']))
+
+
+def bench_compression(filename, k=10):
+    """ Compare compact postings (postings.Postings) with compressed ones
+    (postings.CompressedPostings): the memory used by the postings, the size
+    of the saved index, the time to build the postings, and the query
+    latency in memory and loaded from the file. Check that both return the
+    same results for the sample queries. """
+    from lexicon import Lexicon, TermTable
+    from postings import CompressedPostingsTable
+    documents = Index().read_lines(filename)
+    lexicon = Lexicon()
+    toked_docs = [lexicon.encode(Index().tokenize(d)) for d in documents]
+    doc_freqs = Index().count_doc_frequencies(toked_docs)
+
+    def build(compress):  # as Index(filename, compress=compress) does
+        index = TermTable(Index().create_tfidf_index(toked_docs, doc_freqs, True, compress))
+        return CompressedPostingsTable.pack(index.values()) if compress else index
+
+    built = {}
+    for compress in (False, True):
+        built[compress], elapsed, size, _ = traced(build, compress)
+        print('%-10s build %5.2fs  postings %8.1f KiB' %
+              ('compressed' if compress else 'compact', elapsed, size / 1024.))
+    del toked_docs
+    # The bytes of the postings themselves, without Python object overhead:
+    # the doc id and weight arrays, and the compressed blocks alone (payload)
+    # or with each list's length and skip data and the table's offsets.
+    compact = sum(p.nbytes() for p in built[False].values())
+    payload = sum(len(built[True][term].data) for term in built[True])
+    total = built[True].nbytes()
+    print('compact    nbytes  %8.1f KiB' % (compact / 1024.))
+    print('compressed payload %8.1f KiB (%4.2fx smaller)  nbytes %8.1f KiB (%4.2fx smaller)' %
+          (payload / 1024., 1. * compact / payload, total / 1024., 1. * compact / total))
+    del built
+
+    tmp = tempfile.mkdtemp()
+    indexers = {}
+    for compress in (False, True):
+        label = 'compressed' if compress else 'compact'
+        path = os.path.join(tmp, label + '.idx')
+        Index(filename, compress=compress).save(path)
+        indexers[label] = Index.load(path)
+        print('%-10s file %8.1f KiB' % (label, os.path.getsize(path) / 1024.))
+    queries = sample_queries(indexers['compact'])
+    expected = [indexers['compact'].search(q) for q in queries]
+    for label, indexer in sorted(indexers.items()):
+        same = [indexer.search(q) for q in queries] == expected
+        print('%-10s all %8.3f ms/query  top %d %8.3f ms/query  same results: %s' %
+              (label, 1000 * timed(indexer.search, queries), k,
+               1000 * timed(lambda q: indexer.search(q, k=k), queries), same))
+        os.remove(os.path.join(tmp, label + '.idx'))
+
+
+def bench_tiers(filename, k=10):
+    """ Report the recall@k (against the exact top k) and the query latency
+    of champion lists and of tiered indexes with several thresholds (see
+    searcher.Index.create_tiered_index), next to the exact MaxScore search.
+    """
+    indexer = Index(filename)
+    queries = sample_queries(indexer)
+    expected = [set(doc_id for doc_id, _ in indexer.search(q, k=k)) for q in queries]
+
+    def report(label, search):
+        results = [search(q) for q in queries]
+        recall = sum(len(e.intersection(doc_id for doc_id, _ in r)) / float(len(e))
+                     for r, e in zip(results, expected) if e) / sum(1 for e in expected if e)
+        print('%-28s recall@%d %6.4f  %8.3f ms/query' %
+              (label, k, recall, 1000 * timed(search, queries)))
+
+    report('exact (maxscore)', lambda q: indexer.search(q, k=k))
+    report('champions (10)', lambda q: indexer.search(q, True, k=k))
+    configs = [('tiers (10)', (10,)),
+               ('tiers (10, 100)', (10, 100)),
+               ('tiers (10, 50, 250)', (10, 50, 250)),
+               ('tiers (max(10, df/20))', (lambda df: max(10, df // 20),)),
+               ('tiers (10, max(100, df/4))', (10, lambda df: max(100, df // 4)))]
+    for label, thresholds in configs:
+        start = time.perf_counter()
+        indexer.tiered_index, indexer.tier_bounds = indexer.create_tiered_index(
+            indexer.index, indexer.doc_lengths, thresholds)
+        elapsed = time.perf_counter() - start
+        report('%s, built in %.1fs' % (label, elapsed), lambda q: indexer.search(q, k=k, use_tiers=True))
+
+
+def bench_boolean(filename, n=200, window=5, seed=0):
+    """ Report the latency of AND, phrase and proximity queries with
+    search_boolean, and the time and memory of building the positional
+    index, and check their results against scanning the tokenized
+    documents. Also check that ranked queries do not build the positional
+    index. The phrases are runs of 2 or 3 consecutive words of random
+    documents, and the proximity queries the same words shuffled. """
+    indexer = Index(filename)
+    queries = sample_queries(indexer, n)
+    rand = random.Random(seed)
+    phrases = []
+    while len(phrases) < n:
+        tokens = indexer.tokenize(rand.choice(indexer.documents))
+        length = rand.randint(2, 3)
+        if len(tokens) >= length:
+            start = rand.randrange(len(tokens) - length + 1)
+            phrases.append(tokens[start:start + length])
+    shuffled = [rand.sample(phrase, len(phrase)) for phrase in phrases]
+    toked_docs = [indexer.tokenize(d) for d in indexer.documents]
+
+    def scan(match):
+        return lambda terms: [doc_id for doc_id, tokens in enumerate(toked_docs) if match(terms, tokens)]
+
+    def is_phrase(terms, tokens):
+        return any(tokens[i:i + len(terms)] == terms for i in range(len(tokens)))
+
+    def is_near(terms, tokens):
+        return any(set(terms) <= set(tokens[i:i + window]) for i in range(len(tokens)))
+
+    def doc_ids(results):
+        return sorted(doc_id for doc_id, _ in results)
+
+    ranked = timed(indexer.search, queries)
+    print('ranked (OR)  %8.3f ms/query  positional index built: %s' %
+          (1000 * ranked, indexer.positions is not None))
+    same = all(doc_ids(indexer.search_boolean(q)) ==
+               scan(lambda terms, tokens: set(terms) <= set(tokens))(indexer.tokenize(q))
+               for q in queries)
+    print('AND          %8.3f ms/query  same documents: %s' %
+          (1000 * timed(indexer.search_boolean, queries), same))
+    _, elapsed, size, peak = traced(indexer.positional_index)
+    print('positional index built in %.2fs, %.1f KiB (peak %.1f KiB)' %
+          (elapsed, size / 1024., peak / 1024.))
+    for label, clauses, match in (('phrase', phrases, is_phrase), ('near~%d' % window, shuffled, is_near)):
+        suffix = '' if label == 'phrase' else '~%d' % window
+        queries = ['"%s"%s' % (' '.join(terms), suffix) for terms in clauses]
+        same = all(doc_ids(indexer.search_boolean(q)) == scan(match)(terms)
+                   for q, terms in zip(queries, clauses))
+        print('%-12s %8.3f ms/query  same documents: %s' %
+              (label, 1000 * timed(indexer.search_boolean, queries), same))
+
+
+def bench_match(filename, k=10):
+    """ Compare AND and at-least-2 queries evaluated document at a time
+    (search(match=...), see searcher.Index.search_by_daat) with scoring the
+    OR query term at a time and keeping the documents with enough of the
+    query terms, for compact and compressed postings, and check that both
+    give the same results. """
+    for compress in (False, True):
+        indexer = Index(filename, compress=compress)
+        queries = [q for q in sample_queries(indexer) if len(set(indexer.tokenize(q))) > 1]
+        doc_ids = {}
+
+        def filtered(query, min_match):
+            qry_vector = indexer.query_to_vector(indexer.tokenize(query))
+            for term in qry_vector:
+                if term not in doc_ids:
+                    doc_ids[term] = set(indexer.index[term].doc_ids)
+            return [(doc_id, score) for doc_id, score in indexer.search(query)
+                    if sum(doc_id in doc_ids[term] for term in qry_vector) >= min_match]
+
+        print('%s postings, %d queries' % ('compressed' if compress else 'compact', len(queries)))
+        for label, match, min_match in (('AND', 'and', None), ('at least 2', 2, 2)):
+            def min_terms(query):
+                return len(set(indexer.tokenize(query))) if min_match is None else min_match
+            expected = [filtered(q, min_terms(q)) for q in queries]
+            same = [indexer.search(q, match=match) for q in queries] == expected
+            print('  %-10s  term at a time + filter %7.3f ms/query  document at a time %7.3f ms/query'
+                  '  (top %d %7.3f ms/query)  same results: %s' %
+                  (label, 1000 * timed(lambda q: filtered(q, min_terms(q)), queries),
+                   1000 * timed(lambda q: indexer.search(q, match=match), queries), k,
+                   1000 * timed(lambda q: indexer.search(q, k=k, match=match), queries), same))
+
+
+def bench_shards(filename, k=10):
+    """ Report the query latency (one query at a time) and throughput
+    (search_batch) of sharded.ShardedIndex with 1, 2, 4 and 8 shards, in
+    this process and with a worker process per shard, next to a single
+    index, and check that every configuration returns the single index's
+    results, for all results and for the top k. """
+    from sharded import ShardedIndex
+    indexer = Index(filename)
+    queries = sample_queries(indexer)
+    expected = [indexer.search(q, k=k) for q in queries]
+    expected_all = [indexer.search(q) for q in queries[:100]]
+
+    def report(label, index):
+        same = ([index.search(q, k=k) for q in queries] == expected and
+                index.search_batch(queries[:100]) == expected_all)
+        latency = timed(lambda q: index.search(q, k=k), queries)
+        start = time.perf_counter()
+        index.search_batch(queries, k=k)
+        throughput = len(queries) / (time.perf_counter() - start)
+        print('%-22s top %d %7.3f ms/query  batch %8.1f queries/s  same results: %s' %
+              (label, k, 1000 * latency, throughput, same))
+
+    report('single index', indexer)
+    for n_shards in (1, 2, 4, 8):
+        for processes in (False, True):
+            with ShardedIndex(filename, n_shards, processes=processes) as index:
+                report('%d shards%s' % (n_shards, ', processes' if processes else ''), index)
+
+
+def main():
+    name = sys.argv[1] if len(sys.argv) > 1 else 'memory'
+    filename = sys.argv[2] if len(sys.argv) > 2 else 'documents.txt.gz'
+    globals()['bench_' + name](filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Streaming construction of an index file (see storage.py) for corpora that
+do not fit in memory.
+
+The documents are read one line at a time. Each document's term counts are
+appended to a buffer of (term id, doc id, tf) postings, with term ids given
+out in order of first appearance. When the buffer holds run_size postings it
+is sorted by term id and spilled to a temporary file. The sorted runs are
+then merged, and each term's postings are weighted, written out and reduced
+to a champion list as soon as the merge has collected them.
+
+Memory therefore grows with the vocabulary (the term dictionary and per-term
+offsets) plus a few bytes per document for its length and text offset, but
+not with the number of postings. The result is identical to
+searcher.Index(filename).save(path) (or, with compress=True, to
+searcher.Index(filename, compress=True).save(path)): terms are merged in order of first
+appearance, which is the order create_tfidf_index inserts them, so even the
+floating point document lengths are summed in the same order.
+
+Build a file from the command line with
+`python builder.py documents.txt.gz documents.idx [run_size] [--compress]`.
+"""
+from array import array
+from collections import Counter
+import gzip
+import heapq
+import math
+import sys
+import tempfile
+
+from lexicon import Lexicon
+from postings import TERM_GROUP, TF_WEIGHTS, CompressedPostings, tf_codes
+from searcher import Index, tier_size
+import storage
+
+RECORD = 3  # ints per spilled posting: term id, doc id, tf
+
+
+def read_documents(filename):
+    """ Yield the stripped lines of a gzipped file, one at a time. """
+    with gzip.open(filename, 'rt') as f:
+        for line in f:
+            yield line.strip()
+
+
+def spill(terms, doc_ids, tfs, tmpdir):
+    """ Sort a buffer of postings by term id (keeping doc id order within a
+    term) and write it to a temporary file. Return the file. """
+    run = array('i')
+    for i in sorted(range(len(terms)), key=terms.__getitem__):
+        run.extend((terms[i], doc_ids[i], tfs[i]))
+    f = tempfile.TemporaryFile(dir=tmpdir)
+    run.tofile(f)
+    f.seek(0)
+    return f
+
+
+def read_run(f, chunk=1 << 16):
+    """ Yield the (term id, doc id, tf) postings of a spilled run. """
+    while True:
+        records = array('i', f.read(chunk * RECORD * 4))
+        if not records:
+            return
+        for i in range(0, len(records), RECORD):
+            yield records[i], records[i+1], records[i+2]
+
+
+def merge_runs(runs):
+    """ Merge sorted runs, yielding (term id, doc ids, tfs) for each term in
+    term id order. """
+    term, doc_ids, tfs = None, array('i'), array('i')
+    for term_id, doc_id, tf in heapq.merge(*[read_run(f) for f in runs]):
+        if term_id != term:
+            if term is not None:
+                yield term, doc_ids, tfs
+            term, doc_ids, tfs = term_id, array('i'), array('i')
+        doc_ids.append(doc_id)
+        tfs.append(tf)
+    if term is not None:
+        yield term, doc_ids, tfs
+
+
+def build_index(filename, path, champion_threshold=10, run_size=1000000, tmpdir=None,
+                compress=False):
+    """ Index the gzipped file of documents (one per line) in a single pass
+    and write the result to path, holding at most run_size postings in
+    memory at once. With compress=True the postings are written as
+    postings.CompressedPostings. Load the result with
+    searcher.Index.load(path).
+
+    >>> import os
+    >>> tmp = tempfile.mkdtemp()
+    >>> filename, path = os.path.join(tmp, 'docs.txt.gz'), os.path.join(tmp, 'docs.idx')
+    >>> with gzip.open(filename, 'wt') as f:
+    ...     _ = f.write('a b a\\nb c\\nc d a\\n')
+    >>> build_index(filename, path, run_size=2)
+    >>> loaded, indexer = Index.load(path), Index(filename)
+    >>> list(loaded.index[loaded.lexicon['a']]) == list(indexer.index[indexer.lexicon['a']])
+    True
+    >>> loaded.search('a c') == indexer.search('a c')
+    True
+    >>> build_index(filename, path, run_size=2, compress=True)
+    >>> Index.load(path).search('a c') == indexer.search('a c')
+    True
+    """
+    indexer = Index()
+    lexicon = Lexicon()
+    runs = []
+    terms, doc_ids, tfs = array('i'), array('i'), array('i')
+    documents = tempfile.TemporaryFile(dir=tmpdir)
+    doc_offsets = array('Q', [0])
+    for doc_id, document in enumerate(read_documents(filename)):
+        documents.write(document.encode('utf-8'))
+        doc_offsets.append(documents.tell())
+        for term, tf in Counter(indexer.tokenize(document)).items():
+            terms.append(lexicon.add(term))
+            doc_ids.append(doc_id)
+            tfs.append(tf)
+        if len(terms) >= run_size:
+            runs.append(spill(terms, doc_ids, tfs, tmpdir))
+            terms, doc_ids, tfs = array('i'), array('i'), array('i')
+    if terms:
+        runs.append(spill(terms, doc_ids, tfs, tmpdir))
+    del terms, doc_ids, tfs
+    n_docs = len(doc_offsets) - 1
+
+    postings = [tempfile.TemporaryFile(dir=tmpdir) for _ in range(5)]
+    offsets, champion_offsets = array('Q', [0]), array('Q', [0])
+    compressed_offsets = array('Q', [0]) if compress else array('Q')
+    doc_lengths = array('d', [0.0]) * n_docs
+    for term, term_doc_ids, term_tfs in merge_runs(runs):
+        idf = math.log10(float(n_docs) / len(term_doc_ids))
+        if compress:  # weighted as the compressed postings decode them
+            weights = array('f', [TF_WEIGHTS[code] * idf for code in tf_codes(term_tfs).tolist()])
+        else:
+            weights = array('f', [(1 + math.log10(float(tf))) * idf for tf in term_tfs])
+        for doc_id, weight in zip(term_doc_ids, weights):
+            doc_lengths[doc_id] = float(doc_lengths[doc_id] + weight**2)
+        champions = heapq.nlargest(tier_size(champion_threshold, len(term_doc_ids)),
+                                   zip(term_doc_ids, weights), key=lambda tup: tup[1])
+        term_doc_ids.tofile(postings[0])
+        weights.tofile(postings[1])
+        array('i', [d for d, w in champions]).tofile(postings[2])
+        array('f', [w for d, w in champions]).tofile(postings[3])
+        if compress:
+            postings[4].write(CompressedPostings(term_doc_ids, term_tfs, n_docs).to_bytes())
+            if (term + 1) % TERM_GROUP == 0:
+                compressed_offsets.append(postings[4].tell())
+        offsets.append(offsets[-1] + len(term_doc_ids))
+        champion_offsets.append(champion_offsets[-1] + len(champions))
+    for run in runs:
+        run.close()
+    for doc_id in range(n_docs):
+        doc_lengths[doc_id] = float(math.sqrt(doc_lengths[doc_id]))
+
+    # A second, sequential pass over the written postings, now that all
+    # document lengths are known.
+    max_scores = array('d')
+    postings[0].seek(0)
+    postings[1].seek(0)
+    for term in range(len(lexicon)):
+        n = offsets[term+1] - offsets[term]
+        term_doc_ids = array('i', postings[0].read(4 * n))
+        weights = array('f', postings[1].read(4 * n))
+        best = 0.0
+        for doc_id, weight in zip(term_doc_ids, weights):
+            if weight > 0:
+                best = max(best, weight / float(doc_lengths[doc_id]))
+        max_scores.append(best)
+
+    if compress:  # the offsets, doc ids and weights were only needed for max_scores
+        if len(lexicon) % TERM_GROUP:
+            compressed_offsets.append(postings[4].tell())
+        offsets = array('Q')
+        postings[0].truncate(0)
+        postings[1].truncate(0)
+    sections = (storage.term_tables(list(lexicon)) +
+                (offsets, postings[0], postings[1],
+                 champion_offsets, postings[2], postings[3],
+                 doc_lengths, doc_offsets, documents, max_scores,
+                 compressed_offsets, postings[4]))
+    storage.write_sections(path, 'f', n_docs, len(lexicon),
+                           0 if callable(champion_threshold) else champion_threshold, sections)
+    for f in postings + [documents]:
+        f.close()
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if arg != '--compress']
+    run_size = int(args[2]) if len(args) > 2 else 1000000
+    build_index(args[0], args[1], run_size=run_size, compress='--compress' in sys.argv)
+
+
+if __name__ == '__main__':
+    main()
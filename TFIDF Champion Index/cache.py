@@ -0,0 +1,79 @@
+"""
+A bounded LRU cache for search results, with optional expiry.
+
+Entries are tagged with the generation of the index they were computed
+from (see searcher.Index.generation); when the index reports a different
+generation the whole cache is dropped, so results never outlive the
+documents they were computed from.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class ResultCache(object):
+    """
+    Least-recently-used cache holding at most maxsize entries. If ttl is
+    given, entries older than ttl seconds are treated as missing.
+
+    >>> cache = ResultCache(maxsize=2)
+    >>> cache.put(('city',), 'results for city', generation=0)
+    >>> cache.put(('pop',), 'results for pop', generation=0)
+    >>> cache.get(('city',), generation=0)
+    'results for city'
+    >>> cache.put(('love',), 'results for love', generation=0)
+    >>> cache.get(('pop',), generation=0) is None  # least recently used
+    True
+    >>> cache.get(('city',), generation=1) is None  # the index changed
+    True
+    >>> cache.stats()
+    {'size': 0, 'hits': 1, 'misses': 2, 'evictions': 1, 'invalidations': 1}
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.generation = None
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def check_generation(self, generation):
+        """ Drop every entry if the index generation has changed. """
+        if generation != self.generation:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.generation = generation
+
+    def get(self, key, generation):
+        """ Return the value cached for key, or None. """
+        with self.lock:
+            self.check_generation(generation)
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and self.clock() - entry[1] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, generation):
+        """ Cache value for key, evicting the least recently used entry if the
+        cache is full. """
+        with self.lock:
+            self.check_generation(generation)
+            self.entries[key] = (value, self.clock())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """ Return a dict of the cache size and its counters. """
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations}
@@ -0,0 +1,383 @@
+"""
+An index that can add and delete documents without being rebuilt.
+
+searcher.Index bakes IDF into every stored weight, document length and
+champion list, so any change to the corpus means a full rebuild.
+DynamicIndex instead stores raw term frequencies and applies the current
+IDF when a query runs:
+
+- add_documents appends postings for the new documents only, and computes
+  their lengths with the current statistics.
+- delete_documents marks documents as deleted (a tombstone) and updates the
+  document frequencies; the postings stay until the next compaction.
+- Champion lists hold the highest-tf postings of each term, which are the
+  highest tf-idf postings for any positive IDF, so they are updated per
+  changed document rather than recomputed.
+- compact() drops tombstoned postings and recomputes every document length
+  with the current statistics. It runs in a background thread once the
+  tombstones or the change in corpus size since the last compaction exceed
+  compact_ratio, and never blocks searches.
+
+Searches never take a lock. All the state they read (documents, postings,
+statistics, lengths) is kept in a Snapshot that is never changed once it
+is published: updates copy the current snapshot, change the copy, and
+publish it by replacing DynamicIndex.snapshot. A search reads that
+attribute once, so it sees the index either before or after an update,
+never in between. The copy costs time proportional to the vocabulary and
+the number of documents, so documents are best added in batches.
+
+Between compactions the lengths of older documents lag behind the changing
+IDFs, so scores drift slightly from a full rebuild; after compact() they
+are the same.
+"""
+from array import array
+from collections import Counter, defaultdict
+from collections.abc import Mapping
+import math
+import threading
+
+from postings import Postings
+from searcher import Index
+
+
+class WeightedPostings(Mapping):
+    """ A read-only view mapping term to its tf-idf postings, computed from
+    the raw tf postings with the snapshot's IDF. Deleted documents and
+    documents with a zero length are left out. """
+
+    def __init__(self, snapshot, tf_postings):
+        self.snapshot = snapshot
+        self.tf_postings = tf_postings
+
+    def __getitem__(self, term):
+        if not self.snapshot.doc_freqs.get(term):
+            raise KeyError(term)
+        idf = self.snapshot.idf(term)
+        deleted, lengths = self.snapshot.deleted, self.snapshot.doc_lengths
+        res = Postings(typecode='d')
+        for doc_id, tf in self.tf_postings[term]:
+            if doc_id not in deleted and lengths[doc_id]:
+                res.append((doc_id, (1 + math.log10(tf)) * idf))
+        return res
+
+    def __contains__(self, term):
+        return bool(self.snapshot.doc_freqs.get(term)) and term in self.tf_postings
+
+    def __iter__(self):
+        return (term for term in self.tf_postings if self.snapshot.doc_freqs.get(term))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class MaxScores(Mapping):
+    """ Per-term score bounds for search_by_max_score: the largest
+    (1 + log10(tf)) / length of a term, which does not depend on IDF, times
+    the term's IDF in the snapshot. """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getitem__(self, term):
+        return self.snapshot.max_tf_scores.get(term, 0.0) * self.snapshot.idf(term)
+
+    def __iter__(self):
+        return iter(self.snapshot.max_tf_scores)
+
+    def __len__(self):
+        return len(self.snapshot.max_tf_scores)
+
+
+class Snapshot(Index):
+    """
+    The documents, raw tf postings, statistics and lengths of a
+    DynamicIndex at one point in time, searchable like a searcher.Index. The
+    methods that change a snapshot (add, delete) are only called on a copy
+    that has not been published yet.
+
+    >>> snapshot = Snapshot()
+    >>> snapshot.add(['a b', 'b c'])
+    [0, 1]
+    >>> copy = snapshot.copy()
+    >>> copy.delete([0, 0, 5])
+    1
+    >>> [doc_id for doc_id, _ in snapshot.search('b')], [doc_id for doc_id, _ in copy.search('b')]
+    ([0, 1], [1])
+    """
+
+    def __init__(self, champion_threshold=10):
+        self.champion_threshold = champion_threshold
+        self.documents = []
+        self.tf_index = {}
+        self.champions = {}
+        self.doc_freqs = {}
+        self.doc_lengths = {}
+        self.max_tf_scores = {}
+        self.deleted = frozenset()
+        self.n_docs = 0
+
+    def copy(self):
+        """ Return a new snapshot with copies of this one's containers. The
+        postings lists are shared, and copied by add before they change. """
+        snapshot = Snapshot(self.champion_threshold)
+        snapshot.documents = list(self.documents)
+        snapshot.tf_index = dict(self.tf_index)
+        snapshot.champions = dict(self.champions)
+        snapshot.doc_freqs = dict(self.doc_freqs)
+        snapshot.doc_lengths = dict(self.doc_lengths)
+        snapshot.max_tf_scores = dict(self.max_tf_scores)
+        snapshot.deleted = self.deleted
+        snapshot.n_docs = self.n_docs
+        snapshot.generation = self.generation + 1
+        return snapshot
+
+    @property
+    def index(self):
+        return WeightedPostings(self, self.tf_index)
+
+    @property
+    def champion_index(self):
+        return WeightedPostings(self, self.champions)
+
+    @property
+    def max_scores(self):
+        return MaxScores(self)
+
+    def idf(self, term):
+        """ Return the IDF of term: log10(N / df), where N is the number of
+        documents that have not been deleted. """
+        return math.log10(float(self.n_docs) / self.doc_freqs[term])
+
+    def query_to_vector(self, query_terms):
+        """ Convert a list of query terms into a dict mapping term to its
+        IDF, omitting terms that are in no remaining document.
+
+        >>> snapshot = Snapshot()
+        >>> snapshot.add(['a b', 'b c'])
+        [0, 1]
+        >>> snapshot.query_to_vector(['a', 'b', 'z'])  # doctest:+ELLIPSIS
+        {'a': 0.301..., 'b': 0.0}
+        """
+        return dict((term, self.idf(term)) for term in query_terms
+                    if self.doc_freqs.get(term))
+
+    def add(self, documents):
+        """ Add a list of document strings and return their new doc ids.
+        Only the postings, lengths and champion lists of the new documents
+        are computed; the lengths use the statistics after the whole list
+        has been added. The postings lists of the new documents' terms are
+        copied before they are appended to, as they may be shared with a
+        published snapshot. """
+        added, copied = [], set()
+        for document in documents:
+            doc_id = len(self.documents)
+            self.documents.append(document)
+            counts = Counter(self.tokenize(document))
+            for term, tf in counts.items():
+                if term not in copied:
+                    old = self.tf_index.get(term)
+                    self.tf_index[term] = Postings(typecode='i') if old is None else \
+                        Postings.from_arrays(array('i', old.doc_ids), array('i', old.weights))
+                    copied.add(term)
+                self.tf_index[term].append((doc_id, tf))
+                self.doc_freqs[term] = self.doc_freqs.get(term, 0) + 1
+            added.append((doc_id, counts))
+        self.n_docs += len(added)
+        for doc_id, counts in added:
+            length = self.doc_length(counts)
+            self.doc_lengths[doc_id] = length
+            for term, tf in counts.items():
+                if length:
+                    self.max_tf_scores[term] = max(self.max_tf_scores.get(term, 0.0),
+                                                   (1 + math.log10(tf)) / length)
+                self.add_champion(term, doc_id, tf)
+        return [doc_id for doc_id, _ in added]
+
+    def delete(self, doc_ids):
+        """ Delete documents by doc id and return how many were deleted.
+        Their postings are tombstoned; document frequencies and champion
+        lists are updated straight away. Unknown or already deleted ids are
+        ignored. """
+        deleted = set(self.deleted)
+        for doc_id in doc_ids:
+            if doc_id in deleted or not 0 <= doc_id < len(self.documents):
+                continue
+            deleted.add(doc_id)
+            self.n_docs -= 1
+            for term in set(self.tokenize(self.documents[doc_id])):
+                self.doc_freqs[term] -= 1
+        for term in set(t for doc_id in deleted - self.deleted for t in self.tokenize(self.documents[doc_id])):
+            if any(d in deleted for d, _ in self.champions[term]):
+                self.champions[term] = self.best_postings(self.tf_index[term], deleted)
+        n_deleted = len(deleted) - len(self.deleted)
+        self.deleted = frozenset(deleted)
+        return n_deleted
+
+    def doc_length(self, counts):
+        """ Return the length of a document, given its term counts, under the
+        current statistics. The squares are added with math.fsum, so the
+        result does not depend on the order of the terms. """
+        return math.sqrt(math.fsum(((1 + math.log10(tf)) * self.idf(term))**2
+                                   for term, tf in counts.items()))
+
+    def best_postings(self, tf_postings, deleted=None):
+        """ Return the champion list of a tf postings list: its
+        champion_threshold postings with the highest tf that are not deleted
+        (or not in deleted, if given), best first, ties in doc id order. """
+        deleted = self.deleted if deleted is None else deleted
+        live = [p for p in tf_postings if p[0] not in deleted]
+        live.sort(key=lambda p: p[1], reverse=True)
+        return Postings(live[:self.champion_threshold], typecode='i')
+
+    def add_champion(self, term, doc_id, tf):
+        """ Insert a new posting into term's champion list if it ranks among
+        the champion_threshold best. """
+        champions = self.champions.get(term)
+        if champions is None:
+            self.champions[term] = Postings([(doc_id, tf)], typecode='i')
+        elif len(champions) < self.champion_threshold or tf > champions.weights[-1]:
+            best = list(champions) + [(doc_id, tf)]
+            best.sort(key=lambda p: p[1], reverse=True)
+            self.champions[term] = Postings(best[:self.champion_threshold], typecode='i')
+
+    def compacted(self):
+        """ Return a new snapshot without the postings of deleted documents,
+        and with all document lengths, champion lists and score bounds
+        recomputed with the current statistics. """
+        snapshot = Snapshot(self.champion_threshold)
+        squares = defaultdict(list)
+        for term, tf_postings in self.tf_index.items():
+            if not self.doc_freqs.get(term):
+                continue
+            idf = self.idf(term)
+            live = Postings(typecode='i')
+            for doc_id, tf in tf_postings:
+                if doc_id not in self.deleted:
+                    live.append((doc_id, tf))
+                    squares[doc_id].append(((1 + math.log10(tf)) * idf)**2)
+            snapshot.tf_index[term] = live
+            snapshot.champions[term] = snapshot.best_postings(live)
+            snapshot.doc_freqs[term] = self.doc_freqs[term]
+        snapshot.doc_lengths = dict((doc_id, 0.0) for doc_id in range(len(self.documents)))
+        for doc_id, square in squares.items():
+            snapshot.doc_lengths[doc_id] = math.sqrt(math.fsum(square))
+        for term, live in snapshot.tf_index.items():
+            snapshot.max_tf_scores[term] = max([(1 + math.log10(tf)) / snapshot.doc_lengths[doc_id]
+                                                for doc_id, tf in live
+                                                if snapshot.doc_lengths[doc_id]] or [0.0])
+        snapshot.documents = ['' if doc_id in self.deleted else document
+                              for doc_id, document in enumerate(self.documents)]
+        snapshot.n_docs = self.n_docs
+        snapshot.generation = self.generation + 1
+        return snapshot
+
+
+class DynamicIndex(Index):
+    """
+    A searcher.Index whose corpus can be changed in place.
+
+    >>> indexer = DynamicIndex()
+    >>> indexer.add_documents(['a b', 'b c', 'c d a', 'd'])
+    [0, 1, 2, 3]
+    >>> [doc_id for doc_id, score in indexer.search('a')]
+    [0, 2]
+    >>> before = indexer.snapshot
+    >>> indexer.delete_documents([0, 3])
+    >>> [doc_id for doc_id, score in indexer.search('a')]
+    [2]
+    >>> [doc_id for doc_id, score in before.search('a')]
+    [0, 2]
+    >>> indexer.compact()
+    >>> fresh = DynamicIndex()
+    >>> fresh.add_documents(['b c', 'c d a'])
+    [0, 1]
+    >>> [s for d, s in indexer.search('a b c')] == [s for d, s in fresh.search('a b c')]
+    True
+    """
+
+    def __init__(self, filename=None, champion_threshold=10, compact_ratio=.25):
+        """ Create an index, optionally holding the documents of filename (one
+        per line, gzipped). A background compaction starts once the number of
+        tombstones, or the change in the number of documents since the last
+        compaction, exceeds compact_ratio times the number of documents. """
+        self.champion_threshold = champion_threshold
+        self.compact_ratio = compact_ratio
+        self.snapshot = Snapshot(champion_threshold)
+        self.n_tombstones = 0
+        self.compacted_n_docs = 0
+        self.lock = threading.Lock()
+        self.compaction = None
+        if filename:
+            self.add_documents(self.read_lines(filename))
+
+    # The current snapshot's state, for callers that read one attribute.
+    documents = property(lambda self: self.snapshot.documents)
+    doc_freqs = property(lambda self: self.snapshot.doc_freqs)
+    doc_lengths = property(lambda self: self.snapshot.doc_lengths)
+    deleted = property(lambda self: self.snapshot.deleted)
+    n_docs = property(lambda self: self.snapshot.n_docs)
+    generation = property(lambda self: self.snapshot.generation)
+    index = property(lambda self: self.snapshot.index)
+    champion_index = property(lambda self: self.snapshot.champion_index)
+    max_scores = property(lambda self: self.snapshot.max_scores)
+
+    def query_to_vector(self, query_terms):
+        """ Convert a list of query terms into a dict mapping term to its
+        current IDF (see Snapshot.query_to_vector). """
+        return self.snapshot.query_to_vector(query_terms)
+
+    def search(self, *args, **kwargs):
+        """ Search the current snapshot (see searcher.Index.search). """
+        return self.snapshot.search(*args, **kwargs)
+
+    def search_batch(self, *args, **kwargs):
+        """ Search the current snapshot (see searcher.Index.search_batch). """
+        return self.snapshot.search_batch(*args, **kwargs)
+
+    def search_boolean(self, *args, **kwargs):
+        """ Search the current snapshot (see searcher.Index.search_boolean). """
+        return self.snapshot.search_boolean(*args, **kwargs)
+
+    def add_documents(self, documents):
+        """ Add a list of document strings to the index and return their new
+        doc ids (see Snapshot.add). """
+        with self.lock:
+            fresh = self.snapshot.n_docs == 0 and not self.n_tombstones
+            snapshot = self.snapshot.copy()
+            doc_ids = snapshot.add(documents)
+            if fresh:
+                # Every length was computed with the final statistics.
+                self.compacted_n_docs = snapshot.n_docs
+            self.snapshot = snapshot
+        self.maybe_compact()
+        return doc_ids
+
+    def delete_documents(self, doc_ids):
+        """ Delete documents by doc id (see Snapshot.delete). Their postings
+        are tombstoned until the next compaction. """
+        with self.lock:
+            snapshot = self.snapshot.copy()
+            self.n_tombstones += snapshot.delete(doc_ids)
+            self.snapshot = snapshot
+        self.maybe_compact()
+
+    def maybe_compact(self):
+        """ Start a background compaction if enough has changed since the
+        last one and none is running. """
+        changed = max(self.n_tombstones, abs(self.snapshot.n_docs - self.compacted_n_docs))
+        if (changed > self.compact_ratio * max(self.snapshot.n_docs, 1) and
+                (self.compaction is None or not self.compaction.is_alive())):
+            self.compaction = threading.Thread(target=self.compact)
+            self.compaction.daemon = True
+            self.compaction.start()
+
+    def compact(self):
+        """ Drop the postings of deleted documents and recompute all document
+        lengths, champion lists and score bounds with the current statistics
+        (see Snapshot.compacted). Updates wait for it to finish; searches do
+        not, and see the old snapshot until the new one is published. """
+        with self.lock:
+            snapshot = self.snapshot.compacted()
+            self.n_tombstones = 0
+            self.compacted_n_docs = snapshot.n_docs
+            self.snapshot = snapshot
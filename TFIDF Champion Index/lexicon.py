@@ -0,0 +1,115 @@
+"""
+A vocabulary mapping terms to dense integer ids.
+
+Documents can be kept as compact arrays of term ids instead of lists of
+strings, and per-term index structures as lists or arrays indexed by term
+id (see TermTable) instead of dicts keyed by string. Strings are only
+looked up when a query is parsed.
+"""
+from array import array
+from collections.abc import Mapping
+from numbers import Integral
+
+
+class Lexicon(Mapping):
+    """
+    A mapping from term to term id. Ids are given out in order of first
+    appearance, starting at 0.
+
+    >>> lexicon = Lexicon()
+    >>> lexicon.encode(['b', 'a', 'b'])
+    array('I', [0, 1, 0])
+    >>> lexicon['a'], lexicon.get('z')
+    (1, None)
+    >>> lexicon.term(0)
+    'b'
+    >>> lexicon.decode(array('I', [1, 0]))
+    ['a', 'b']
+    >>> list(lexicon)
+    ['b', 'a']
+    """
+
+    def __init__(self, terms=()):
+        self.ids = {}
+        self.terms = []
+        for term in terms:
+            self.add(term)
+
+    def add(self, term):
+        """ Return the id of term, giving it the next id if it is new. """
+        term_id = self.ids.get(term)
+        if term_id is None:
+            term_id = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def term(self, term_id):
+        """ Return the term with the given id. """
+        return self.terms[term_id]
+
+    def encode(self, tokens):
+        """ Return a list of tokens as an array of term ids, adding any new
+        terms. """
+        ids = self.ids
+        return array('I', [ids[token] if token in ids else self.add(token) for token in tokens])
+
+    def decode(self, term_ids):
+        """ Return the terms of a sequence of term ids. """
+        return [self.terms[term_id] for term_id in term_ids]
+
+    def get(self, term, default=None):
+        return self.ids.get(term, default)
+
+    def __getitem__(self, term):
+        return self.ids[term]
+
+    def __contains__(self, term):
+        return term in self.ids
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+
+class TermTable(Mapping):
+    """
+    A read-only mapping from term id to value, stored in a list or array
+    indexed by term id.
+
+    >>> table = TermTable({0: 3, 1: 1}, 'i')
+    >>> table[1], 1 in table, 2 in table, 'a' in table
+    (1, True, False, False)
+    >>> import numpy as np
+    >>> np.int64(1) in table, table[np.int32(0)]
+    (True, 3)
+    >>> list(table.values())
+    [3, 1]
+    """
+
+    def __init__(self, values, typecode=None):
+        """ Create a table from a dict keyed by the term ids 0 to n-1, or a
+        sequence in term id order. With a typecode the values are stored in
+        an array of that type, otherwise in a list. """
+        if isinstance(values, Mapping):
+            values = [values[term_id] for term_id in range(len(values))]
+        self.table = list(values) if typecode is None else array(typecode, values)
+
+    def __getitem__(self, term_id):
+        # Indexing the table checks the type and the upper bound.
+        try:
+            if term_id >= 0:
+                return self.table[term_id]
+        except (IndexError, TypeError):
+            pass
+        raise KeyError(term_id)
+
+    def __contains__(self, term_id):
+        return isinstance(term_id, Integral) and 0 <= term_id < len(self.table)
+
+    def __iter__(self):
+        return iter(range(len(self.table)))
+
+    def __len__(self):
+        return len(self.table)
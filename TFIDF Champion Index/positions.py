@@ -0,0 +1,183 @@
+"""
+A positional index, and the boolean, phrase and proximity matching built on
+it, for searcher.Index.search_boolean.
+
+The positions of every term in every document are kept in four flat arrays
+(see PositionalIndex) rather than one Python object per posting. The index
+is built from the documents the first time a query needs positions, so
+ranked queries pay nothing for it.
+
+Query syntax (see parse_query): words must all occur in a document (AND);
+"quoted words" must occur as a phrase, and "quoted words"~N must all occur
+within a window of N consecutive positions, in any order.
+"""
+import re
+
+import numpy as np
+
+from lexicon import Lexicon
+from postings import gallop
+
+QUERY_CLAUSE = re.compile(r'"([^"]*)"(?:~(\d+))?|([^"\s]+)')
+
+
+def parse_query(query, tokenize):
+    """ Split a query into (terms, window) clauses: window is None for a
+    single term, 0 for a phrase and N for a proximity clause "..."~N. Terms
+    are tokenized with tokenize; clauses with no terms are dropped.
+
+    >>> from searcher import Index
+    >>> parse_query('"New York" city "pop song"~3', Index().tokenize)
+    [(['new', 'york'], 0), (['city'], None), (['pop', 'song'], 3)]
+    """
+    clauses = []
+    for phrase, window, word in QUERY_CLAUSE.findall(query):
+        if word:
+            clauses.extend(([term], None) for term in tokenize(word))
+            continue
+        terms = tokenize(phrase)
+        if len(terms) == 1 and not window:
+            clauses.append((terms, None))
+        elif terms:
+            clauses.append((terms, int(window) if window else 0))
+    return clauses
+
+
+def intersect(lists):
+    """ Return the values common to all of the given sorted lists, as a
+    list. The shortest list drives the intersection and the others are
+    galloped through, so long lists are mostly skipped.
+
+    >>> intersect([[1, 4, 6, 9, 12], [4, 9], [0, 4, 5, 9, 10]])
+    [4, 9]
+    >>> intersect([])
+    []
+    """
+    if not lists:
+        return []
+    lists = sorted(lists, key=len)
+    result = list(lists[0])
+    for values in lists[1:]:
+        matched, i = [], 0
+        for value in result:
+            i = gallop(values, value, i)
+            if i == len(values):
+                break
+            if values[i] == value:
+                matched.append(value)
+        result = matched
+    return result
+
+
+class PositionalIndex(object):
+    """
+    The positions of each term in each document:
+
+      term_offsets.......int64 [n_terms+1], start of each term's postings
+      doc_ids............int32 [n_postings], sorted within each term
+      position_offsets...int32 [n_postings+1], start of each posting's positions
+      positions..........int32 [n_tokens], sorted within each posting
+
+    with terms numbered by a lexicon.Lexicon of their own.
+
+    >>> from searcher import Index
+    >>> index = PositionalIndex(['a b a c', 'c a b', 'b'], Index().tokenize)
+    >>> index.postings('a')
+    [(0, [0, 2]), (1, [1])]
+    >>> index.phrase(['a', 'b']).tolist(), index.phrase(['b', 'a']).tolist()
+    ([0, 1], [0])
+    >>> index.near(['c', 'b'], 2), index.near(['c', 'b'], 3)
+    ([], [0, 1])
+    """
+
+    def __init__(self, documents, tokenize):
+        """ Index the positions of the tokens of each document string. """
+        self.lexicon = Lexicon()
+        term_ids, doc_ids, positions = [], [], []
+        for doc_id, document in enumerate(documents):
+            tokens = self.lexicon.encode(tokenize(document))
+            term_ids.append(np.frombuffer(tokens, dtype=np.uint32))
+            doc_ids.append(np.full(len(tokens), doc_id, dtype=np.int32))
+            positions.append(np.arange(len(tokens), dtype=np.int32))
+        term_ids = np.concatenate(term_ids or [np.zeros(0, dtype=np.uint32)])
+        # A stable sort by term keeps each term's tokens in (doc_id, position) order.
+        order = np.argsort(term_ids, kind='stable')
+        term_ids = term_ids[order]
+        doc_ids = np.concatenate(doc_ids or [np.zeros(0, dtype=np.int32)])[order]
+        self.positions = np.concatenate(positions or [np.zeros(0, dtype=np.int32)])[order]
+        starts = np.flatnonzero(np.concatenate(([True], (term_ids[1:] != term_ids[:-1]) |
+                                                (doc_ids[1:] != doc_ids[:-1])))) if len(order) else \
+            np.zeros(0, dtype=np.int64)
+        self.doc_ids = doc_ids[starts]
+        self.position_offsets = np.append(starts, len(order)).astype(np.int32)
+        self.term_offsets = np.searchsorted(term_ids[starts], np.arange(len(self.lexicon) + 1))
+
+    def term_postings(self, term):
+        """ Return the doc ids of term and the start and end of each doc's
+        positions, as arrays (empty if term does not occur). """
+        term_id = self.lexicon.get(term)
+        if term_id is None:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        start, end = self.term_offsets[term_id], self.term_offsets[term_id+1]
+        return (self.doc_ids[start:end], self.position_offsets[start:end],
+                self.position_offsets[start+1:end+1])
+
+    def postings(self, term):
+        """ Return a list of (doc_id, positions) pairs for term. """
+        doc_ids, starts, ends = self.term_postings(term)
+        return [(doc_id, self.positions[start:end].tolist())
+                for doc_id, start, end in zip(doc_ids.tolist(), starts.tolist(), ends.tolist())]
+
+    def occurrences(self, term):
+        """ Return every (doc_id, position) occurrence of term, as one sorted
+        int64 array of doc_id << 32 | position. """
+        doc_ids, starts, ends = self.term_postings(term)
+        if not len(doc_ids):
+            return np.zeros(0, dtype=np.int64)
+        counts = ends - starts
+        return (np.repeat(doc_ids.astype(np.int64), counts) << 32) + self.positions[starts[0]:ends[-1]]
+
+    def phrase(self, terms):
+        """ Return the sorted doc ids of the documents containing terms as a
+        phrase, i.e. at consecutive positions. Each term's occurrences are
+        shifted back by its offset in the phrase, so that the phrase starts
+        are the occurrences common to all terms. """
+        starts = None
+        for offset, term in enumerate(terms):
+            keys = self.occurrences(term)
+            keys = keys[(keys & 0xffffffff) >= offset] - offset
+            starts = keys if starts is None else np.intersect1d(starts, keys, assume_unique=True)
+        if starts is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(starts >> 32)
+
+    def near(self, terms, window, doc_ids=None):
+        """ Return the sorted doc ids of the documents in which every one of
+        terms occurs within some window of that many consecutive positions,
+        in any order. Only the documents containing every term (or, if
+        given, those of doc_ids) are checked. """
+        terms = list(dict.fromkeys(terms))
+        postings = [dict((d, (s, e)) for d, s, e in zip(*(a.tolist() for a in self.term_postings(term))))
+                    for term in terms]
+        candidates = intersect([sorted(p) for p in postings]) if doc_ids is None else \
+            [d for d in doc_ids if all(d in p for p in postings)]
+        matched = []
+        for doc_id in candidates:
+            # The smallest window covering all terms, over the merged
+            # occurrences of the terms in the document.
+            occurrences = sorted((position, i) for i, p in enumerate(postings)
+                                 for position in self.positions[slice(*p[doc_id])].tolist())
+            counts, covered, first = [0] * len(terms), 0, 0
+            for position, i in occurrences:
+                counts[i] += 1
+                covered += counts[i] == 1
+                while covered == len(terms):
+                    if position - occurrences[first][0] < window:
+                        break
+                    counts[occurrences[first][1]] -= 1
+                    covered -= counts[occurrences[first][1]] == 0
+                    first += 1
+                if covered == len(terms):
+                    matched.append(doc_id)
+                    break
+        return matched
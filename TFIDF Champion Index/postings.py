@@ -0,0 +1,698 @@
+""" Compact postings lists for the TF-IDF index.
+
+A postings list is stored as two parallel typed arrays, one of doc ids and
+one of weights, instead of a list of [doc_id, weight] lists. With float32
+weights a posting costs 8 bytes rather than the 100+ bytes of two boxed
+Python numbers inside a list.
+
+CompressedPostings goes further for indexes that are too large for that:
+doc ids are stored as delta-gaps and the weights as the term frequencies
+they were computed from, quantized above TF_EXACT, in blocks of BLOCK_SIZE
+postings bit-packed with the fewest bits each block needs. Lists of more
+than one block keep the last doc id of each block as skip data. Blocks are
+decoded with vectorized NumPy operations. A CompressedPostingsTable packs
+the lists of a whole index into one buffer, so that there is no Python
+object per term until a list is used.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+from itertools import chain
+import math
+from numbers import Integral
+import sys
+
+import numpy as np
+
+BLOCK_SIZE = 128
+# Lists of up to SMALL values are encoded and decoded in pure Python, which
+# is faster than NumPy for so few.
+SMALL = 32
+# The doc id of a PostingsCursor past the end of its list.
+END = sys.maxsize
+# A CompressedPostingsTable keeps the start of one list in every TERM_GROUP.
+TERM_GROUP = 16
+
+
+def gallop(values, target, lo=0):
+    """ Return the first index i >= lo with values[i] >= target (or
+    len(values)), probing lo, lo+1, lo+3, lo+7, ... before a binary search,
+    so that skipping n values costs O(log n).
+
+    >>> gallop([1, 3, 5, 7, 9, 11], 8), gallop([1, 3, 5, 7, 9, 11], 12, 2)
+    (4, 6)
+    """
+    step, hi = 1, lo
+    while hi < len(values) and values[hi] < target:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect_left(values, target, lo, min(hi, len(values)))
+
+
+class Postings(object):
+    """ A postings list backed by contiguous doc id and weight arrays.
+
+    Iterating yields (doc_id, weight) tuples, so code written against the
+    list-of-lists layout (e.g. `for doc_id, weight in index[term]`) works
+    unchanged.
+
+    >>> p = Postings([(0, 0.5), (3, 0.25)])
+    >>> p.append([7, 1.0])
+    >>> len(p)
+    3
+    >>> list(p)
+    [(0, 0.5), (3, 0.25), (7, 1.0)]
+    >>> p[1]
+    (3, 0.25)
+    >>> p.nbytes()
+    24
+    """
+    __slots__ = ('doc_ids', 'weights')
+
+    def __init__(self, pairs=(), typecode='f'):
+        self.doc_ids = array('i')
+        self.weights = array(typecode)
+        for doc_id, weight in pairs:
+            self.doc_ids.append(doc_id)
+            self.weights.append(weight)
+
+    @classmethod
+    def from_arrays(cls, doc_ids, weights):
+        """ Wrap existing doc id and weight sequences (arrays or memoryviews)
+        without copying them. """
+        postings = cls.__new__(cls)
+        postings.doc_ids = doc_ids
+        postings.weights = weights
+        return postings
+
+    @property
+    def typecode(self):
+        """ The array typecode of the weights, e.g. 'f' for float32. """
+        return getattr(self.weights, 'typecode', None) or self.weights.format
+
+    def arrays(self):
+        """ Return the (doc_ids, weights) arrays. """
+        return self.doc_ids, self.weights
+
+    def append(self, posting):
+        doc_id, weight = posting
+        self.doc_ids.append(doc_id)
+        self.weights.append(weight)
+
+    def nbytes(self):
+        """ Return the number of bytes used by the two arrays. """
+        return (len(self.doc_ids) * self.doc_ids.itemsize +
+                len(self.weights) * self.weights.itemsize)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        return zip(self.doc_ids, self.weights)
+
+    def __getitem__(self, i):
+        return (self.doc_ids[i], self.weights[i])
+
+    def __repr__(self):
+        return 'Postings(%r)' % list(self)
+
+
+def encode_varints(values):
+    """ Variable-byte encode a sequence of non-negative integers: 7 bits per
+    byte, least significant first, with the high bit set on every byte but
+    the last of each value.
+
+    >>> encode_varints([1, 127, 128, 300]).hex()
+    '017f8001ac02'
+    """
+    if len(values) <= SMALL:
+        out = bytearray()
+        for value in values:
+            value = int(value)
+            while value >= 0x80:
+                out.append(value & 0x7f | 0x80)
+                value >>= 7
+            out.append(value)
+        return bytes(out)
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for bits in (7, 14, 21, 28, 35, 42, 49, 56, 63):
+        lengths += values >= (1 << bits)
+    ends = np.cumsum(lengths)
+    out = np.zeros(int(ends[-1]), dtype=np.uint8)
+    starts = ends - lengths
+    for i in range(int(lengths.max())):
+        has = lengths > i
+        more = np.where(lengths[has] > i + 1, 0x80, 0).astype(np.uint8)
+        out[starts[has] + i] = ((values[has] >> np.uint64(7 * i)) & np.uint64(0x7f)).astype(np.uint8) | more
+    return out.tobytes()
+
+
+def decode_varints(data):
+    """ Decode the output of encode_varints into an int64 array.
+
+    >>> decode_varints(encode_varints([1, 127, 128, 300]))
+    array([  1, 127, 128, 300])
+    """
+    if len(data) <= SMALL:
+        return np.array(_decode_varints(data), dtype=np.int64)
+    return _decode_varints_numpy(data)
+
+
+def _decode_varints(data):
+    """ decode_varints in pure Python, returning a list. """
+    values, value, shift = [], 0, 0
+    for byte in bytes(data):
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            values.append(value)
+            value, shift = 0, 0
+        else:
+            shift += 7
+    return values
+
+
+def _decode_varints_numpy(data):
+    """ decode_varints with NumPy: each value starts with the byte after the
+    last byte of the previous one, and is assembled from its first, second,
+    ... bytes in turn, for all values at once. """
+    data = np.frombuffer(data, dtype=np.uint8)
+    low = (data & 0x7f).astype(np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    if len(ends) == len(data):  # every value fits in one byte
+        return low
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    values = low[starts]
+    for k in range(1, int((ends - starts).max()) + 1):
+        more = np.flatnonzero(ends - starts >= k)
+        values[more] |= low[starts[more] + k] << (7 * k)
+    return values
+
+
+def read_varint(buf, start):
+    """ Decode one variable-byte encoded value at buf[start]; return it and
+    the position after it.
+
+    >>> read_varint(encode_varints([300, 1]), 0)
+    (300, 2)
+    """
+    value, shift = 0, 0
+    while True:
+        byte = buf[start]
+        start += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, start
+        shift += 7
+
+
+def _tf_bounds():
+    """ Return the smallest term frequency of each tf code, then 2**31. """
+    bounds = list(range(1, TF_EXACT + 2))
+    while bounds[-1] < 2 ** 31:
+        bounds.append(max(bounds[-1] + 1, int(bounds[-1] * 2 ** (1. / TF_STEPS))))
+    bounds[-1] = 2 ** 31
+    return bounds
+
+
+# Term frequencies up to TF_EXACT are stored exactly, as the codes tf - 1;
+# larger ones are quantized to TF_STEPS codes per doubling. A code stands
+# for the geometric middle of its range of tfs, so the tf weight
+# 1 + log10(tf) of a quantized tf is off by about log10(2) / (2 * TF_STEPS)
+# at most.
+TF_EXACT = 64
+TF_STEPS = 2
+TF_BOUNDS = _tf_bounds()
+TF_VALUES = TF_BOUNDS[:TF_EXACT] + [int(round(math.sqrt(lo * (hi - 1))))
+                                    for lo, hi in zip(TF_BOUNDS[TF_EXACT:-1], TF_BOUNDS[TF_EXACT+1:])]
+# 1 + log10(tf) of each code, computed with math.log10 as create_tfidf_index
+# does, as a list and as a NumPy array.
+TF_WEIGHTS = [1 + math.log10(float(tf)) for tf in TF_VALUES]
+TF_WEIGHTS_ARRAY = np.array(TF_WEIGHTS)
+
+
+def tf_codes(tfs):
+    """ Return the code of each term frequency in tfs, as an array.
+
+    >>> codes = tf_codes([1, 2, 64, 65, 100, 1000])
+    >>> codes.tolist(), [TF_VALUES[code] for code in codes]
+    ([0, 1, 63, 64, 65, 71], [1, 2, 64, 76, 108, 854])
+    """
+    return np.searchsorted(TF_BOUNDS, np.asarray(tfs, dtype=np.int64), side='right') - 1
+
+
+def encode_block(values, codes):
+    """ Bit-pack a block: a header byte with the bit width w of the largest
+    of values (up to 31) in its low 5 bits and that of the largest of codes
+    (up to 7) in its high 3, then every value in w bits and every code in
+    its width, least significant bit first.
+
+    >>> encode_block([5, 0, 3], [0, 1, 0]).hex()
+    '23c504'
+    """
+    n = len(values)
+    width = int(max(values)).bit_length() if n else 0
+    code_width = int(max(codes)).bit_length() if n else 0
+    header = bytes([width | code_width << 5])
+    if n <= SMALL:
+        packed, shift = 0, 0
+        for value in values:
+            packed |= int(value) << shift
+            shift += width
+        for code in codes:
+            packed |= int(code) << shift
+            shift += code_width
+        return header + packed.to_bytes((shift + 7) // 8, 'little')
+    bits = [((np.asarray(v, dtype=np.uint64)[:, None] >> np.arange(w, dtype=np.uint64)) & np.uint64(1))
+            .astype(np.uint8).ravel() for v, w in ((values, width), (codes, code_width))]
+    return header + np.packbits(np.concatenate(bits), bitorder='little').tobytes()
+
+
+# The value of each bit of a bit-packed value of up to 31 bits.
+_POWERS = [np.left_shift(1, np.arange(width, dtype=np.int64)) for width in range(32)]
+
+
+def block_nbytes(data, start, n):
+    """ Return the size of the block of n values at data[start]. """
+    header = data[start]
+    return 1 + (n * ((header & 0x1f) + (header >> 5)) + 7) // 8
+
+
+def decode_block(data, n):
+    """ Decode a block of n values written by encode_block into (values,
+    codes), as lists if n <= SMALL and as int64 arrays otherwise.
+
+    >>> decode_block(encode_block([5, 0, 3], [0, 1, 0]), 3)
+    ([5, 0, 3], [0, 1, 0])
+    """
+    header = data[0]
+    width, code_width = header & 0x1f, header >> 5
+    payload = data[1:1 + (n * (width + code_width) + 7) // 8]
+    if n <= SMALL:
+        packed = int.from_bytes(payload, 'little')
+        mask = (1 << width) - 1
+        values = [(packed >> (i * width)) & mask for i in range(n)]
+        packed >>= n * width
+        mask = (1 << code_width) - 1
+        return values, [(packed >> (i * code_width)) & mask for i in range(n)]
+    bits = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=n * (width + code_width),
+                         bitorder='little')
+    split = n * width
+    values = bits[:split].reshape(n, width).dot(_POWERS[width]) if width else np.zeros(n, dtype=np.int64)
+    if not code_width:
+        return values, np.zeros(n, dtype=np.int64)
+    return values, bits[split:].reshape(n, code_width).dot(_POWERS[code_width])
+
+
+class CompressedPostings(object):
+    """ A postings list of a tf-idf index, compressed.
+
+    The doc ids are stored as gaps from the previous doc id (from -1 for the
+    first), and the weights as codes of the term frequencies they were
+    computed from (see tf_codes); a weight is decoded as
+    (1 + log10(tf)) * log10(n_docs / df), with df the length of the list,
+    rounded to the float type of typecode. For tfs up to TF_EXACT that is
+    exactly the weight a Postings of that typecode built by
+    create_tfidf_index holds.
+
+    The postings are cut into blocks of BLOCK_SIZE, each bit-packed with
+    the fewest bits that hold its largest gap (less one) and its largest
+    code (see encode_block); a block of consecutive doc ids with tf 1 is
+    only its header byte. Lists of more than one block also keep the last
+    doc id and the start of every block, so that find can skip to the one
+    block that can contain a doc id.
+
+    Iterating, or calling blocks, decodes one block at a time. arrays (or
+    doc_ids and weights) decodes the whole list into arrays like those of
+    Postings.
+
+    >>> p = CompressedPostings([3, 4, 200], [1, 10, 2], n_docs=20, block_size=2)
+    >>> list(p)  # doctest:+ELLIPSIS
+    [(3, 0.82390...), (4, 1.64781...), (200, 1.07192...)]
+    >>> p.doc_ids
+    array('i', [3, 4, 200])
+    >>> p.block_last, p.find(200) == list(p)[2], p.find(5)
+    (array('i', [4, 200]), True, None)
+    >>> len(p.data), len(p.to_bytes())
+    (6, 28)
+    >>> list(CompressedPostings.from_bytes(p.to_bytes(), 20, block_size=2)) == list(p)
+    True
+    """
+    __slots__ = ('length', 'n_docs', 'typecode', 'block_size', 'block_last',
+                 'block_offsets', 'data')
+
+    def __init__(self, doc_ids, tfs, n_docs, typecode='f', block_size=BLOCK_SIZE):
+        """ Compress the postings of doc_ids (sorted) with term frequencies tfs
+        in an index of n_docs documents. """
+        self.length = len(doc_ids)
+        self.n_docs = n_docs
+        self.typecode = typecode
+        self.block_size = block_size
+        self.block_last = self.block_offsets = None
+        if self.small():
+            gaps, previous = [], -1
+            for doc_id in doc_ids:
+                gaps.append(doc_id - previous - 1)
+                previous = doc_id
+            codes = [tf - 1 if tf <= TF_EXACT else bisect_right(TF_BOUNDS, tf) - 1 for tf in tfs]
+            self.data = encode_block(gaps, codes)
+            return
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        gaps = np.diff(doc_ids, prepend=-1) - 1
+        codes = tf_codes(tfs)
+        blocks = [encode_block(gaps[i:i+block_size], codes[i:i+block_size])
+                  for i in range(0, self.length, block_size)]
+        self.data = b''.join(blocks)
+        if len(blocks) > 1:
+            self.block_last = array('i', doc_ids[block_size - 1::block_size].tolist())
+            if self.length % block_size:
+                self.block_last.append(int(doc_ids[-1]))
+            self.block_offsets = array('I', [0])
+            for block in blocks:
+                self.block_offsets.append(self.block_offsets[-1] + len(block))
+
+    @classmethod
+    def from_bytes(cls, buf, n_docs, typecode='f', block_size=BLOCK_SIZE):
+        """ Read a list written by to_bytes. The data is a view into buf, not
+        a copy. """
+        buf = memoryview(buf)
+        postings = cls.__new__(cls)
+        postings.n_docs = n_docs
+        postings.typecode = typecode
+        postings.block_size = block_size
+        postings.length, start = read_varint(buf, 0)
+        postings.block_last = postings.block_offsets = None
+        n_blocks = -(-postings.length // block_size)
+        if n_blocks > 1:
+            _, start = read_varint(buf, start)
+            postings.block_last = buf[start:start + 4 * n_blocks].cast('i')
+            start += 4 * n_blocks
+            postings.block_offsets = buf[start:start + 4 * (n_blocks + 1)].cast('I')
+            start += 4 * (n_blocks + 1)
+        postings.data = buf[start:]
+        return postings
+
+    @staticmethod
+    def end(buf, start, block_size=BLOCK_SIZE):
+        """ Return the position after the list written by to_bytes at
+        buf[start], reading only its header. """
+        length, start = read_varint(buf, start)
+        if length > block_size:
+            size, start = read_varint(buf, start)
+            return start + size
+        return start + block_nbytes(buf, start, length)
+
+    def to_bytes(self):
+        """ Serialize the list: its length, variable-byte encoded; for a list
+        of more than one block, the number of bytes that follow (also
+        variable-byte encoded) and the skip data as the block_last and
+        block_offsets arrays, in native byte order, so that from_bytes can
+        use them without decoding; then the blocks. """
+        if self.block_last is None:
+            return encode_varints([self.length]) + bytes(self.data)
+        skips = bytes(self.block_last) + bytes(self.block_offsets)
+        return (encode_varints([self.length, len(skips) + len(self.data)]) + skips +
+                bytes(self.data))
+
+    def n_blocks(self):
+        return -(-self.length // self.block_size)
+
+    def small(self):
+        """ Whether the list is a single block short enough to decode in
+        pure Python (see decode_small). """
+        return self.length <= SMALL and self.length <= self.block_size
+
+    def decode_small(self):
+        """ Return the doc ids and weights of a small list as a list and an
+        array, with the same values decode would give. """
+        gaps, codes = decode_block(self.data, self.length)
+        doc_ids, doc_id = [], -1
+        for gap in gaps:
+            doc_id += gap + 1
+            doc_ids.append(doc_id)
+        idf = math.log10(float(self.n_docs) / self.length)
+        return doc_ids, array(self.typecode, [TF_WEIGHTS[code] * idf for code in codes])
+
+    def decode(self, start_block=0, end_block=None):
+        """ Return the doc ids and weights of blocks start_block up to
+        end_block (by default the last) as NumPy arrays. """
+        if end_block is None:
+            end_block = self.n_blocks()
+        if start_block >= end_block:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=self.typecode)
+        if self.block_offsets is None:
+            gaps, codes = decode_block(self.data, self.length)
+        elif end_block - start_block == 1:
+            gaps, codes = decode_block(self.data[self.block_offsets[start_block]:
+                                                 self.block_offsets[end_block]],
+                                       min(self.block_size, self.length - start_block * self.block_size))
+        else:
+            gaps, codes = self.decode_blocks(start_block, end_block)
+        gaps, codes = np.asarray(gaps, dtype=np.int64), np.asarray(codes, dtype=np.int64)
+        gaps += 1
+        gaps[0] += self.block_last[start_block - 1] if start_block else -1
+        idf = math.log10(float(self.n_docs) / self.length)
+        return np.cumsum(gaps), (TF_WEIGHTS_ARRAY[codes] * idf).astype(self.typecode)
+
+    def decode_blocks(self, start_block, end_block):
+        """ Return the gaps (less one) and codes of blocks start_block up to
+        end_block as arrays, decoded together. Each block is taken as two
+        runs of equally wide values, its gaps and its codes, and every value
+        is read as the 8 bytes starting at the byte of its first bit,
+        shifted and masked to the width of its run, for all values at
+        once. """
+        start, end = self.block_offsets[start_block], self.block_offsets[end_block]
+        data = np.zeros(end - start + 8, dtype=np.uint8)
+        data[:end - start] = np.frombuffer(self.data[start:end], dtype=np.uint8)
+        # The (unaligned) 8-byte word starting at each byte.
+        words = np.ndarray((end - start + 1,), dtype='<u8', buffer=data, strides=(1,))
+        offsets = np.frombuffer(self.block_offsets, dtype=np.uint32)[start_block:end_block] - start
+        headers = data[offsets].astype(np.int64)
+        sizes = np.full(end_block - start_block, self.block_size, dtype=np.int64)
+        sizes[-1] = min(self.block_size, self.length - (end_block - 1) * self.block_size)
+        # The runs of the blocks in turn: the gaps, then the codes, of each.
+        widths = np.column_stack((headers & 0x1f, headers >> 5)).ravel()
+        runs = np.repeat(sizes, 2)
+        bases = 8 * np.repeat(offsets.astype(np.int64), 2) + 8
+        bases[1::2] += sizes * widths[::2]
+        index = np.arange(2 * int(sizes.sum())) - np.repeat(np.cumsum(runs) - runs, runs)
+        positions = np.repeat(bases, runs) + index * np.repeat(widths, runs)
+        masks = np.array([(1 << width) - 1 for width in widths.tolist()], dtype=np.uint64)
+        values = ((words[positions >> 3] >> (positions & 7).astype(np.uint64)) &
+                  np.repeat(masks, runs)).astype(np.int64)
+        is_gap = np.repeat(np.tile([True, False], len(sizes)), runs)
+        return values[is_gap], values[~is_gap]
+
+    def blocks(self):
+        """ Yield the (doc_ids, weights) arrays of each block in turn. """
+        for block in range(self.n_blocks()):
+            yield self.decode(block, block + 1)
+
+    def find(self, doc_id):
+        """ Return the (doc_id, weight) posting of doc_id, or None. Only the
+        block that can contain it is decoded. """
+        if self.small():
+            doc_ids, weights = self.decode_small()
+            i = bisect_left(doc_ids, doc_id)
+            if i == len(doc_ids) or doc_ids[i] != doc_id:
+                return None
+            return (doc_id, weights[i])
+        block = 0 if self.block_last is None else bisect_left(self.block_last, doc_id)
+        if block == self.n_blocks():
+            return None
+        doc_ids, weights = self.decode(block, block + 1)
+        i = np.searchsorted(doc_ids, doc_id)
+        if i == len(doc_ids) or doc_ids[i] != doc_id:
+            return None
+        return (doc_id, weights[i].item())
+
+    def arrays(self):
+        """ Decode the whole list into (doc_ids, weights) arrays like those of
+        Postings. """
+        if self.small():
+            doc_ids, weights = self.decode_small()
+            return array('i', doc_ids), weights
+        doc_ids, weights = self.decode()
+        res = array('i', doc_ids.astype(np.int32).tobytes()), array(self.typecode)
+        res[1].frombytes(weights.tobytes())
+        return res
+
+    @property
+    def doc_ids(self):
+        return self.arrays()[0]
+
+    @property
+    def weights(self):
+        return self.arrays()[1]
+
+    def nbytes(self):
+        """ Return the number of bytes used by the data and skip tables. """
+        if self.block_last is None:
+            return len(self.data)
+        return len(self.data) + 4 * len(self.block_last) + 4 * len(self.block_offsets)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        if self.small():
+            return zip(*self.decode_small())
+        return chain.from_iterable(zip(doc_ids.tolist(), weights.tolist())
+                                   for doc_ids, weights in self.blocks())
+
+    def __repr__(self):
+        return 'CompressedPostings(%r)' % list(self)
+
+
+class PostingsCursor(object):
+    """ A cursor over a postings list, for document-at-a-time evaluation.
+    doc_id and weight are those of the current posting (doc_id is END once
+    the list is used up); next() moves to the following posting and
+    seek(doc_id) to the first one with a doc id of at least doc_id. Both
+    return the new doc_id.
+
+    seek skips the postings in between: it gallops through the decoded
+    postings, and in a CompressedPostings list it first looks up the block
+    to land in in the skip data (the last doc id of each block), so only
+    the blocks a cursor stops in are decoded.
+
+    >>> cursor = PostingsCursor(Postings([(1, .5), (4, .25), (9, 1.)]))
+    >>> cursor.doc_id, cursor.seek(4), cursor.weight, cursor.seek(5), cursor.next() == END
+    (1, 4, 0.25, 9, True)
+    >>> postings = CompressedPostings(range(0, 1000, 2), [1] * 500, 1000, block_size=64)
+    >>> cursor = PostingsCursor(postings)
+    >>> cursor.seek(501), cursor.block, cursor.next(), cursor.seek(2000) == END
+    (502, 3, 504, True)
+    """
+
+    __slots__ = ('postings', 'block', 'doc_ids', 'weights', 'i', 'doc_id', 'weight', 'length')
+
+    def __init__(self, postings):
+        """ Create a cursor on the first posting of postings: a Postings, a
+        CompressedPostings or a list of [doc_id, weight] lists. """
+        self.length = len(postings)
+        self.postings = None
+        self.block = 0
+        if isinstance(postings, CompressedPostings) and not postings.small():
+            self.postings = postings
+            self.load(0)
+        elif isinstance(postings, (Postings, CompressedPostings)):
+            self.doc_ids, self.weights = postings.arrays()
+        else:
+            self.doc_ids = [p[0] for p in postings]
+            self.weights = [p[1] for p in postings]
+        self.move(0)
+
+    def load(self, block):
+        """ Decode block of a CompressedPostings list. """
+        self.block = block
+        doc_ids, weights = self.postings.decode(block, block + 1)
+        self.doc_ids, self.weights = doc_ids.tolist(), weights.tolist()
+
+    def move(self, i):
+        """ Move to posting i of the current block, or past the end of it to
+        the first posting of the next block. """
+        while i >= len(self.doc_ids):
+            if self.postings is None or self.block + 1 >= self.postings.n_blocks():
+                self.i, self.doc_id, self.weight = len(self.doc_ids), END, None
+                return END
+            self.load(self.block + 1)
+            i = 0
+        self.i, self.doc_id, self.weight = i, self.doc_ids[i], self.weights[i]
+        return self.doc_id
+
+    def next(self):
+        return self.move(self.i + 1)
+
+    def seek(self, doc_id):
+        if doc_id <= self.doc_id:
+            return self.doc_id
+        if self.postings is not None and doc_id > self.doc_ids[-1]:
+            n_blocks = self.postings.n_blocks()
+            if self.postings.block_last is None:
+                return self.move(len(self.doc_ids))
+            block = bisect_left(self.postings.block_last, doc_id, self.block + 1)
+            if block == n_blocks:
+                self.block = n_blocks - 1
+                return self.move(len(self.doc_ids))
+            self.load(block)
+            return self.move(gallop(self.doc_ids, doc_id))
+        return self.move(gallop(self.doc_ids, doc_id, self.i))
+
+
+class CompressedPostingsTable(Mapping):
+    """ A read-only mapping from term id to CompressedPostings, backed by one
+    buffer holding CompressedPostings.to_bytes() of each list in turn (in
+    memory, or in an index file; see storage.py). Lists are decoded from
+    the buffer on access.
+
+    Only the start of every TERM_GROUP-th list is kept in offsets (followed
+    by the end of the buffer); a list is found by skipping the lists before
+    it in its group, which only reads their headers.
+
+    >>> table = CompressedPostingsTable.pack([CompressedPostings([0, 2], [1, 3], 10),
+    ...                                       CompressedPostings([1], [1], 10)])
+    >>> list(table[1]), list(table.offsets), len(table), 2 in table
+    ([(1, 1.0)], [0, 6], 2, False)
+    >>> table.length(0)
+    2
+    """
+
+    def __init__(self, offsets, data, n_terms, n_docs, typecode='f'):
+        self.offsets = offsets
+        self.data = data
+        self.n_terms = n_terms
+        self.n_docs = n_docs
+        self.typecode = typecode
+
+    @classmethod
+    def pack(cls, postings):
+        """ Pack a sequence of CompressedPostings (of the same index), in term
+        id order. """
+        offsets, blob = array('Q', [0]), bytearray()
+        n_terms, n_docs, typecode = 0, 0, 'f'
+        for p in postings:
+            blob += p.to_bytes()
+            n_terms += 1
+            if n_terms % TERM_GROUP == 0:
+                offsets.append(len(blob))
+            n_docs, typecode = p.n_docs, p.typecode
+        if n_terms % TERM_GROUP:
+            offsets.append(len(blob))
+        return cls(offsets, bytes(blob), n_terms, n_docs, typecode)
+
+    def nbytes(self):
+        """ Return the number of bytes used by the buffer and the offsets. """
+        return len(self.data) + 8 * len(self.offsets)
+
+    def __contains__(self, term_id):
+        return isinstance(term_id, Integral) and 0 <= term_id < len(self)
+
+    def start(self, term_id):
+        """ Return the position of the postings of term_id in the buffer. """
+        start = self.offsets[term_id // TERM_GROUP]
+        for _ in range(term_id % TERM_GROUP):
+            start = CompressedPostings.end(self.data, start)
+        return start
+
+    def length(self, term_id):
+        """ Return the length of the postings of term_id, without decoding
+        them. """
+        return read_varint(self.data, self.start(term_id))[0]
+
+    def __getitem__(self, term_id):
+        if term_id not in self:
+            raise KeyError(term_id)
+        start = self.start(term_id)
+        end = CompressedPostings.end(self.data, start)
+        return CompressedPostings.from_bytes(memoryview(self.data)[start:end],
+                                             self.n_docs, self.typecode)
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __len__(self):
+        return self.n_terms
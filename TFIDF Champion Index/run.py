@@ -5,24 +5,79 @@ Run with `python run.py`. If successful, you should see a message like:
 Running on http://127.0.0.1:5000/ . You can then view the page in your web
 browser at the specified URL.
 
-You should not need to modify this file.
+If the file named by the INDEX_PATH environment variable (default
+documents.idx) exists, the index is memory-mapped from it instead of being
+rebuilt from documents.txt.gz. Create it with
+`python storage.py documents.txt.gz documents.idx`.
+
+Results and their rendered HTML are kept in an LRU cache of CACHE_SIZE
+entries (default 1024), each valid for CACHE_TTL seconds (default: until
+the index changes). Its counters are served at /cache.
+
+JSON endpoints, for other services and load balancers:
+  GET  /api/search?q=QUERY&k=10&champion=0
+  POST /api/batch  {"queries": [QUERY, ...], "k": 10, "champion": false}
+  GET  /healthz    liveness and index summary
+For a multi-process server sharing one memory-mapped index, see serve.py.
 """
+import os
+
 from flask import Flask
+from flask import jsonify
 from flask import request
 
+from cache import ResultCache
 from searcher import Index
 
+INDEX_PATH = os.environ.get('INDEX_PATH', 'documents.idx')
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', 1024))
+CACHE_TTL = float(os.environ['CACHE_TTL']) if os.environ.get('CACHE_TTL') else None
+
 app = Flask(__name__)
-my_index = Index('documents.txt.gz')
+if os.path.exists(INDEX_PATH):
+    my_index = Index.load(INDEX_PATH)
+else:
+    my_index = Index('documents.txt.gz')
+results_cache = ResultCache(CACHE_SIZE, CACHE_TTL)
 
 
 def results2string(doc_ids):
     """ Return the top 100 search results as a string of <p> blocks, looking up each
     doc_id in the index. """
-    res = ''
-    for doc_id, score in doc_ids[:100]:
-        res += "<p>%d: <b>%e</b> %s </p>" % (doc_id, score, my_index.documents[doc_id])
-    return res
+    return ''.join("<p>%d: <b>%e</b> %s </p>" % (doc_id, score, my_index.documents[doc_id])
+                   for doc_id, score in doc_ids[:100])
+
+
+def cached_search(query, champ):
+    """ Return the top 100 (doc_id, score) results for query and their HTML,
+    from the cache if the same tokens were searched for before. """
+    key = (tuple(my_index.tokenize(query)), champ)
+    generation = my_index.generation
+    entry = results_cache.get(key, generation)
+    if entry is None:
+        results = my_index.search(query, champ, k=100)
+        entry = (results, results2string(results))
+        results_cache.put(key, entry, generation)
+    return entry
+
+
+def top_k(query, champ, k):
+    """ Return the top k (doc_id, score) results for query, using the result
+    cache when k is within the cached top 100. """
+    if k <= 100:
+        return cached_search(query, champ)[0][:k]
+    return my_index.search(query, champ, k=k)
+
+
+def results2json(results):
+    """ Return search results as a list of JSON-ready dicts. """
+    return [{'doc_id': doc_id, 'score': score, 'document': my_index.documents[doc_id]}
+            for doc_id, score in results]
+
+
+def parse_flag(value):
+    """ Interpret a query string or JSON value as a boolean. """
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
 
 
 def form():
@@ -45,10 +100,56 @@ def index():
     result = "<html>\n<body>" + form()
     if request.method == 'POST':  # Respond to search request.
         champ = 'champion' in request.form
-        result += results2string(my_index.search(request.form['query'], champ))
+        result += cached_search(request.form['query'], champ)[1]
     result += "<body></html>"
     return result
 
 
+@app.route('/api/search')
+def api_search():
+    """ Return the top k results for the query parameter q as JSON. """
+    query = request.args.get('q', '')
+    k = request.args.get('k', '10')
+    try:
+        k = int(k)
+    except ValueError:
+        k = -1
+    if k < 0:
+        return jsonify({'error': 'k must be a non-negative integer'}), 400
+    champ = parse_flag(request.args.get('champion', ''))
+    return jsonify({'query': query, 'k': k, 'champion': champ,
+                    'results': results2json(top_k(query, champ, k))})
+
+
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    """ Run a list of queries posted as JSON, returning one result list per
+    query, in order. """
+    body = request.get_json(silent=True) or {}
+    queries, k = body.get('queries'), body.get('k', 10)
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        return jsonify({'error': 'queries must be a list of strings'}), 400
+    if not isinstance(k, int) or isinstance(k, bool) or k < 0:
+        return jsonify({'error': 'k must be a non-negative integer'}), 400
+    champ = parse_flag(body.get('champion', False))
+    return jsonify({'k': k, 'champion': champ,
+                    'results': [results2json(top_k(q, champ, k)) for q in queries]})
+
+
+@app.route('/healthz')
+def healthz():
+    """ Liveness and readiness check. The index is loaded before the app can
+    serve requests, so any response means the process is ready. """
+    return jsonify({'status': 'ok', 'pid': os.getpid(),
+                    'documents': len(my_index.documents),
+                    'generation': my_index.generation})
+
+
+@app.route('/cache')
+def cache_stats():
+    """ Report the result cache's size and hit/miss counters. """
+    return jsonify(results_cache.stats())
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -11,28 +11,126 @@ query and the document (normalized only by the document length, not the query
 length, as in the examples in class).
 
 The search method also supports a use_champion parameter, which will use a
-champion list (with threshold 10) to perform the search.
+champion list (with threshold 10) to perform the search, and a use_tiers
+parameter, which searches tiers of impact-ordered postings (see
+create_tiered_index) until the top k are settled.
+
+The search method scores every document containing any query term. The
+search_boolean method only returns documents containing all of them, and
+supports "quoted phrases" and "proximity"~N clauses (see positions.py),
+using a positional index that is built the first time a query needs it.
+
+By default the postings are stored compactly (see postings.Postings): each
+term maps to a pair of contiguous doc id / float32 weight arrays rather than
+a list of [doc_id, weight] lists. With compress=True they are compressed
+further (see postings.CompressedPostings), at some cost in query time.
+
+An index built from a file keys its postings, champion lists, document
+frequencies and score bounds by integer term id (see lexicon.Lexicon), in
+tables indexed by term id (lexicon.TermTable), so query vectors are keyed by
+term id too. Indexes assembled by hand from tokenized documents, with no
+lexicon, are keyed by term.
 
 """
-from collections import defaultdict
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
 import codecs
 import gzip
+import heapq
 import math
+import multiprocessing
 import re
 
+import numpy as np
+
+from lexicon import Lexicon, TermTable
+from positions import PositionalIndex, intersect, parse_query
+from postings import (END, CompressedPostings, CompressedPostingsTable, Postings, PostingsCursor,
+                      gallop)
+import storage
+
 class Index(object):
 
-    def __init__(self, filename=None, champion_threshold=10):
-        """ DO NOT MODIFY.
+    max_scores = None
+    tiered_index = tier_bounds = None
+    positions = None  # the positional index, built by positional_index when first needed
+    positions_generation = None
+    lexicon = None  # maps terms to the term ids the index is keyed by, if any
+    generation = 0  # incremented whenever the indexed documents change
+
+    def __init__(self, filename=None, champion_threshold=10, compact=True, workers=1,
+                 compress=False, tier_thresholds=None):
+        """
         Create a new index by parsing the given file containing documents,
-        one per line. You should not modify this. """
+        one per line. If compact is True the postings are stored as
+        postings.Postings arrays, otherwise as lists of [doc_id, weight]
+        lists; if compress is True they are postings.CompressedPostings
+        instead, with the same weights as compact ones (up to a term
+        frequency of postings.TF_EXACT, above which term frequencies are
+        quantized), packed into a postings.CompressedPostingsTable. With
+        workers > 1, tokenizing and counting are spread over that many
+        processes (see create_tfidf_index_parallel); the index is the same
+        for any number of workers.
+
+        champion_threshold and each of tier_thresholds are a number of
+        postings, or a function from a term's document frequency to one (see
+        tier_size). If tier_thresholds is given, the tiered index used by
+        search(use_tiers=True) is built too (see create_tiered_index). """
+        self.champion_threshold = champion_threshold
         if filename:  # filename may be None for testing purposes.
             self.documents = self.read_lines(filename)
-            toked_docs = [self.tokenize(d) for d in self.documents]
-            self.doc_freqs = self.count_doc_frequencies(toked_docs)
-            self.index = self.create_tfidf_index(toked_docs, self.doc_freqs)
+            self.lexicon = Lexicon()
+            if workers > 1:
+                doc_freqs, index = self.create_tfidf_index_parallel(
+                    self.documents, workers, compact, self.lexicon, compress)
+            else:
+                toked_docs = [self.lexicon.encode(self.tokenize(d)) for d in self.documents]
+                doc_freqs = self.count_doc_frequencies(toked_docs)
+                index = self.create_tfidf_index(toked_docs, doc_freqs, compact, compress)
+                del toked_docs
+            self.doc_freqs = TermTable(doc_freqs, 'i')
+            self.index = TermTable(index)
+            if compress:
+                self.index = CompressedPostingsTable.pack(self.index.values())
             self.doc_lengths = self.compute_doc_lengths(self.index)
-            self.champion_index = self.create_champion_index(self.index, champion_threshold)
+            self.champion_index = TermTable(self.create_champion_index(self.index, champion_threshold))
+            self.max_scores = TermTable(self.compute_max_scores(self.index, self.doc_lengths), 'd')
+            if tier_thresholds is not None:
+                self.tiered_index, self.tier_bounds = self.create_tiered_index(
+                    self.index, self.doc_lengths, tier_thresholds)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """ Load an index written by save. With mmap=True the file is
+        memory-mapped, so loading takes constant time and processes that load
+        the same file share its pages. The loaded index is read-only. """
+        indexer = cls()
+        vars(indexer).update(storage.read_index(path, mmap))
+        return indexer
+
+    def save(self, path):
+        """ Write this index to path in the format described in storage.py.
+
+        >>> import os, tempfile
+        >>> indexer = Index()
+        >>> indexer.documents = ['a b a', 'a c']
+        >>> toked_docs = [indexer.tokenize(d) for d in indexer.documents]
+        >>> indexer.doc_freqs = indexer.count_doc_frequencies(toked_docs)
+        >>> indexer.index = indexer.create_tfidf_index(toked_docs, indexer.doc_freqs, True)
+        >>> indexer.doc_lengths = indexer.compute_doc_lengths(indexer.index)
+        >>> indexer.champion_index = indexer.create_champion_index(indexer.index, 10)
+        >>> path = os.path.join(tempfile.mkdtemp(), 'test.idx')
+        >>> indexer.save(path)
+        >>> loaded = Index.load(path)
+        >>> loaded.documents[1]
+        'a c'
+        >>> loaded.search('b c') == indexer.search('b c')
+        True
+        >>> loaded.search('b c', k=1) == indexer.search('b c')[:1]
+        True
+        """
+        storage.write_index(self, path)
 
     def compute_doc_lengths(self, index):
         """
@@ -59,11 +157,32 @@ class Index(object):
         
         return res
     
+    def compute_max_scores(self, index, doc_lengths):
+        """
+        Return a dict mapping each term to the largest length-normalized
+        weight (tf-idf weight / document length) in its postings list. This is
+        the most a query term of weight 1 can add to any document's cosine
+        score, and lets search_by_max_score skip documents that cannot reach
+        the top k.
+
+        >>> Index().compute_max_scores({'a': [[0, 3], [1, 2]]}, {0: 6., 1: 2.})
+        {'a': 1.0}
+        """
+        res = {}
+        for term in index.keys():
+            best = 0.0
+            for doc_id, weight in index[term]:
+                if weight > 0:
+                    best = max(best, weight / float(doc_lengths[doc_id]))
+            res[term] = best
+        return res
+
     def create_champion_index(self, index, threshold=10):
         """
         Create an index mapping each term to its champion list, defined as the
         documents with the K highest tf-idf values for that term (the
-        threshold parameter determines K).
+        threshold parameter determines K, see tier_size). Ties keep their
+        postings order.
 
         In the example below, the champion list for term 'a' contains
         documents 1 and 2; the champion list for term 'b' contains documents 0
@@ -72,20 +191,92 @@ class Index(object):
         >>> champs = Index().create_champion_index({'a': [[0, 10], [1, 20], [2, 15]], 'b': [[0, 20], [1, 15], [2, 10]]}, 2)
         >>> champs['a']
         [[1, 20], [2, 15]]
+
+        Compact or compressed postings produce compact champion lists:
+
+        >>> champs = Index().create_champion_index({'a': Postings([(0, 1), (1, 2)])}, 1)
+        >>> champs['a']
+        Postings([(1, 2.0)])
+
+        The threshold can depend on the document frequency:
+
+        >>> champs = Index().create_champion_index({'a': [[0, 10], [1, 20], [2, 15]], 'b': [[0, 20]]}, lambda df: df - 1)
+        >>> champs['a'], champs['b']
+        ([[1, 20], [2, 15]], [])
         """
         res = defaultdict(list)
         for term in list(index.keys()):
-            doc_list = []
-            for item in index[term]:
-                doc_list.append((item[0],item[1]))
-            doc_list.sort(key = lambda tup: tup[1],reverse = True)
-            doc_list = doc_list[:threshold]
+            postings = index[term]
+            # nlargest is documented to equal sorted(...)[:n], ties included.
+            doc_list = heapq.nlargest(tier_size(threshold, len(postings)),
+                                      ((item[0], item[1]) for item in postings),
+                                      key=lambda tup: tup[1])
+            if isinstance(postings, (Postings, CompressedPostings)):
+                res[term] = Postings(doc_list, postings.typecode)
+                continue
             for items in doc_list:
                 res[term].append([items[0],items[1]])
         
         return res
 
-    def create_tfidf_index(self, docs, doc_freqs):
+    def create_tiered_index(self, index, doc_lengths, thresholds=(10, 100)):
+        """
+        Split each postings list into tiers by impact, the length-normalized
+        weight (weight / document length) that a posting adds to a cosine
+        score for a query term of weight 1: the first tier holds the
+        thresholds[0] postings with the highest impacts, the second the next
+        ones up to thresholds[1], and so on; the last tier holds the rest, so
+        the tiers together hold every posting. Each threshold is a number of
+        postings or a function of the document frequency (see tier_size).
+        The first tiers are in order of decreasing impact, the last in doc_id
+        order. Terms with no postings in a tier are left out of it.
+
+        Also return, for every tier but the last, a dict from term to the
+        largest impact in the tiers after it: the most a query term of
+        weight 1 can add to a document's score once that tier has been
+        searched.
+
+        Returns:
+        A (tiers, bounds) tuple of a list of len(thresholds) + 1 dicts from
+        term to postings list, and a list of len(thresholds) dicts.
+
+        >>> index = {'a': [[0, 1], [1, 4], [2, 2], [3, 3]], 'b': [[2, 1]]}
+        >>> tiers, bounds = Index().create_tiered_index(index, {0: 1, 1: 1, 2: 1, 3: 2}, (1, 2))
+        >>> [tier['a'] for tier in tiers]
+        [[[1, 4]], [[2, 2]], [[0, 1], [3, 3]]]
+        >>> bounds
+        [{'a': 2.0, 'b': 0.0}, {'a': 1.5, 'b': 0.0}]
+        """
+        tiers = [{} for _ in range(len(thresholds) + 1)]
+        bounds = [{} for _ in thresholds]
+        for term in index.keys():
+            postings = index[term]
+            sizes, size = [], 0
+            for threshold in thresholds:
+                size = max(size, tier_size(threshold, len(postings)))
+                sizes.append(size)
+            best = heapq.nlargest(size, ((item[0], item[1]) for item in postings),
+                                  key=lambda tup: tup[1] / float(doc_lengths[tup[0]]))
+            chosen = set(doc_id for doc_id, _ in best)
+            parts = [best[start:end] for start, end in zip([0] + sizes, sizes)]
+            parts.append([(doc_id, weight) for doc_id, weight in postings if doc_id not in chosen])
+            bound = 0.0
+            for t in range(len(parts) - 1, -1, -1):
+                if t < len(bounds):
+                    bounds[t][term] = bound
+                for doc_id, weight in parts[t]:
+                    if weight > 0:
+                        bound = max(bound, weight / float(doc_lengths[doc_id]))
+            for t, part in enumerate(parts):
+                if not part:
+                    continue
+                if isinstance(postings, (Postings, CompressedPostings)):
+                    tiers[t][term] = Postings(part, postings.typecode)
+                else:
+                    tiers[t][term] = [[doc_id, weight] for doc_id, weight in part]
+        return tiers, bounds
+
+    def create_tfidf_index(self, docs, doc_freqs, compact=False, compress=False, n_docs=None):
         """
         Create an index in which each postings list contains a list of
         [doc_id, tf-idf weight] pairs. For example:
@@ -100,6 +291,14 @@ class Index(object):
         Parameters:
         docs........list of lists, where each sublist contains the tokens for one document.
         doc_freqs...dict from term to document frequency (see count_doc_frequencies).
+        compact.....if True, each postings list is a postings.Postings with
+                    float32 weights instead of a list of lists.
+        compress....if True, each postings list is a
+                    postings.CompressedPostings, whatever compact is.
+        n_docs......number of documents in the collection, if docs are only
+                    part of it (as for the shards of sharded.ShardedIndex);
+                    by default len(docs). Not supported with compress, as
+                    compressed postings derive the IDF from their length.
 
         Use math.log10 (log base 10).
 
@@ -110,19 +309,112 @@ class Index(object):
         [[0, 0.0], [1, 0.0]]
         >>> index['b']  # doctest:+ELLIPSIS
         [[0, 0.3010299956639812]]
+        >>> index = Index().create_tfidf_index([['a', 'b', 'a'], ['a']], {'a': 2., 'b': 1., 'c': 1.}, compact=True)
+        >>> index['b']  # doctest:+ELLIPSIS
+        Postings([(0, 0.30103...)])
+        >>> index = Index().create_tfidf_index([['a', 'b', 'a'], ['a']], {'a': 2., 'b': 1., 'c': 1.}, compress=True)
+        >>> index['b']  # doctest:+ELLIPSIS
+        CompressedPostings([(0, 0.30103...)])
         """
-        
-        res = defaultdict(list)
+        if n_docs is None:
+            n_docs = len(docs)
+        elif compress:
+            raise ValueError('compressed postings cannot be weighted for a larger collection')
+        if compress:
+            tf_index = defaultdict(lambda: (array('i'), array('i')))
+            for doc_id in range(len(docs)):
+                for term, tf in Counter(docs[doc_id]).items():
+                    tf_index[term][0].append(doc_id)
+                    tf_index[term][1].append(tf)
+            return dict((term, CompressedPostings(doc_ids, tfs, len(docs)))
+                        for term, (doc_ids, tfs) in tf_index.items())
+
+        res = defaultdict(Postings if compact else list)
         for doc_id in range(len(docs)):
             term_count = defaultdict(lambda: 0)
             for token in docs[doc_id]:
                 term_count[token] += 1
             for key in list(term_count.keys()):
                 if key in term_count:
-                    res[key].append([doc_id, ( ( 1 + math.log10( float((term_count[key])) ) ) * math.log10( ( float(len(docs)) / doc_freqs[key] ) ) )])
+                    res[key].append([doc_id, ( ( 1 + math.log10( float((term_count[key])) ) ) * math.log10( ( float(n_docs) / doc_freqs[key] ) ) )])
                     
         return res
 
+    def create_tfidf_index_parallel(self, documents, workers, compact=False, lexicon=None,
+                                    compress=False):
+        """
+        Build the same doc_freqs and tf-idf index as count_doc_frequencies and
+        create_tfidf_index, using a pool of worker processes.
+
+        The documents are cut into one contiguous shard per worker. Each
+        worker tokenizes its shard and returns its tf postings (see
+        count_shard); the shards are then merged in order, which keeps every
+        postings list sorted by doc_id and the terms in order of first
+        appearance, exactly as create_tfidf_index builds them. Only the
+        weighting is done here, once the global document frequencies are
+        known.
+
+        Parameters:
+        documents...list of document strings.
+        workers.....number of processes.
+        compact.....as for create_tfidf_index.
+        lexicon.....if given, a lexicon.Lexicon to key the result by term id
+                    instead of by term; new terms are added in order of
+                    first appearance, as encoding the documents in order
+                    would add them.
+        compress....as for create_tfidf_index.
+
+        Returns:
+        A (doc_freqs, index) tuple.
+
+        >>> docs = ['a b a', 'a c', 'c d', 'b b']
+        >>> doc_freqs, index = Index().create_tfidf_index_parallel(docs, 2)
+        >>> toked_docs = [Index().tokenize(d) for d in docs]
+        >>> index == Index().create_tfidf_index(toked_docs, Index().count_doc_frequencies(toked_docs))
+        True
+        >>> doc_freqs['c']
+        2
+        >>> lexicon = Lexicon()
+        >>> toked_docs = [lexicon.encode(Index().tokenize(d)) for d in docs]
+        >>> id_doc_freqs, id_index = Index().create_tfidf_index_parallel(docs, 2, lexicon=Lexicon())
+        >>> id_index == Index().create_tfidf_index(toked_docs, Index().count_doc_frequencies(toked_docs))
+        True
+        >>> _, compressed = Index().create_tfidf_index_parallel(docs, 2, compress=True)
+        >>> compressed['b']
+        CompressedPostings([(0, 0.3010300099849701), (3, 0.391649067401886)])
+        """
+        size = max(1, -(-len(documents) // workers))
+        shards = [(i, documents[i:i+size]) for i in range(0, len(documents), size)]
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(count_shard, shards)
+
+        merged = {}
+        for terms, offsets, doc_ids, tfs in results:
+            for i, term in enumerate(terms):
+                start, end = offsets[i], offsets[i+1]
+                merged.setdefault(term, []).append((doc_ids[start:end], tfs[start:end]))
+
+        doc_freqs = defaultdict(lambda: 0)
+        index = defaultdict(Postings if compact else list)
+        log_tfs = {}
+        for term, parts in merged.items():
+            if lexicon is not None:
+                term = lexicon.add(term)
+            doc_freqs[term] = sum(len(part_doc_ids) for part_doc_ids, _ in parts)
+            idf = math.log10(float(len(documents)) / doc_freqs[term])
+            if compress:
+                index[term] = CompressedPostings(
+                    np.concatenate([part_doc_ids for part_doc_ids, _ in parts]),
+                    np.concatenate([part_tfs for _, part_tfs in parts]), len(documents))
+                continue
+            postings = index[term]
+            for part_doc_ids, part_tfs in parts:
+                for doc_id, tf in zip(part_doc_ids, part_tfs):
+                    if tf not in log_tfs:
+                        log_tfs[tf] = 1 + math.log10(float(tf))
+                    postings.append([doc_id, log_tfs[tf] * idf])
+        return doc_freqs, index
+
     def count_doc_frequencies(self, docs):
         """ Return a dict mapping terms to document frequency.
         >>> res = Index().count_doc_frequencies([['a', 'b', 'a', 'z'], ['a', 'b', 'c'], ['a', 'z']])
@@ -158,31 +450,34 @@ class Index(object):
           query_terms....list of terms
 
         Returns:
-          A dict from query term to IDF.
+          A dict from query term (its term id, if the index has a lexicon) to IDF.
         """
         N = len(self.documents)
         qry_vector = defaultdict(lambda: 0)
         
         for term in query_terms:
-            if term in self.index:
+            if self.lexicon is not None:
+                term = self.lexicon.get(term)
+            if term is not None and term in self.index:
                 freq = self.doc_freqs[term]
                 qry_vector[term] =  float(math.log10( float(N) / freq ))
         
         return qry_vector
 
-    def search_by_cosine(self, query_vector, index, doc_lengths):
+    def search_by_cosine(self, query_vector, index, doc_lengths, k=None):
         """
         Return a sorted list of doc_id, score pairs, where the score is the
         cosine similarity between the query_vector and the document. The
         document length should be used in the denominator, but not the query
-        length (as discussed in class). You can use the built-in sorted method
-        (rather than a priority queue) to sort the results.
+        length (as discussed in class). If k is given, only the k best pairs
+        are returned, selected with a bounded heap instead of a full sort.
 
         The parameters are:
 
         query_vector.....dict from term to weight from the query
         index............dict from term to list of doc_id, weight pairs
         doc_lengths......dict from doc_id to length (output of compute_doc_lengths)
+        k................number of results to return, or None for all
 
         In the example below, the query is the term 'a' with weight
         1. Document 1 has cosine similarity of 2, while document 0 has
@@ -190,6 +485,8 @@ class Index(object):
 
         >>> Index().search_by_cosine({'a': 1}, {'a': [[0, 1], [1, 2]]}, {0: 1, 1: 1})
         [(1, 2.0), (0, 1.0)]
+        >>> Index().search_by_cosine({'a': 1}, {'a': [[0, 1], [1, 2]]}, {0: 1, 1: 1}, k=1)
+        [(1, 2.0)]
         """
         
         scores = defaultdict(lambda: 0)
@@ -201,12 +498,320 @@ class Index(object):
         for doc_id in scores:
             scores[doc_id] /= float(doc_lengths[doc_id])
         
+        if k is not None:
+            # nlargest is documented to equal sorted(...)[:k], ties included.
+            return heapq.nlargest(k, scores.items(), key=lambda x: x[1])
         return(sorted(list(scores.items()),key=lambda x:x[1], reverse = True))
 
-    def search(self, query, use_champions=False):
+    def search_by_max_score(self, query_vector, index, doc_lengths, max_scores, k):
+        """
+        Return the same top k doc_id, score pairs as
+        search_by_cosine(query_vector, index, doc_lengths)[:k], using
+        term-at-a-time MaxScore early termination.
+
+        A query term can add at most its query weight times max_scores[term]
+        (see compute_max_scores) to any document's score. Terms are scored
+        from the largest bound down; once the k-th best partial score exceeds
+        the summed bounds of the terms still to come, no unseen document can
+        reach the top k. From then on only the documents that can still make
+        it are kept, and the remaining (usually long, low-idf) postings lists
+        are probed for them by binary search instead of being scanned.
+        Postings must be sorted by doc_id.
+
+        The top candidates are finally rescored in query term order, so the
+        scores, and the tie order of search_by_cosine's stable sort (first
+        query term containing the document, then doc_id), are reproduced
+        exactly.
+
+        >>> index = {'a': [[0, 1], [1, 2], [2, 1]], 'b': [[0, 1], [3, 1]]}
+        >>> lengths = {0: 1, 1: 1, 2: 1, 3: 1}
+        >>> Index().search_by_max_score({'a': 1, 'b': 1}, index, lengths, {'a': 2, 'b': 1}, 2)
+        [(0, 2.0), (1, 2.0)]
+        """
+        if k <= 0:
+            return []
+        terms = []
+        for position, (term, qry_weight) in enumerate(query_vector.items()):
+            if term in index:
+                postings = index[term]
+                if isinstance(postings, (Postings, CompressedPostings)):
+                    doc_ids, weights = postings.arrays()
+                else:
+                    doc_ids = [p[0] for p in postings]
+                    weights = [p[1] for p in postings]
+                terms.append((qry_weight * max_scores[term], position, qry_weight, doc_ids, weights))
+        terms.sort(key=lambda t: -t[0])
+
+        # Bounds are inflated and thresholds deflated a little, so rounding
+        # can never prune a document that belongs in the top k.
+        remaining = sum(t[0] for t in terms) * (1 + 1e-9)
+        scores = defaultdict(float)
+        pruning = False
+        for i, (bound, _, qry_weight, doc_ids, weights) in enumerate(terms):
+            remaining -= bound
+            if not pruning:
+                for doc_id, weight in zip(doc_ids, weights):
+                    scores[doc_id] += qry_weight * weight
+            elif len(scores) * math.log(len(doc_ids) + 1, 2) < len(doc_ids):
+                for doc_id in scores:
+                    j = bisect_left(doc_ids, doc_id)
+                    if j < len(doc_ids) and doc_ids[j] == doc_id:
+                        scores[doc_id] += qry_weight * weights[j]
+            else:
+                for doc_id, weight in zip(doc_ids, weights):
+                    if doc_id in scores:
+                        scores[doc_id] += qry_weight * weight
+            if i + 1 < len(terms) and len(scores) >= k:
+                normalized = [s / float(doc_lengths[d]) for d, s in scores.items()]
+                threshold = heapq.nlargest(k, normalized)[-1] * (1 - 1e-9)
+                if pruning or remaining < threshold:
+                    pruning = True
+                    scores = defaultdict(float, [(d, s) for (d, s), n in
+                                                 zip(scores.items(), normalized)
+                                                 if n + remaining >= threshold])
+
+        normalized = [(d, s / float(doc_lengths[d])) for d, s in scores.items()]
+        if len(normalized) > k:
+            threshold = heapq.nlargest(k, [n for _, n in normalized])[-1] * (1 - 1e-9)
+            normalized = [(d, n) for d, n in normalized if n >= threshold]
+        terms.sort(key=lambda t: t[1])
+        results = []
+        for doc_id, _ in normalized:
+            score, first = 0, None
+            for _, position, qry_weight, doc_ids, weights in terms:
+                j = bisect_left(doc_ids, doc_id)
+                if j < len(doc_ids) and doc_ids[j] == doc_id:
+                    score += qry_weight * weights[j]
+                    first = position if first is None else first
+            results.append((-score / float(doc_lengths[doc_id]), first, doc_id))
+        return [(doc_id, -score) for score, _, doc_id in sorted(results)[:k]]
+
+    def search_by_daat(self, query_vector, index, doc_lengths, min_match=1, k=None):
+        """
+        Return the doc_id, score pairs of the documents containing at least
+        min_match of the terms of query_vector, scored and ordered as by
+        search_by_cosine: min_match=1 is an OR query, and
+        min_match=len(query_vector) an AND query.
+
+        The postings lists are evaluated document at a time, with a
+        postings.PostingsCursor per term. A document in at least min_match
+        of the n lists is in one of the n - min_match + 1 shortest, so only
+        those are walked posting by posting, and the cursors on the others
+        seek straight to each candidate. An AND query thus takes time
+        proportional to the length of its shortest list.
+
+        >>> index = {'a': [[0, 1], [1, 2], [2, 1]], 'b': [[1, 1], [3, 2]], 'c': [[1, 3], [2, 1]]}
+        >>> lengths = {0: 1, 1: 1, 2: 1, 3: 1}
+        >>> query = {'a': 1, 'b': 1, 'c': 1}
+        >>> Index().search_by_daat(query, index, lengths, 3)
+        [(1, 6.0)]
+        >>> Index().search_by_daat(query, index, lengths, 2)
+        [(1, 6.0), (2, 2.0)]
+        >>> Index().search_by_daat(query, index, lengths, 1) == Index().search_by_cosine(query, index, lengths)
+        True
+        >>> Index().search_by_daat(query, index, lengths, 1, k=2)
+        [(1, 6.0), (2, 2.0)]
+        """
+        terms = [(term, weight) for term, weight in query_vector.items() if term in index]
+        if not terms or min_match > len(terms):
+            return []
+        cursors = [PostingsCursor(index[term]) for term, _ in terms]
+        by_length = sorted(range(len(terms)), key=lambda t: cursors[t].length)
+        walked = by_length[:len(terms) - min_match + 1]
+        sought = by_length[len(terms) - min_match + 1:]
+
+        matches = []
+        while True:
+            doc_id = min(cursors[t].doc_id for t in walked)
+            if doc_id == END:
+                break
+            matched = [t for t in walked if cursors[t].doc_id == doc_id]
+            for n, t in enumerate(sought):
+                if len(matched) + len(sought) - n < min_match:
+                    break
+                if cursors[t].seek(doc_id) == doc_id:
+                    matched.append(t)
+            if len(matched) >= min_match:
+                # Sum the weights in query term order, as search_by_cosine does.
+                matched.sort()
+                score = 0
+                for t in matched:
+                    score += terms[t][1] * cursors[t].weight
+                matches.append((matched[0], doc_id, score / float(doc_lengths[doc_id])))
+            for t in walked:
+                if cursors[t].doc_id == doc_id:
+                    cursors[t].next()
+
+        # search_by_cosine meets documents in order of their first query
+        # term, then of doc id, and its sort keeps that order among ties.
+        matches.sort(key=lambda x: x[0])
+        results = [(doc_id, score) for _, doc_id, score in matches]
+        if k is not None:
+            return heapq.nlargest(k, results, key=lambda x: x[1])
+        return sorted(results, key=lambda x: x[1], reverse=True)
+
+    def search_by_tiers(self, query_vector, tiers, bounds, doc_lengths, k=None):
+        """
+        Return the top k doc_id, score pairs for query_vector, searching the
+        tiers of create_tiered_index one after the other until k documents
+        score at least the bound on what the postings in the remaining
+        tiers could add to any score, so that no document the search has
+        not matched can outscore them. Documents can still be missing
+        weights from the tiers left unsearched, so their scores are lower
+        bounds and the results are approximate.
+
+        A query whose champion lists (the first tier) match fewer than k
+        documents therefore falls back to the next tiers instead of
+        returning few results. Once every tier is searched, e.g. with k=None,
+        the results and their order equal search_by_cosine's exactly.
+
+        >>> index = {'a': [[0, 1], [1, 4], [2, 2], [3, 3]], 'b': [[2, 1], [3, 1]]}
+        >>> lengths = {0: 1, 1: 1, 2: 1, 3: 2}
+        >>> tiers, bounds = Index().create_tiered_index(index, lengths, (1,))
+        >>> Index().search_by_tiers({'a': 1}, tiers, bounds, lengths, 1)
+        [(1, 4.0)]
+        >>> Index().search_by_tiers({'b': 1, 'a': 1}, tiers, bounds, lengths, 2)
+        [(1, 4.0), (2, 3.0)]
+        >>> query = {'b': 1, 'a': 1}
+        >>> Index().search_by_tiers(query, tiers, bounds, lengths) == Index().search_by_cosine(query, index, lengths)
+        True
+        """
+        terms = list(query_vector.items())
+        # The weights of each document, per query term, so that the final
+        # scores can be summed in query term order as in search_by_cosine.
+        contributions = [{} for _ in terms]
+        scores = defaultdict(float)
+        for t, tier in enumerate(tiers):
+            for (term, qry_weight), weights in zip(terms, contributions):
+                if term in tier:
+                    for doc_id, doc_weight in tier[term]:
+                        weights[doc_id] = qry_weight * doc_weight
+                        scores[doc_id] += qry_weight * doc_weight
+            if k is None or t + 1 == len(tiers):
+                continue
+            # Inflated a little, so rounding never stops the search too early.
+            bound = sum(qry_weight * bounds[t].get(term, 0.0) for term, qry_weight in terms)
+            bound *= 1 + 1e-9
+            if sum(1 for doc_id, score in scores.items()
+                   if score / float(doc_lengths[doc_id]) >= bound) >= k:
+                break
+
+        normalized = [(doc_id, score / float(doc_lengths[doc_id])) for doc_id, score in scores.items()]
+        if k is not None and len(normalized) > k:
+            threshold = heapq.nlargest(k, [n for _, n in normalized])[-1] * (1 - 1e-9)
+            normalized = [(d, n) for d, n in normalized if n >= threshold]
+        results = []
+        for doc_id, _ in normalized:
+            score, first = 0, None
+            for position, weights in enumerate(contributions):
+                if doc_id in weights:
+                    score += weights[doc_id]
+                    first = position if first is None else first
+            results.append((-score / float(doc_lengths[doc_id]), first, doc_id))
+        return [(doc_id, -score) for score, _, doc_id in sorted(results)[:k]]
+
+    def search_by_cosine_batch(self, query_vectors, index, doc_lengths, k=None, batch_size=None):
+        """
+        Return search_by_cosine(query_vector, index, doc_lengths, k) for each
+        of a list of query vectors, scoring up to batch_size queries at once.
+
+        The scores of a batch are accumulated in a dense (queries x documents)
+        NumPy matrix. Each term's postings are converted to arrays once per
+        call, and are added to the rows of every query that contains the term
+        in one vectorized step. Terms are added in rounds by their position
+        in the query, so each document's score is summed in the same order as
+        search_by_cosine sums it and the floating point results are identical.
+        Ties are broken as search_by_cosine's stable sort breaks them: by the
+        first query term containing the document, then by the position of the
+        document in that term's postings.
+
+        By default batch_size keeps each matrix to about 4M entries.
+
+        >>> index = {'a': [[0, 1], [1, 2]], 'b': [[1, 1], [2, 3]]}
+        >>> lengths = {0: 1, 1: 1, 2: 2}
+        >>> Index().search_by_cosine_batch([{'a': 1}, {'b': 1, 'a': 1}], index, lengths)
+        [[(1, 2.0), (0, 1.0)], [(1, 3.0), (2, 1.5), (0, 1.0)]]
+        >>> Index().search_by_cosine_batch([{'b': 1, 'a': 1}], index, lengths, k=1)
+        [[(1, 3.0)]]
+        """
+        if isinstance(doc_lengths, dict):
+            lengths = np.zeros(max(doc_lengths, default=-1) + 1)
+            lengths[list(doc_lengths.keys())] = list(doc_lengths.values())
+        else:
+            lengths = np.asarray(doc_lengths, dtype=np.float64)
+        n_docs = len(lengths)
+        if batch_size is None:
+            batch_size = max(1, (1 << 22) // max(n_docs, 1))
+
+        arrays = {}
+        def postings_arrays(term):
+            if term not in arrays:
+                postings = index[term]
+                if isinstance(postings, (Postings, CompressedPostings)):
+                    doc_ids, weights = postings.arrays()
+                else:
+                    doc_ids = [p[0] for p in postings]
+                    weights = [p[1] for p in postings]
+                arrays[term] = (np.asarray(doc_ids, dtype=np.int64),
+                                np.asarray(weights, dtype=np.float64),
+                                np.arange(len(doc_ids), dtype=np.int64))
+            return arrays[term]
+
+        unmatched = np.iinfo(np.int64).max
+        results = []
+        for start in range(0, len(query_vectors), batch_size):
+            batch = [[(term, weight) for term, weight in vector.items() if term in index]
+                     for vector in query_vectors[start:start+batch_size]]
+            scores = np.zeros((len(batch), n_docs))
+            # (query term position << 32) + position in its postings of the
+            # first term that matched each document.
+            first = np.full((len(batch), n_docs), unmatched, dtype=np.int64)
+            for position in range(max([len(terms) for terms in batch] or [0])):
+                groups = defaultdict(list)
+                for row, terms in enumerate(batch):
+                    if position < len(terms):
+                        groups[terms[position][0]].append((row, terms[position][1]))
+                for term, members in groups.items():
+                    doc_ids, weights, ranks = postings_arrays(term)
+                    rows = np.array([row for row, _ in members])[:, None]
+                    qry_weights = np.array([weight for _, weight in members], dtype=np.float64)
+                    scores[rows, doc_ids] += qry_weights[:, None] * weights
+                    first[rows, doc_ids] = np.minimum(first[rows, doc_ids],
+                                                      (position << 32) + ranks)
+            for row in range(len(batch)):
+                matched = np.flatnonzero(first[row] != unmatched)
+                row_scores = scores[row, matched] / lengths[matched]
+                order = np.lexsort((first[row, matched], -row_scores))[:k]
+                results.append(list(zip(matched[order].tolist(), row_scores[order].tolist())))
+        return results
+
+    def search_batch(self, queries, use_champions=False, k=None, batch_size=None):
+        """ Return [self.search(query, use_champions, k) for query in
+        queries], scoring the queries together with search_by_cosine_batch.
+        This is much faster than searching one query at a time when there are
+        many queries, e.g. for offline evaluation.
+
+        >>> indexer = Index()
+        >>> indexer.documents = ['a b a', 'a c', 'b c d', 'd']
+        >>> toked_docs = [indexer.tokenize(d) for d in indexer.documents]
+        >>> indexer.doc_freqs = indexer.count_doc_frequencies(toked_docs)
+        >>> indexer.index = indexer.create_tfidf_index(toked_docs, indexer.doc_freqs, True)
+        >>> indexer.doc_lengths = indexer.compute_doc_lengths(indexer.index)
+        >>> queries = ['a', 'c b', 'd a z', 'z']
+        >>> indexer.search_batch(queries) == [indexer.search(q) for q in queries]
+        True
+        """
+        qry_vectors = [self.query_to_vector(self.tokenize(query)) for query in queries]
+        index = self.champion_index if use_champions else self.index
+        return self.search_by_cosine_batch(qry_vectors, index, self.doc_lengths, k, batch_size)
+
+    def search(self, query, use_champions=False, k=None, use_tiers=False, match='or'):
         """ Return the document ids for documents matching the query. Assume that
-        query is a single string, possible containing multiple words. Assume
-        queries with multiple words are AND queries. The steps are to:
+        query is a single string, possible containing multiple words. By
+        default every document containing at least one of the words is
+        scored (an OR query); match selects AND or at-least-m queries, and
+        search_boolean supports phrase and proximity queries. The steps are
+        to:
 
         1. Tokenize the query (calling self.tokenize)
         2. Convert the query into an idf vector (calling self.query_to_vector)
@@ -216,14 +821,123 @@ class Index(object):
 
         query...........raw query string, possibly containing multiple terms (though boolean operators do not need to be supported)
         use_champions...If True, Step 4 above will use only the champion index to perform the search.
+        k...............If given, return only the top k results. Unless champion
+                        lists are used, these are found with search_by_max_score.
+        use_tiers.......If True, search the tiered index (see search_by_tiers);
+                        the index must have been built with tier_thresholds.
+        match...........'or' to match documents containing any query word,
+                        'and' for those containing every word, or a number m
+                        for those containing at least m of the words. With
+                        more than one word to match, the query is evaluated
+                        by search_by_daat; OR queries are scored term at a
+                        time, which is faster when every posting is needed.
+
+        >>> indexer = Index()
+        >>> indexer.documents = ['a b c', 'a c', 'b c d', 'd']
+        >>> toked_docs = [indexer.tokenize(d) for d in indexer.documents]
+        >>> indexer.doc_freqs = indexer.count_doc_frequencies(toked_docs)
+        >>> indexer.index = indexer.create_tfidf_index(toked_docs, indexer.doc_freqs, True)
+        >>> indexer.doc_lengths = indexer.compute_doc_lengths(indexer.index)
+        >>> [doc_id for doc_id, _ in indexer.search('a b d')]
+        [0, 2, 3, 1]
+        >>> [doc_id for doc_id, _ in indexer.search('a b d', match=2)]
+        [0, 2]
+        >>> indexer.search('a b d', match='and'), indexer.search('a z', match='and')
+        ([], [])
         """
         
         qry_terms = self.tokenize(query)
         qry_vector = self.query_to_vector(qry_terms)
+        min_match = match_count(match, qry_terms)
+        if min_match > 1:
+            if use_tiers:
+                raise ValueError("tiered search only supports OR queries")
+            index = self.champion_index if use_champions else self.index
+            return self.search_by_daat(qry_vector, index, self.doc_lengths, min_match, k)
+        if use_tiers:
+            if self.tiered_index is None:
+                raise ValueError('the index has no tiers; build it with tier_thresholds')
+            return self.search_by_tiers(qry_vector, self.tiered_index, self.tier_bounds,
+                                        self.doc_lengths, k)
         if use_champions == True:
-            return self.search_by_cosine(qry_vector, self.champion_index, self.doc_lengths)
+            return self.search_by_cosine(qry_vector, self.champion_index, self.doc_lengths, k)
+        elif k is not None and self.max_scores is not None:
+            return self.search_by_max_score(qry_vector, self.index, self.doc_lengths, self.max_scores, k)
         else:
-            return self.search_by_cosine(qry_vector, self.index, self.doc_lengths)
+            return self.search_by_cosine(qry_vector, self.index, self.doc_lengths, k)
+
+    def positional_index(self):
+        """ Return the positional index of the documents (see
+        positions.PositionalIndex), building it the first time it is needed,
+        and again after the documents change. """
+        if self.positions is None or self.positions_generation != self.generation:
+            self.positions = PositionalIndex(self.documents, self.tokenize)
+            self.positions_generation = self.generation
+        return self.positions
+
+    def search_boolean(self, query, k=None):
+        """ Return the doc_id, score pairs of the documents matching every
+        clause of query (see positions.parse_query): each word must occur in
+        the document, each "quoted phrase" must occur as a phrase, and the
+        words of each "quoted clause"~N must all occur within N consecutive
+        positions. The documents are scored and ordered as by search, so the
+        results are those of search restricted to the matching documents.
+
+        The documents containing every word are found by intersecting
+        postings lists (see positions.intersect). Positions are only looked
+        at, and the positional index only built, for phrase and proximity
+        clauses.
+
+        >>> indexer = Index()
+        >>> indexer.documents = ['new york city', 'york new', 'new city of york', 'city']
+        >>> toked_docs = [indexer.tokenize(d) for d in indexer.documents]
+        >>> indexer.doc_freqs = indexer.count_doc_frequencies(toked_docs)
+        >>> indexer.index = indexer.create_tfidf_index(toked_docs, indexer.doc_freqs, True)
+        >>> indexer.doc_lengths = indexer.compute_doc_lengths(indexer.index)
+        >>> [doc_id for doc_id, _ in indexer.search_boolean('york new')]
+        [1, 0, 2]
+        >>> [doc_id for doc_id, _ in indexer.search_boolean('"new york" city')]
+        [0]
+        >>> [doc_id for doc_id, _ in indexer.search_boolean('"york city"~3')]
+        [0, 2]
+        >>> indexer.search_boolean('new york') == [r for r in indexer.search('new york') if r[0] != 3]
+        True
+        >>> indexer.search_boolean('new zebra'), indexer.positions is None
+        ([], False)
+        """
+        clauses = parse_query(query, self.tokenize)
+        qry_terms = [term for terms, _ in clauses for term in terms]
+        qry_vector = self.query_to_vector(qry_terms)
+        if not clauses or len(qry_vector) < len(set(qry_terms)):
+            return []
+        arrays = []
+        for term in qry_vector:
+            postings = self.index[term]
+            if isinstance(postings, (Postings, CompressedPostings)):
+                arrays.append(postings.arrays())
+            else:
+                arrays.append(([p[0] for p in postings], [p[1] for p in postings]))
+        doc_ids = intersect([ids for ids, _ in arrays])
+        for terms, window in clauses:
+            if window is None or not doc_ids:
+                continue
+            if window == 0:
+                doc_ids = intersect([doc_ids, self.positional_index().phrase(terms).tolist()])
+            else:
+                doc_ids = self.positional_index().near(terms, window, doc_ids)
+
+        # Sum the weights in query term order, as search_by_cosine does.
+        scores = [0] * len(doc_ids)
+        for qry_weight, (ids, weights) in zip(qry_vector.values(), arrays):
+            i = 0
+            for j, doc_id in enumerate(doc_ids):
+                i = gallop(ids, doc_id, i)
+                scores[j] += qry_weight * weights[i]
+        results = [(doc_id, score / float(self.doc_lengths[doc_id]))
+                   for doc_id, score in zip(doc_ids, scores)]
+        if k is not None:
+            return heapq.nlargest(k, results, key=lambda x: x[1])
+        return sorted(results, key=lambda x: x[1], reverse=True)
 
     def read_lines(self, filename):
         """ DO NOT MODIFY.
@@ -243,15 +957,73 @@ class Index(object):
         return [t.lower() for t in re.findall(r"\w+(?:[-']\w+)*", document)]
 
 
+def tier_size(threshold, df):
+    """ Return the number of postings a champion list or tier threshold
+    selects from a postings list of df postings: threshold itself, or
+    threshold(df) if it is a function.
+
+    >>> tier_size(10, 500), tier_size(lambda df: max(10, df // 20), 500)
+    (10, 25)
+    """
+    return threshold(df) if callable(threshold) else threshold
+
+
+def match_count(match, query_terms):
+    """ Return the number of distinct query terms a document must contain
+    for the match argument of Index.search: 1 for 'or', all of them for
+    'and', or the number given.
+
+    >>> match_count('or', ['a', 'b', 'a']), match_count('and', ['a', 'b', 'a']), match_count(2, [])
+    (1, 2, 2)
+    """
+    if match == 'or':
+        return 1
+    if match == 'and':
+        return len(set(query_terms))
+    if not isinstance(match, int) or match < 1:
+        raise ValueError("match must be 'or', 'and' or a positive number of terms")
+    return match
+
+
+def count_shard(shard):
+    """ Tokenize a shard of documents for create_tfidf_index_parallel.
+
+    Params:
+      shard...a (first doc_id, list of document strings) tuple.
+    Returns:
+      A (terms, offsets, doc_ids, tfs) tuple: the shard's terms in order of
+      first appearance, and their postings concatenated into flat arrays,
+      term i's postings being doc_ids[offsets[i]:offsets[i+1]].
+
+    >>> count_shard((5, ['b a b', 'a']))
+    (['b', 'a'], array('i', [0, 1, 3]), array('i', [5, 5, 6]), array('i', [2, 1, 1]))
+    """
+    first_doc_id, documents = shard
+    tokenize = Index().tokenize
+    postings = {}
+    for doc_id, document in enumerate(documents, first_doc_id):
+        for term, tf in Counter(tokenize(document)).items():
+            if term not in postings:
+                postings[term] = (array('i'), array('i'))
+            postings[term][0].append(doc_id)
+            postings[term][1].append(tf)
+    offsets, doc_ids, tfs = array('i', [0]), array('i'), array('i')
+    for term_doc_ids, term_tfs in postings.values():
+        doc_ids.extend(term_doc_ids)
+        tfs.extend(term_tfs)
+        offsets.append(len(doc_ids))
+    return list(postings), offsets, doc_ids, tfs
+
+
 def main():
-    """ DO NOT MODIFY.
+    """
     Main method. Constructs an Index object and runs a sample query. """
     indexer = Index('documents.txt.gz')
     for query in ['pop love song', 'chinese american','city']:
         print(('\n\nQUERY=%s' % query))
-        print(('\n'.join(['%d\t%e' % (doc_id, score) for doc_id, score in indexer.search(query)[:10]])))
+        print(('\n'.join(['%d\t%e' % (doc_id, score) for doc_id, score in indexer.search(query, k=10)])))
         print(('\n\nQUERY=%s Using Champion List' % query))
-        print(('\n'.join(['%d\t%e' % (doc_id, score) for doc_id, score in indexer.search(query, True)[:10]])))
+        print(('\n'.join(['%d\t%e' % (doc_id, score) for doc_id, score in indexer.search(query, True, k=10)])))
 
 if __name__ == '__main__':
     main()
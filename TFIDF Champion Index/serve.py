@@ -0,0 +1,158 @@
+"""
+A pre-forking production server for run.py.
+
+The parent process loads the index (memory-mapped from INDEX_PATH when it
+exists, see run.py), binds the listening socket and then forks the workers.
+Every worker therefore shares the parent's mapped index pages instead of
+loading its own copy, and serves requests from the shared socket with a
+pool of threads. Connections that arrive while the workers start up wait
+in the socket's backlog rather than being refused.
+
+Each worker reports over a pipe once its server is set up on the socket.
+When every worker has reported, the parent prints "ready" and, with
+--ready-file, creates that file, for process supervisors or deployment
+scripts to wait on. A worker that exits is replaced by a new one, unless it
+exits before reporting (e.g. it cannot start), so that a broken setup is not
+forked over and over. SIGTERM or SIGINT stops the workers gracefully: they
+stop accepting, finish the requests in flight, and exit.
+
+Run with `python serve.py --port 8000 --workers 4`.
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+
+from werkzeug.serving import make_server
+
+
+def run_worker(app, sock, host, port, ready_fd=None):
+    """ Serve app from the inherited listening socket until SIGTERM. Once
+    the server is set up, write a byte to ready_fd and close it. """
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    # Let server_close wait for requests in flight instead of dropping them.
+    server.daemon_threads = False
+    server.block_on_close = True
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if ready_fd is not None:
+        os.write(ready_fd, b'1')
+        os.close(ready_fd)
+    server.serve_forever()
+    server.server_close()
+
+
+def start_worker(app, sock, host, port):
+    """ Fork a worker serving app (see run_worker), wait until it is
+    serving, and return its pid, or None if it exited before that.
+
+    SIGTERM and SIGINT are blocked around the fork, and the child resets
+    them to their defaults before unblocking them, so that it never runs
+    the parent's handlers: until run_worker installs its own, they simply
+    end the worker. """
+    read_fd, write_fd = os.pipe()
+    signals = {signal.SIGTERM, signal.SIGINT}
+    signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+    try:
+        pid = os.fork()
+    except OSError:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+        raise
+    if pid == 0:
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+            os.close(read_fd)
+            run_worker(app, sock, host, port, write_fd)
+        finally:
+            os._exit(0)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+    os.close(write_fd)
+    try:
+        ready = os.read(read_fd, 1)
+    finally:
+        os.close(read_fd)
+    if not ready:
+        os.waitpid(pid, 0)
+        return None
+    return pid
+
+
+def serve(host='127.0.0.1', port=8000, workers=os.cpu_count() or 1, ready_file=None):
+    """ Load the index, fork workers processes serving run.app on host:port,
+    and wait for them. """
+    import run  # Loads the index once, before forking.
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+
+    children = set()
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    try:
+        for _ in range(workers):
+            pid = start_worker(run.app, sock, host, port)
+            if stopping:
+                break
+            if pid is None:
+                sys.stderr.write('a worker exited before serving; stopping\n')
+                stop(signal.SIGTERM, None)
+                break
+            children.add(pid)
+        else:
+            print('ready: %d workers serving %d documents on http://%s:%d/' %
+                  (workers, len(run.my_index.documents), host, port))
+            sys.stdout.flush()
+            if ready_file:
+                open(ready_file, 'w').close()
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            children.discard(pid)
+            if stopping:
+                continue
+            sys.stderr.write('worker %d exited with status %d; starting a new one\n' % (pid, status))
+            pid = start_worker(run.app, sock, host, port)
+            if pid is None:
+                sys.stderr.write('the new worker exited before serving; not replacing it\n')
+            else:
+                children.add(pid)
+    finally:
+        sock.close()
+        if ready_file and os.path.exists(ready_file):
+            os.remove(ready_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--ready-file', help='file to create once all workers are serving')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers, args.ready_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+An index partitioned into shards, searched by scatter-gather.
+
+ShardedIndex cuts the documents into n_shards contiguous ranges of doc ids,
+each indexed by a regular searcher.Index, so that no single index has to
+hold every postings list and each shard's lists are a fraction of the
+total. A query is scattered to every shard, each shard returns its own top
+k, and the sorted per-shard lists are merged with a heap.
+
+The document frequencies and the number of documents are those of the
+whole collection: they are counted once before the shards are built, each
+shard's postings are weighted with them, and the query's IDF weights are
+computed from them before it is scattered. Scores are therefore identical
+to those of a single searcher.Index over the same documents, and so is the
+order of the results. Champion lists are per shard, so searches with
+use_champions can differ from a single index's.
+
+With processes=True each shard is saved to a file (see storage.py) and
+served by its own worker process, which memory-maps it; the shards are then
+searched in parallel. Otherwise they are searched one after the other in
+this process.
+"""
+from bisect import bisect_left
+import heapq
+from itertools import islice
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from lexicon import Lexicon, TermTable
+from searcher import Index, match_count
+
+
+def search_shard(indexer, terms, use_champions=False, k=None, min_match=1):
+    """
+    Search one shard for the query terms, a list of (term, weight) pairs
+    in query order weighted with the collection's IDF (see
+    ShardedIndex.query_terms), the way searcher.Index.search would search a
+    query vector of them.
+
+    Returns:
+      A list of (-score, first, doc_id) tuples, sorted, where first is the
+      position in terms of the first term the document contains and doc_id
+      is the shard's own doc id. This is the order of searcher.Index.search
+      results, so the lists of several shards can be merged.
+
+    >>> shard = Index()
+    >>> shard.documents = ['a b', 'b']
+    >>> toked_docs = [shard.tokenize(d) for d in shard.documents]
+    >>> shard.index = shard.create_tfidf_index(toked_docs, {'a': 1, 'b': 3}, True, n_docs=4)
+    >>> shard.doc_lengths = shard.compute_doc_lengths(shard.index)
+    >>> search_shard(shard, [('z', 1.), ('b', 1.), ('a', 1.)])  # doctest:+ELLIPSIS
+    [(-1.18..., 1, 0), (-1.0, 1, 1)]
+    """
+    qry_vector, positions = {}, []
+    for position, (term, weight) in enumerate(terms):
+        key = term if indexer.lexicon is None else indexer.lexicon.get(term)
+        if key is not None and key in indexer.index:
+            qry_vector[key] = weight
+            positions.append(position)
+    index = indexer.champion_index if use_champions else indexer.index
+    if min_match > 1:
+        results = indexer.search_by_daat(qry_vector, index, indexer.doc_lengths, min_match, k)
+    elif k is not None and not use_champions and indexer.max_scores is not None:
+        results = indexer.search_by_max_score(qry_vector, index, indexer.doc_lengths,
+                                              indexer.max_scores, k)
+    else:
+        results = indexer.search_by_cosine(qry_vector, index, indexer.doc_lengths, k)
+
+    doc_ids = [index[key].arrays()[0] if key in index else () for key in qry_vector]
+    def first(doc_id):
+        for position, ids in zip(positions, doc_ids):
+            i = bisect_left(ids, doc_id)
+            if i < len(ids) and ids[i] == doc_id:
+                return position
+    return [(-score, first(doc_id), doc_id) for doc_id, score in results]
+
+
+def serve_shard(path, conn):
+    """ Load the shard index saved at path and answer requests from conn
+    until it sends None. A request is a list of argument tuples for
+    search_shard; the reply is the list of their results. """
+    indexer = Index.load(path)
+    while True:
+        requests = conn.recv()
+        if requests is None:
+            break
+        conn.send([search_shard(indexer, *request) for request in requests])
+    conn.close()
+
+
+class ShardedIndex(object):
+    """
+    >>> import gzip, os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'docs.txt.gz')
+    >>> with gzip.open(path, 'wt') as f:
+    ...     _ = f.write('a b a\\na c\\nb c d\\nd\\nc a\\n')
+    >>> single = Index(path)
+    >>> sharded = ShardedIndex(path, n_shards=2)
+    >>> sharded.offsets
+    [0, 3]
+    >>> sharded.search('a d') == single.search('a d')
+    True
+    >>> sharded.search('c a', k=2) == single.search('c a', k=2)
+    True
+    >>> sharded.search('a c', match='and') == single.search('a c', match='and')
+    True
+    >>> with ShardedIndex(path, n_shards=3, processes=True) as sharded:
+    ...     sharded.search_batch(['a d', 'c']) == [single.search('a d'), single.search('c')]
+    True
+    """
+
+    tokenize = Index.tokenize
+    read_lines = Index.read_lines
+
+    def __init__(self, filename=None, n_shards=2, champion_threshold=10, processes=False):
+        """
+        Index the documents of filename (one per line) in n_shards shards
+        of compact postings. If processes is True each shard is served by a
+        worker process from a memory-mapped file, and close() (or leaving a
+        with block) must be called to stop them.
+        """
+        self.shards, self.workers, self.tmpdir = [], [], None
+        self.offsets, self.n_docs = [], 0
+        if filename:  # filename may be None for testing purposes.
+            documents = self.read_lines(filename)
+            self.n_docs = len(documents)
+            self.lexicon = Lexicon()
+            toked_docs = [self.lexicon.encode(self.tokenize(d)) for d in documents]
+            self.doc_freqs = TermTable(Index().count_doc_frequencies(toked_docs), 'i')
+            size = max(1, -(-len(documents) // n_shards))
+            self.offsets = list(range(0, len(documents), size))
+            for offset in self.offsets:
+                self.shards.append(self.create_shard(documents[offset:offset+size],
+                                                     toked_docs[offset:offset+size],
+                                                     champion_threshold))
+            del toked_docs
+            if processes:
+                self.start()
+
+    def create_shard(self, documents, toked_docs, champion_threshold):
+        """ Return a searcher.Index of some of the documents, with local doc
+        ids and the weights of the whole collection. Its postings are keyed
+        by term id in id order, as Index(filename) keys them, so that
+        document lengths are summed in the same order. """
+        indexer = Index(champion_threshold=champion_threshold)
+        indexer.documents = documents
+        indexer.lexicon = self.lexicon
+        index = indexer.create_tfidf_index(toked_docs, self.doc_freqs, True, n_docs=self.n_docs)
+        indexer.index = dict(sorted(index.items()))
+        indexer.doc_freqs = dict((term_id, len(postings)) for term_id, postings in indexer.index.items())
+        indexer.doc_lengths = indexer.compute_doc_lengths(indexer.index)
+        indexer.champion_index = indexer.create_champion_index(indexer.index, champion_threshold)
+        indexer.max_scores = indexer.compute_max_scores(indexer.index, indexer.doc_lengths)
+        return indexer
+
+    def start(self):
+        """ Save each shard to a temporary file and start a worker process
+        to serve it (see serve_shard). The shards are then only held by the
+        workers. """
+        self.tmpdir = tempfile.mkdtemp()
+        for i, shard in enumerate(self.shards):
+            path = os.path.join(self.tmpdir, 'shard%d.idx' % i)
+            shard.save(path)
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=serve_shard, args=(path, child_conn), daemon=True)
+            process.start()
+            child_conn.close()
+            self.workers.append((process, conn))
+        self.shards = []
+
+    def close(self):
+        """ Stop the worker processes, if any, and delete their files. """
+        for process, conn in self.workers:
+            conn.send(None)
+            conn.close()
+            process.join()
+        self.workers = []
+        if self.tmpdir is not None:
+            shutil.rmtree(self.tmpdir)
+            self.tmpdir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def query_terms(self, query):
+        """ Return the indexed terms of query and their IDF in the whole
+        collection, as (term, idf) pairs in query order, like the query
+        vector of searcher.Index.query_to_vector. """
+        terms = {}
+        for term in self.tokenize(query):
+            term_id = self.lexicon.get(term)
+            if term_id is not None and term not in terms:
+                terms[term] = float(math.log10(float(self.n_docs) / self.doc_freqs[term_id]))
+        return list(terms.items())
+
+    def scatter(self, requests):
+        """ Run search_shard for each request (a tuple of its arguments
+        after the index) on every shard, in parallel if the shards have
+        worker processes. Return each shard's list of results. """
+        if not self.workers:
+            return [[search_shard(shard, *request) for request in requests] for shard in self.shards]
+        for _, conn in self.workers:
+            conn.send(requests)
+        return [conn.recv() for _, conn in self.workers]
+
+    def gather(self, shard_results, k=None):
+        """ Merge the search_shard results of each shard into the doc_id,
+        score pairs of the top k (or all) documents, with global doc ids. """
+        merged = heapq.merge(*[[(score, first, doc_id + offset) for score, first, doc_id in results]
+                               for results, offset in zip(shard_results, self.offsets)])
+        return [(doc_id, -score) for score, _, doc_id in islice(merged, k)]
+
+    def search_batch(self, queries, use_champions=False, k=None, match='or'):
+        """ Return [self.search(query, use_champions, k, match) for query in
+        queries], sending all the queries to each shard at once. """
+        requests = [(self.query_terms(query), use_champions, k,
+                     match_count(match, self.tokenize(query))) for query in queries]
+        per_shard = self.scatter(requests)
+        return [self.gather([results[i] for results in per_shard], k) for i in range(len(queries))]
+
+    def search(self, query, use_champions=False, k=None, match='or'):
+        """ Return the doc_id, score pairs of searcher.Index.search for query
+        over the whole collection: every shard is searched for its top k,
+        and the results merged. """
+        return self.search_batch([query], use_champions, k, match)[0]
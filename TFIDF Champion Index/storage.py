@@ -0,0 +1,352 @@
+"""
+A versioned binary file format for searcher.Index.
+
+The file starts with a fixed header and a table of (offset, length) pairs,
+one per section, followed by the sections themselves. Every section is a
+flat array, so loading only has to wrap the file in memoryviews; with
+mmap=True nothing is read until it is used and the pages are shared by every
+process that maps the same file.
+
+Sections:
+  terms..............UTF-8 terms, concatenated in byte order
+  term_offsets.......uint64 [n_terms+1], start of each term in `terms`
+  term_numbers.......int32 [n_terms], term number (id) of each sorted term,
+                     i.e. its position in the postings tables below
+  postings_offsets...uint64 [n_terms+1], start of each postings list
+  doc_ids, weights...int32 / float [n_postings]
+  champion_*.........the same three tables for the champion index
+  doc_lengths........float64 [n_docs]
+  doc_offsets........uint64 [n_docs+1], start of each document in `documents`
+  documents..........UTF-8 documents, concatenated
+  max_scores.........float64 [n_terms], searcher.Index.max_scores (version 2+)
+  compressed_offsets...uint64, postings.CompressedPostingsTable.offsets: the
+                       start of every TERM_GROUP-th term's postings in
+                       `compressed_postings`, then its end; or empty
+                       (version 3+)
+  compressed_postings..postings.CompressedPostings.to_bytes() of each term
+
+An index of CompressedPostings is written with empty postings_offsets,
+doc_ids and weights sections (each list's length is read from the list) and
+its postings in the compressed sections; otherwise those are empty. The
+compressed postings of version 3 used a different encoding, and are not
+read.
+
+Files of an older version are still read; sections they lack are loaded as
+None. The header's champion threshold is 0 if it was a function of the
+document frequency (see searcher.tier_size).
+
+Build a file from the command line with
+`python storage.py documents.txt.gz documents.idx [--compress]`.
+"""
+from array import array
+from collections.abc import Mapping, Sequence
+import mmap
+from numbers import Integral
+import shutil
+import struct
+import sys
+
+from postings import CompressedPostings, CompressedPostingsTable, Postings
+
+MAGIC = b'TFIDFIDX'
+FORMAT_VERSION = 4
+HEADER = struct.Struct('<8sIcc2xQQQ')
+SECTION = struct.Struct('<QQ')
+SECTIONS = ('terms', 'term_offsets', 'term_numbers',
+            'postings_offsets', 'doc_ids', 'weights',
+            'champion_offsets', 'champion_doc_ids', 'champion_weights',
+            'doc_lengths', 'doc_offsets', 'documents', 'max_scores',
+            'compressed_offsets', 'compressed_postings')
+# Number of leading SECTIONS present in each format version.
+SECTION_COUNTS = {1: 12, 2: 13, 3: 15, 4: 15}
+BYTEORDERS = {'little': b'<', 'big': b'>'}
+
+
+class TermLexicon(Mapping):
+    """ A read-only lexicon.Lexicon backed by the term tables of an index
+    file: a mapping from term to term number. Terms are found by binary
+    search over the sorted term table, so no dict is built at load time. """
+
+    def __init__(self, terms, term_offsets, term_numbers):
+        self.terms = terms
+        self.term_offsets = term_offsets
+        self.term_numbers = term_numbers
+        self.positions = None
+
+    def _term(self, i):
+        return bytes(self.terms[self.term_offsets[i]:self.term_offsets[i+1]])
+
+    def find(self, term):
+        """ Return the term number of term, or -1 if it is not indexed. """
+        key = term.encode('utf-8')
+        lo, hi = 0, len(self.term_numbers)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.term_numbers) and self._term(lo) == key:
+            return self.term_numbers[lo]
+        return -1
+
+    def term(self, number):
+        """ Return the term with the given term number. """
+        if self.positions is None:
+            positions = array('i', [0]) * len(self.term_numbers)
+            for i, n in enumerate(self.term_numbers):
+                positions[n] = i
+            self.positions = positions
+        return self._term(self.positions[number]).decode('utf-8')
+
+    def get(self, term, default=None):
+        number = self.find(term) if isinstance(term, str) else -1
+        return default if number < 0 else number
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __getitem__(self, term):
+        number = self.get(term)
+        if number is None:
+            raise KeyError(term)
+        return number
+
+    def __iter__(self):
+        for number in range(len(self.term_numbers)):
+            yield self.term(number)
+
+    def __len__(self):
+        return len(self.term_numbers)
+
+
+class PostingsTable(Mapping):
+    """ A read-only mapping from term number to postings.Postings, backed by
+    the flat postings tables of an index file. """
+
+    def __init__(self, offsets, doc_ids, weights):
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+
+    def __contains__(self, number):
+        return isinstance(number, Integral) and 0 <= number < len(self)
+
+    def __getitem__(self, number):
+        """ Return the postings list of the given term number, as views into
+        the file. """
+        if number not in self:
+            raise KeyError(number)
+        start, end = self.offsets[number], self.offsets[number+1]
+        return Postings.from_arrays(self.doc_ids[start:end], self.weights[start:end])
+
+    def length(self, number):
+        """ Return the length of the postings list of the given term number. """
+        return self.offsets[number+1] - self.offsets[number]
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class DocumentFrequencies(Mapping):
+    """ Document frequencies of a PostingsTable or a
+    postings.CompressedPostingsTable, i.e. the length of each postings
+    list. """
+
+    def __init__(self, postings):
+        self.postings = postings
+
+    def __getitem__(self, number):
+        if number not in self.postings:
+            raise KeyError(number)
+        return self.postings.length(number)
+
+    def __contains__(self, number):
+        return number in self.postings
+
+    def __iter__(self):
+        return iter(self.postings)
+
+    def __len__(self):
+        return len(self.postings)
+
+
+class DocumentStore(Sequence):
+    """ The raw document strings, decoded on access. """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __getitem__(self, doc_id):
+        if isinstance(doc_id, slice):
+            return [self[i] for i in range(*doc_id.indices(len(self)))]
+        if doc_id < 0:
+            doc_id += len(self)
+        if not 0 <= doc_id < len(self):
+            raise IndexError('document id out of range')
+        return str(self.blob[self.offsets[doc_id]:self.offsets[doc_id+1]], 'utf-8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def _flatten(index, terms, typecode):
+    """ Concatenate the postings lists of terms (in order) into offset, doc id
+    and weight arrays. """
+    offsets, doc_ids, weights = array('Q', [0]), array('i'), array(typecode)
+    for term in terms:
+        for doc_id, weight in index[term]:
+            doc_ids.append(doc_id)
+            weights.append(weight)
+        offsets.append(len(doc_ids))
+    return offsets, doc_ids, weights
+
+
+def _compressed(index, terms):
+    """ Return the postings_offsets, doc_ids, weights and compressed sections
+    for the CompressedPostings of terms (in order). """
+    if not isinstance(index, CompressedPostingsTable) or terms != list(index):
+        index = CompressedPostingsTable.pack([index[term] for term in terms])
+    return array('Q'), array('i'), array(index.typecode), index.offsets, index.data
+
+
+def _blob(strings):
+    """ UTF-8 encode and concatenate strings, returning (offsets, blob). """
+    offsets, blob = array('Q', [0]), bytearray()
+    for s in strings:
+        blob += s.encode('utf-8')
+        offsets.append(len(blob))
+    return offsets, blob
+
+
+def term_tables(terms):
+    """ Return the terms, term_offsets and term_numbers sections for a list
+    of terms given in term number order. """
+    order = sorted(range(len(terms)), key=lambda i: terms[i].encode('utf-8'))
+    term_offsets, term_blob = _blob(terms[i] for i in order)
+    return term_blob, term_offsets, array('i', order)
+
+
+def write_sections(path, typecode, n_docs, n_terms, champion_threshold, sections):
+    """ Write an index file from its sections, given in SECTIONS order. Each
+    section is either an array / bytes-like object or a binary file object,
+    which is copied from its start, so sections built on disk never have to
+    be read into memory. """
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, BYTEORDERS[sys.byteorder],
+                            typecode.encode('ascii'), n_docs, n_terms,
+                            champion_threshold))
+        position = HEADER.size + SECTION.size * len(SECTIONS)
+        table = []
+        for section in sections:
+            if hasattr(section, 'read'):
+                length = section.seek(0, 2)
+            else:
+                length = len(section) * getattr(section, 'itemsize', 1)
+            position += -position % 8
+            table.append(SECTION.pack(position, length))
+            position += length
+        f.write(b''.join(table))
+        for section in sections:
+            f.write(b'\0' * (-f.tell() % 8))
+            if hasattr(section, 'read'):
+                section.seek(0)
+                shutil.copyfileobj(section, f)
+            else:
+                f.write(section)
+
+
+def write_index(indexer, path):
+    """ Write the documents, postings, document lengths and champion lists of
+    a searcher.Index to path. Terms are numbered in the order of
+    indexer.index, which for an index keyed by term id is id order. """
+    keys = list(indexer.index.keys())
+    lexicon = indexer.lexicon
+    terms = keys if lexicon is None else [lexicon.term(key) for key in keys]
+    first = next(iter(indexer.index.values()), None)
+    typecode = getattr(first, 'typecode', 'd')
+    doc_lengths = array('d', [0.0]) * len(indexer.documents)
+    lengths = indexer.doc_lengths
+    for doc_id, length in (lengths.items() if isinstance(lengths, dict) else enumerate(lengths)):
+        doc_lengths[doc_id] = length
+    doc_offsets, doc_blob = _blob(indexer.documents)
+    max_scores = indexer.max_scores
+    if max_scores is None:
+        max_scores = indexer.compute_max_scores(indexer.index, indexer.doc_lengths)
+    max_scores = array('d', (max_scores[key] for key in keys))
+    if isinstance(first, CompressedPostings):
+        postings = _compressed(indexer.index, keys)
+    else:
+        postings = _flatten(indexer.index, keys, typecode) + (array('Q'), b'')
+    sections = (term_tables(terms) + postings[:3] +
+                _flatten(indexer.champion_index, keys, typecode) +
+                (doc_lengths, doc_offsets, doc_blob, max_scores) + postings[3:])
+    threshold = indexer.champion_threshold
+    write_sections(path, typecode, len(indexer.documents), len(terms),
+                   0 if callable(threshold) else threshold, sections)
+
+
+def read_index(path, use_mmap=True):
+    """ Read a file written by write_index. Return a dict from searcher.Index
+    attribute name to value; the postings, documents and lengths are views
+    into the file rather than copies, and are keyed by term number. """
+    with open(path, 'rb') as f:
+        if use_mmap:
+            buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        else:
+            buf = memoryview(f.read())
+    magic, version, byteorder, typecode, n_docs, n_terms, threshold = \
+        HEADER.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError('%s is not an index file' % path)
+    if version > FORMAT_VERSION:
+        raise ValueError('%s has format version %d, this code reads up to %d' %
+                         (path, version, FORMAT_VERSION))
+    if byteorder != BYTEORDERS[sys.byteorder]:
+        raise ValueError('%s was written on a machine with a different byte order' % path)
+    typecodes = {'term_offsets': 'Q', 'term_numbers': 'i', 'postings_offsets': 'Q',
+                 'doc_ids': 'i', 'weights': typecode.decode('ascii'),
+                 'champion_offsets': 'Q', 'champion_doc_ids': 'i',
+                 'champion_weights': typecode.decode('ascii'),
+                 'doc_lengths': 'd', 'doc_offsets': 'Q', 'max_scores': 'd',
+                 'compressed_offsets': 'Q'}
+    s = dict.fromkeys(SECTIONS)
+    for i, name in enumerate(SECTIONS[:SECTION_COUNTS[version]]):
+        offset, length = SECTION.unpack_from(buf, HEADER.size + i * SECTION.size)
+        s[name] = buf[offset:offset+length]
+        if name in typecodes:
+            s[name] = s[name].cast(typecodes[name])
+
+    if s['compressed_offsets'] is not None and len(s['compressed_offsets']):
+        if version < 4:
+            raise ValueError('%s has compressed postings of format version %d; rebuild it' %
+                             (path, version))
+        index = CompressedPostingsTable(s['compressed_offsets'], s['compressed_postings'],
+                                        n_terms, n_docs, typecode.decode('ascii'))
+    else:
+        index = PostingsTable(s['postings_offsets'], s['doc_ids'], s['weights'])
+    doc_freqs = DocumentFrequencies(index)
+    champion_index = PostingsTable(s['champion_offsets'], s['champion_doc_ids'],
+                                   s['champion_weights'])
+    return {'documents': DocumentStore(s['documents'], s['doc_offsets']),
+            'lexicon': TermLexicon(s['terms'], s['term_offsets'], s['term_numbers']),
+            'index': index,
+            'doc_freqs': doc_freqs,
+            'doc_lengths': s['doc_lengths'],
+            'champion_index': champion_index,
+            'champion_threshold': threshold,
+            'max_scores': s['max_scores']}
+
+
+def main():
+    from searcher import Index
+    args = [arg for arg in sys.argv[1:] if arg != '--compress']
+    Index(args[0], compress='--compress' in sys.argv).save(args[1])
+
+
+if __name__ == '__main__':
+    main()